@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# End-to-end launch latency of "runjail true".
+#
+# Every configuration is a combination of the number of extra --ro paths,
+# --nonet and the size of the host mount table. Larger host mount tables are
+# simulated by mounting tmpfs instances in a private user and mount namespace,
+# so no privileges are needed besides unprivileged user namespaces.
+#
+# With --phases the launches are traced with --trace-timing and the median
+# duration of every phase is reported as well.
+
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__) + "/..")
+
+from runjail.Libc import Libc
+from runjail.UserNs import UserNs
+
+RUNJAIL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin", "runjail")
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of the sorted list |samples|."""
+    index = max(0, -(-len(samples) * p // 100) - 1)
+    return samples[int(index)]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return { "runs": len(samples),
+             "min": samples[0],
+             "median": percentile(samples, 50),
+             "p95": percentile(samples, 95),
+             "p99": percentile(samples, 99),
+             "max": samples[-1] }
+
+
+def make_ro_paths(base, count):
+    paths = []
+    for i in range(count):
+        path = os.path.join(base, "ro{}".format(i))
+        os.makedirs(path, exist_ok=True)
+        paths.append(path)
+    return paths
+
+
+def summarize_phases(records):
+    durations = collections.OrderedDict()
+    for record in records:
+        for phase, duration in record["phases"]:
+            durations.setdefault(phase, []).append(duration / 1000)
+
+    return { "phases": collections.OrderedDict((phase, percentile(sorted(samples), 50))
+                                               for phase, samples in durations.items()),
+             "counters": records[-1]["counters"] }
+
+
+def run_traced(command, env):
+    read_fd, write_fd = os.pipe()
+    try:
+        result = subprocess.run(command[:2] + ["--trace-timing", "--trace-fd={}".format(write_fd)] + command[2:],
+                                env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, pass_fds=(write_fd,))
+    finally:
+        os.close(write_fd)
+
+    with os.fdopen(read_fd) as f:
+        data = f.readline()
+
+    return result, json.loads(data) if data else None
+
+
+def measure(args, ro_paths, nonet, env):
+    command = [sys.executable, RUNJAIL, "--cwd=/"]
+    command += ["--ro=" + path for path in ro_paths]
+    if nonet:
+        command.append("--nonet")
+    if args.no_cache:
+        command.append("--no-cache")
+    command += ["--", "true"]
+
+    samples = []
+    records = []
+    for i in range(args.warmup + args.runs):
+        start = time.perf_counter()
+        if args.phases:
+            result, record = run_traced(command, env)
+        else:
+            result = subprocess.run(command, env=env, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        elapsed = time.perf_counter() - start
+
+        if result.returncode != 0:
+            raise RuntimeError("runjail failed with exit code {}: {}".format(
+                result.returncode, result.stderr.decode(errors="replace").strip()))
+        if i >= args.warmup:
+            samples.append(elapsed)
+            if args.phases:
+                records.append(record)
+
+    summary = summarize(samples)
+    if args.phases:
+        summary.update(summarize_phases(records))
+    return summary
+
+
+def in_mount_namespace(mount_root, host_mounts, func):
+    """Run |func| in a private user and mount namespace that has
+    |host_mounts| additional tmpfs mounts below |mount_root|.
+    Returns:
+        The return value of |func|, it has to be JSON serializable.
+    """
+    read_fd, write_fd = os.pipe2(os.O_CLOEXEC)
+
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            os.close(read_fd)
+            userns = UserNs(None)
+            Libc().unshare(Libc.CLONE_NEWUSER | Libc.CLONE_NEWNS)
+            userns.setup_user_mapping()
+            userns.mount_private_propagation("/")
+
+            userns.mount_tmpfs(mount_root, "755")
+            for i in range(host_mounts):
+                path = os.path.join(mount_root, "m{}".format(i))
+                os.mkdir(path)
+                userns.mount_tmpfs(path, "755")
+
+            result = func()
+            with os.fdopen(write_fd, "w") as f:
+                json.dump(result, f)
+            exit_code = 0
+        except BaseException as e:
+            print("Benchmark failed: {}".format(e), file=sys.stderr)
+        os._exit(exit_code)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        data = f.read()
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("Benchmark in the private mount namespace failed.")
+
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ro-paths", type=int, action="append",
+                        help="Number of extra --ro paths (default: 0, 10, 100 and 1000).")
+    parser.add_argument("--host-mounts", type=int, action="append",
+                        help="Number of synthetic host mounts (default: 0, 100 and 1000).")
+    parser.add_argument("--mount-root", default="/mnt",
+                        help="Directory that the synthetic host mounts are placed in (default: /mnt).")
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Pass --no-cache to runjail.")
+    parser.add_argument("--phases", action="store_true",
+                        help="Report the median duration of every launch phase.")
+    parser.add_argument("--json", help="Write the results to this file.")
+    args = parser.parse_args()
+
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="runjail-bench") as scratch:
+        env = os.environ.copy()
+        # don't touch the plan cache of the user
+        env["XDG_CACHE_HOME"] = os.path.join(scratch, "cache")
+
+        for host_mounts in args.host_mounts or [0, 100, 1000]:
+            for ro_count in args.ro_paths or [0, 10, 100, 1000]:
+                ro_paths = make_ro_paths(os.path.join(scratch, "ro"), ro_count)
+
+                for nonet in (False, True):
+                    if host_mounts:
+                        summary = in_mount_namespace(args.mount_root, host_mounts,
+                                                     lambda: measure(args, ro_paths, nonet, env))
+                    else:
+                        summary = measure(args, ro_paths, nonet, env)
+
+                    summary.update({"host_mounts": host_mounts, "ro_paths": ro_count, "nonet": nonet})
+                    results.append(summary)
+                    print("host mounts {:5}, ro paths {:5}, nonet {:1}: median {:8.2f} ms, "
+                          "p95 {:8.2f} ms, p99 {:8.2f} ms".format(
+                              host_mounts, ro_count, int(nonet), summary["median"] * 1000,
+                              summary["p95"] * 1000, summary["p99"] * 1000))
+                    if args.phases:
+                        print("    " + ", ".join("{} {:.2f}".format(phase, duration * 1000)
+                                                 for phase, duration in summary["phases"].items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"python": sys.version.split()[0],
+                       "kernel": os.uname().release,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
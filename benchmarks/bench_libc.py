@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Per-call overhead of Libc.mount() against the untyped ctypes calls with
+# string buffers that were used before. The mount fails early with ENOENT
+# (or EPERM without privileges) so mostly the Python side is measured.
+
+import argparse
+import ctypes
+import errno
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__) + "/..")
+
+from runjail.Libc import Libc, load_library
+
+TARGET = "/nonexistent/runjail-bench"
+
+
+class LegacyLibc:
+    """The Libc.mount() implementation before the prototypes were declared."""
+
+    def __init__(self):
+        self._lib = load_library("libc.so.6", "c")
+
+    def _to_c_string(self, string):
+        if string is None:
+            return None
+        else:
+            return ctypes.create_string_buffer(string.encode(sys.getdefaultencoding()))
+
+    def _errno_exception(self):
+        return OSError(ctypes.get_errno(), errno.errorcode[ctypes.get_errno()])
+
+    def mount(self, source, target, fstype, mountflags=0, data=None):
+        result = self._lib.mount(self._to_c_string(source),
+                                 self._to_c_string(target),
+                                 self._to_c_string(fstype),
+                                 mountflags,
+                                 self._to_c_string(data))
+
+        if result != 0:
+            raise self._errno_exception()
+
+
+def failing_mount(libc):
+    try:
+        libc.mount("tmpfs", TARGET, "tmpfs", Libc.MS_NOSUID, "mode=700")
+    except OSError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="Write the results to this file.")
+    args = parser.parse_args()
+
+    results = {}
+    for name, libc in (("legacy", LegacyLibc()), ("typed", Libc())):
+        best = min(timeit.repeat(lambda: failing_mount(libc), number=args.number, repeat=args.repeat))
+        results[name] = best / args.number
+        print("{:6}: {:6.2f} us per mount() call".format(name, results[name] * 1000000))
+
+    print("speedup: {:.2f}x".format(results["legacy"] / results["typed"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark of the mountinfo parser on synthetic mount tables.
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(__file__) + "/..")
+
+from runjail.MountInfo import MountInfo
+
+
+def legacy_parse(filename):
+    """The parser before the rewrite, kept as the baseline."""
+    def unescape(field):
+        return re.sub(r"\\(\d{1,3})", lambda match: chr(int(match.group(1), 8)), field)
+
+    mounts = []
+    with open(filename) as f:
+        for line in f:
+            fields = [unescape(field) for field in line.rstrip("\n").split(" ")]
+            index_dash = -1
+            for i in range(6, len(fields)):
+                if fields[i] == "-":
+                    index_dash = i
+            mount = fields[:6] + [fields[6:index_dash]] + fields[index_dash + 1:]
+            flags = 0
+            for option in mount[5].split(","):
+                flags |= {"ro": 1, "nosuid": 2, "nodev": 4, "noexec": 8}.get(option, 0)
+            mounts.append((mount, flags))
+    return mounts
+
+
+def write_mountinfo(f, lines):
+    f.write("1 0 254:0 / / rw,relatime shared:1 - ext4 /dev/vda rw\n")
+    for i in range(2, lines + 1):
+        parent_id = max(1, i // 8)
+        if i % 50 == 0:
+            mount_point = "/srv/dir\\040with\\040spaces/{}".format(i)
+        else:
+            mount_point = "/srv/{}/mnt{}".format(parent_id, i)
+        options = "ro,nosuid,nodev,relatime" if i % 3 else "rw,noatime"
+        f.write("{} {} 0:{} / {} {} shared:{} master:{} - tmpfs tmpfs rw,size={}k,mode=755\n".format(
+            i, parent_id, i, mount_point, options, i, parent_id, i))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, action="append",
+                        help="Number of lines of the synthetic mount table (default: 1000 and 10000).")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="Write the results to this file.")
+    args = parser.parse_args()
+
+    results = []
+
+    for lines in args.lines or [1000, 10000]:
+        with tempfile.NamedTemporaryFile("w", prefix="mountinfo") as f:
+            write_mountinfo(f, lines)
+            f.flush()
+
+            legacy = min(timeit.repeat(lambda: legacy_parse(f.name), number=1, repeat=args.repeat))
+            current = min(timeit.repeat(lambda: MountInfo(filename=f.name), number=1, repeat=args.repeat))
+            mount_info = MountInfo(filename=f.name)
+            lookup = min(timeit.repeat(lambda: mount_info.get_mounts_under("/srv/1"),
+                                       number=100, repeat=args.repeat)) / 100
+
+        results.append({"lines": lines, "legacy_parse": legacy, "parse": current, "mounts_under": lookup})
+        print("{:6} lines: legacy {:8.2f} ms, parse {:8.2f} ms ({:.1f}x), mounts_under {:8.3f} ms".format(
+            lines, legacy * 1000, current * 1000, legacy / current, lookup * 1000))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
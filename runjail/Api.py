@@ -0,0 +1,274 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Library interface to run commands in sandboxes.
+
+All namespace work happens in a forked helper process, the calling process
+is never unshared, chrooted or exited. The helper is the process that
+Runjail.run turns into the monitor of the sandbox, so its exit status is
+the one of the command and the sandbox is killed when it dies.
+"""
+
+import os
+import select
+import signal
+import traceback
+
+from runjail.Libc import Libc
+from runjail.Runjail import Options, Runjail
+
+# same values as in the subprocess module
+PIPE = -1
+DEVNULL = -3
+
+
+def make_options(ro=(), rw=(), hide=(), empty=(), emptyro=(), overlay=(), hide_glob=(), cwd=None, nonet=False, env=None,
+                 kill_timeout=None, cgroup_root=None, cgroup_limits=None, tmpfs_options=None, seeds=None, seccomp=None):
+    """Combine the host defaults with additional mounts, like the command line does.
+    Args:
+        hide_glob: Patterns of paths to hide like "/repo/**/*.pem" (see HideGlob).
+        cwd: Working directory of the command (default: the current one).
+        env: Environment of the command (default: the current one).
+        kill_timeout: Seconds until a terminated sandbox is killed (default: never).
+        cgroup_limits: Maps cgroup v2 interface files like "memory.max" to values,
+            applied to a new cgroup below |cgroup_root|, a delegated cgroup v2
+            without processes that is required by them.
+        tmpfs_options: Maps empty and emptyro paths to tmpfs options like "size=2G".
+        seeds: Maps empty and emptyro paths to tar archives that are extracted into them.
+        seccomp: Name of the seccomp profile that filters the syscalls of the command.
+    Raises:
+        ValueError if a mount, tmpfs option or the seccomp profile is invalid
+        or |cgroup_limits| lack |cgroup_root|,
+        OSError if the seccomp profile can't be read.
+    """
+    if cgroup_limits and cgroup_root is None:
+        raise ValueError("cgroup_limits need a cgroup_root.")
+
+    runjail = Runjail()
+    defaults = runjail.get_defaults()
+
+    if hide_glob:
+        from runjail.HideGlob import HideGlob
+        hide = list(hide)
+        for pattern in hide_glob:
+            hide += HideGlob(pattern, Runjail.get_cache_dir()).expand()
+
+    mounts = Runjail.resolve_mounts(defaults, { "ro": ro,
+                                                "rw": rw,
+                                                "hide": hide,
+                                                "empty": empty,
+                                                "emptyro": emptyro,
+                                                "overlay": overlay })
+
+    if tmpfs_options is not None:
+        tmpfs_options = { Runjail.preprocess_path(path): Runjail.format_tmpfs_options(Runjail.parse_tmpfs_options(value))
+                          for path, value in tmpfs_options.items() }
+
+    if seeds is not None:
+        seeds = { Runjail.preprocess_path(path): os.path.abspath(archive) for path, archive in seeds.items() }
+        for path in seeds:
+            if path not in mounts["empty"] and path not in mounts["emptyro"]:
+                raise ValueError("\"{}\" isn't an empty mount, it can't be seeded.".format(path))
+
+    if seccomp is not None:
+        from runjail.Seccomp import SeccompProfile
+        seccomp = SeccompProfile(seccomp).load(Runjail.get_cache_dir())
+
+    return Options(ro=mounts["ro"],
+                   rw=mounts["rw"],
+                   hide=mounts["hide"],
+                   empty=mounts["empty"],
+                   emptyro=mounts["emptyro"],
+                   overlay=mounts["overlay"],
+                   symlink=defaults["symlink"],
+                   cwd=os.getcwd() if cwd is None else cwd,
+                   nonet=nonet,
+                   env=env,
+                   kill_timeout=kill_timeout,
+                   cgroup_root=cgroup_root,
+                   cgroup_limits=cgroup_limits,
+                   tmpfs_options=tmpfs_options,
+                   seeds=seeds,
+                   seccomp=seccomp)
+
+
+def _open_stdio(stdin, stdout, stderr):
+    """Returns:
+        A list of (target fd, fd) for the helper, the fds that have to be
+        closed after the fork and the file objects of the pipes.
+    """
+    child_fds = []
+    close_fds = []
+    files = []
+
+    for target_fd, spec in ((0, stdin), (1, stdout), (2, stderr)):
+        file = None
+        if spec is None:
+            fd = None
+        elif spec == PIPE:
+            read_fd, write_fd = os.pipe2(os.O_CLOEXEC)
+            if target_fd == 0:
+                fd = read_fd
+                file = open(write_fd, "wb")
+            else:
+                fd = write_fd
+                file = open(read_fd, "rb")
+            close_fds.append(fd)
+        elif spec == DEVNULL:
+            fd = os.open(os.devnull, os.O_RDWR | os.O_CLOEXEC)
+            close_fds.append(fd)
+        elif isinstance(spec, int):
+            fd = spec
+        else:
+            fd = spec.fileno()
+
+        if fd is not None:
+            child_fds.append((target_fd, fd))
+        files.append(file)
+
+    return child_fds, close_fds, files
+
+
+def _fork_helper(options, argv, stdin, stdout, stderr, plan_cache):
+    child_fds, close_fds, files = _open_stdio(stdin, stdout, stderr)
+
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 1
+        try:
+            # the parent ends of the pipes, the command wouldn't see EOF otherwise
+            for file in files:
+                if file is not None:
+                    os.close(file.fileno())
+
+            # move the fds out of the way so they can't overwrite each other
+            child_fds = [(target_fd, os.dup(fd)) for target_fd, fd in child_fds]
+            for target_fd, fd in child_fds:
+                os.dup2(fd, target_fd)
+                os.close(fd)
+
+            Runjail().run(options, argv, plan_cache)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            traceback.print_exc()
+        os._exit(exit_code)
+
+    for fd in close_fds:
+        os.close(fd)
+
+    return pid, files
+
+
+class Process:
+    """Handle of a sandboxed command, similar to subprocess.Popen."""
+
+    def __init__(self, pid, stdin, stdout, stderr):
+        self.pid = pid
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        # readable once the helper exited
+        self._pidfd = Libc().pidfd_open(pid)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for file in (self.stdin, self.stdout, self.stderr):
+            if file is not None:
+                file.close()
+        self.wait()
+
+    def _set_status(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        os.close(self._pidfd)
+        self._pidfd = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                self._set_status(status)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Wait until the command exited.
+        Raises:
+            subprocess.TimeoutExpired if it's still running after |timeout| seconds.
+        """
+        if self.returncode is None:
+            readable, writable, exceptional = select.select([self._pidfd], [], [], timeout)
+            if not readable:
+                import subprocess
+                raise subprocess.TimeoutExpired(self.pid, timeout)
+            self._set_status(os.waitpid(self.pid, 0)[1])
+        return self.returncode
+
+    def send_signal(self, sig):
+        """Send |sig| to the helper, the sandbox is killed when the helper dies."""
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class AsyncProcess(Process):
+    """Process whose wait() is a coroutine driven by the pidfd in the event loop."""
+
+    async def wait(self):
+        if self.returncode is None:
+            import asyncio
+
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+
+            def on_exit():
+                if not future.done():
+                    future.set_result(None)
+
+            loop.add_reader(self._pidfd, on_exit)
+            try:
+                await future
+            finally:
+                loop.remove_reader(self._pidfd)
+
+            self._set_status(os.waitpid(self.pid, 0)[1])
+        return self.returncode
+
+
+def spawn(options, argv, stdin=None, stdout=None, stderr=None, plan_cache=None):
+    """Run |argv| in a sandbox described by |options| (see make_options()).
+    Args:
+        stdin, stdout, stderr: None to inherit, PIPE, DEVNULL, a fd or a file object.
+    Returns:
+        A Process.
+    """
+    pid, files = _fork_helper(options, argv, stdin, stdout, stderr, plan_cache)
+    return Process(pid, *files)
+
+
+async def spawn_async(options, argv, stdin=None, stdout=None, stderr=None, plan_cache=None):
+    """Like spawn() but returns an AsyncProcess."""
+    pid, files = _fork_helper(options, argv, stdin, stdout, stderr, plan_cache)
+    return AsyncProcess(pid, *files)
@@ -0,0 +1,262 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import json
+import os
+import selectors
+import signal
+import sys
+import time
+import traceback
+
+from runjail.Libc import Libc
+from runjail.Runjail import Runjail
+
+Job = collections.namedtuple("Job", ["id", "argv", "cwd", "env", "mounts"])
+
+RunningJob = collections.namedtuple("RunningJob", ["job", "pid", "pidfd", "start"])
+
+
+def read_jobs(f):
+    """Parse one job per line of |f|.
+
+    Each line is a JSON object with the "argv" list and optionally "id",
+    "cwd", "env" (added to the current environment) and the lists "ro",
+    "rw", "hide", "empty", "emptyro" and "overlay" of extra mounts.
+    Raises:
+        ValueError if a line is invalid.
+    """
+    jobs = []
+    ids = set()
+
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("not a JSON object")
+
+            argv = data["argv"]
+            if not isinstance(argv, list) or not argv or not all(isinstance(arg, str) for arg in argv):
+                raise ValueError("\"argv\" has to be a non-empty list of strings")
+
+            env = data.get("env")
+            if env is not None and not (isinstance(env, dict) and
+                                        all(isinstance(value, str) for value in env.values())):
+                raise ValueError("\"env\" has to map names to strings")
+
+            mounts = { category: data[category] for category in Runjail.MOUNT_CATEGORIES if category in data }
+            for category, paths in mounts.items():
+                if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                    raise ValueError("\"{}\" has to be a list of paths".format(category))
+
+            job_id = str(data.get("id", line_number))
+            if job_id in ids:
+                raise ValueError("duplicate id \"{}\"".format(job_id))
+            if "/" in job_id or job_id.startswith("."):
+                raise ValueError("invalid id \"{}\"".format(job_id))
+            ids.add(job_id)
+        except (KeyError, ValueError) as e:
+            raise ValueError("Invalid job in line {}: {}".format(line_number, e))
+
+        jobs.append(Job(job_id, argv, data.get("cwd"), env, mounts))
+
+    return jobs
+
+
+class TaggedOutput:
+    """Copies the output of a job to a stream, every line prefixed with the job id."""
+
+    def __init__(self, job_id, stream):
+        self._prefix = "[{}] ".format(job_id).encode()
+        self._stream = stream
+        self._buffer = b""
+
+    def feed(self, data):
+        if not data:
+            # EOF, terminate an incomplete last line
+            if self._buffer:
+                self._write([self._buffer + b"\n"])
+                self._buffer = b""
+            return
+
+        lines = (self._buffer + data).split(b"\n")
+        self._buffer = lines.pop()
+        self._write([line + b"\n" for line in lines])
+
+    def _write(self, lines):
+        if lines:
+            self._stream.write(b"".join(self._prefix + line for line in lines))
+            self._stream.flush()
+
+
+class Batch:
+    """Runs jobs in parallel sandboxes that share the resolved mounts and plans.
+
+    Every job is forked from this process and goes through Runjail.run, so
+    only the job specific mounts are validated and compiled per job.
+    """
+
+    def __init__(self, runjail, options, parallel, output_dir=None, plan_cache=None):
+        """Args:
+            options: Options shared by all jobs.
+            parallel: Maximum number of jobs that run at the same time.
+            output_dir: Write the output of every job to <id>.out and <id>.err
+                in this directory instead of the tagged stdout/stderr.
+        """
+        self._runjail = runjail
+        self._options = options
+        self._parallel = parallel
+        self._output_dir = output_dir
+        self._plan_cache = plan_cache
+        self._libc = Libc()
+        # compiled plans by the mounts of the job
+        self._plans = {}
+
+    def _get_options(self, job):
+        options = self._options
+        if job.mounts:
+            base = { category: getattr(options, category) for category in Runjail.MOUNT_CATEGORIES }
+            options = options._replace(**Runjail.resolve_mounts(base, job.mounts))
+
+        env = None
+        if job.env is not None:
+            env = dict(os.environ)
+            env.update(job.env)
+
+        return options._replace(cwd=job.cwd or options.cwd, env=env)
+
+    def _get_plan(self, options):
+        key = tuple(tuple(getattr(options, category)) for category in Runjail.MOUNT_CATEGORIES)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = self._runjail.get_plan(options, self._plan_cache)
+        return plan
+
+    def _open_outputs(self, job):
+        """Returns:
+            A list of (target fd, fd) for stdin, stdout and stderr of the job
+            and a dict of the pipes of the tagged stream by fd.
+        """
+        stdin_fd = os.open(os.devnull, os.O_RDONLY | os.O_CLOEXEC)
+        tagged = {}
+
+        if self._output_dir is not None:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC
+            stdout_fd = os.open(os.path.join(self._output_dir, job.id + ".out"), flags, 0o644)
+            stderr_fd = os.open(os.path.join(self._output_dir, job.id + ".err"), flags, 0o644)
+        else:
+            read_fd, stdout_fd = os.pipe2(os.O_CLOEXEC)
+            tagged[read_fd] = TaggedOutput(job.id, sys.stdout.buffer)
+            read_fd, stderr_fd = os.pipe2(os.O_CLOEXEC)
+            tagged[read_fd] = TaggedOutput(job.id, sys.stderr.buffer)
+
+        return [(0, stdin_fd), (1, stdout_fd), (2, stderr_fd)], tagged
+
+    def _start(self, job, selector):
+        options = self._get_options(job)
+        plan = self._get_plan(options)
+        fds, tagged = self._open_outputs(job)
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                # the pipes and pidfds of the other jobs
+                for fd in list(selector.get_map()):
+                    os.close(fd)
+                selector.close()
+                for target_fd, fd in fds:
+                    os.dup2(fd, target_fd)
+                self._runjail.run(options, job.argv, plan=plan)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+            os._exit(exit_code)
+
+        for target_fd, fd in fds:
+            os.close(fd)
+
+        try:
+            pidfd = self._libc.pidfd_open(pid)
+        except OSError:
+            # the job can't be tracked, don't leave it running
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            for fd in tagged:
+                os.close(fd)
+            raise
+
+        for fd, output in tagged.items():
+            selector.register(fd, selectors.EVENT_READ, output)
+        running = RunningJob(job, pid, pidfd, time.monotonic())
+        selector.register(pidfd, selectors.EVENT_READ, running)
+
+    def run(self, jobs):
+        """Run all |jobs|.
+        Returns:
+            A list with a summary dict of every job.
+        """
+        pending = collections.deque(jobs)
+        results = {}
+        running = 0
+
+        with selectors.DefaultSelector() as selector:
+            while pending or len(selector.get_map()) > 0:
+                while pending and running < self._parallel:
+                    job = pending.popleft()
+                    try:
+                        self._start(job, selector)
+                        running += 1
+                    except (OSError, ValueError) as e:
+                        results[job.id] = { "id": job.id, "argv": job.argv, "error": str(e) }
+
+                if not selector.get_map():
+                    continue
+
+                for key, events in selector.select():
+                    if isinstance(key.data, TaggedOutput):
+                        data = os.read(key.fd, 65536)
+                        key.data.feed(data)
+                        if not data:
+                            selector.unregister(key.fd)
+                            os.close(key.fd)
+                    else:
+                        selector.unregister(key.fd)
+                        os.close(key.fd)
+                        results[key.data.job.id] = self._finish(key.data)
+                        running -= 1
+
+        return [results[job.id] for job in jobs]
+
+    def _finish(self, running):
+        pid, status = os.waitpid(running.pid, 0)
+        result = { "id": running.job.id,
+                   "argv": running.job.argv,
+                   "duration": time.monotonic() - running.start }
+
+        if os.WIFSIGNALED(status):
+            result["signal"] = os.WTERMSIG(status)
+        else:
+            result["exit_code"] = os.WEXITSTATUS(status)
+
+        return result
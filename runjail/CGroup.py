@@ -0,0 +1,106 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+
+class CGroup:
+    """cgroup v2 child of a delegated cgroup that limits the resources of one sandbox.
+
+    The limits map interface files like "memory.max" to the value written to
+    them, the controllers they belong to are enabled in the root. The root
+    can't contain processes itself once controllers are enabled, so it has
+    to be a delegated cgroup other than the one runjail is started in.
+    """
+
+    MOUNT = "/sys/fs/cgroup"
+
+    def __init__(self, root, limits):
+        self._root = root
+        self._limits = limits
+        self._path = os.path.join(root, "runjail-{}".format(os.getpid()))
+        self._return_fd = None
+
+    @staticmethod
+    def get_current_path():
+        """Returns:
+            The path of the cgroup v2 of the current process.
+        """
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                hierarchy, controllers, path = line.rstrip("\n").split(":", 2)
+                if hierarchy == "0":
+                    return CGroup.MOUNT + path.rstrip("/")
+        raise FileNotFoundError("No cgroup v2 hierarchy.")
+
+    def get_path(self):
+        return self._path
+
+    def _write(self, path, value):
+        with open(path, "w") as f:
+            f.write(value)
+
+    def create(self):
+        """Create the cgroup and apply the limits.
+        Raises:
+            OSError if the root isn't writable or a limit is rejected.
+        """
+        controllers = sorted(set(name.split(".")[0] for name in self._limits))
+        self._write(os.path.join(self._root, "cgroup.subtree_control"),
+                    " ".join("+" + controller for controller in controllers))
+
+        os.mkdir(self._path, 0o755)
+        try:
+            for name, value in sorted(self._limits.items()):
+                try:
+                    self._write(os.path.join(self._path, name), value)
+                except OSError as e:
+                    raise OSError(e.errno, "{}: {}".format(name, e.strerror))
+        except OSError:
+            self._rmdir()
+            raise
+
+    def enter(self, return_path=None):
+        """Move the current process into the cgroup, its children inherit it.
+        Args:
+            return_path: The cgroup remove() moves the process back to
+                (default: the current one).
+        """
+        if return_path is None:
+            return_path = CGroup.get_current_path()
+
+        # opened now, the permissions of a migration are checked with the credentials of the opener
+        self._return_fd = os.open(os.path.join(return_path, "cgroup.procs"), os.O_WRONLY | os.O_CLOEXEC)
+        self._write(os.path.join(self._path, "cgroup.procs"), str(os.getpid()))
+
+    def remove(self):
+        """Leave the cgroup and remove it, the sandbox has to be dead."""
+        if self._return_fd is not None:
+            try:
+                os.write(self._return_fd, str(os.getpid()).encode())
+            except OSError:
+                # e.g. the original cgroup was removed, the cgroup stays as empty leftover once we exit
+                pass
+            os.close(self._return_fd)
+            self._return_fd = None
+
+        self._rmdir()
+
+    def _rmdir(self):
+        try:
+            os.rmdir(self._path)
+        except OSError:
+            # exiting processes can keep it busy for a moment, it's only a leftover empty directory then
+            pass
@@ -0,0 +1,204 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fnmatch
+import marshal
+import os
+import re
+
+
+class HideGlob:
+    """Expands a pattern like "/repo/**/*.pem" to the paths that have to be hidden.
+
+    Every path component is matched with fnmatch (so "*" also matches a
+    leading dot) and "**" matches any number of directories. The walk starts
+    at the directory before the first component with wildcards, doesn't
+    follow symlinks or cross file systems, skips symlinks in the matches and
+    doesn't descend into matched directories or directories the remaining
+    pattern can't match in.
+
+    The result of every scanned directory, its matches and the subdirectories
+    to descend into, is cached by the inode and mtime of the directory. They
+    change whenever an entry is added, removed or renamed, so repeated
+    launches only stat the directories instead of listing them.
+    """
+
+    VERSION = 1
+
+    def __init__(self, pattern, cache_dir=None):
+        """Args:
+            cache_dir: Directory of the cache of scanned directories, None disables caching.
+        Raises:
+            ValueError if the pattern is empty.
+        """
+        pattern = os.path.expanduser(pattern)
+        components = [component for component in pattern.split("/") if component]
+        if not components:
+            raise ValueError("Invalid hide pattern \"{}\".".format(pattern))
+
+        root = []
+        while components and not HideGlob._has_wildcards(components[0]):
+            root.append(components.pop(0))
+
+        root_path = os.path.join("/" if os.path.isabs(pattern) else "", *root)
+        self._root = os.path.realpath(root_path)
+        self._components = components
+        # None for "**"
+        self._matchers = [None if component == "**" else re.compile(fnmatch.translate(component)).match
+                          for component in components]
+        self._closures = [self._closure(state) for state in range(len(components) + 1)]
+        self._cache_dir = cache_dir
+        self._cache = {}
+        # only the directories of the last expansion are stored
+        self._new_cache = {}
+        self._cache_changed = False
+
+    @staticmethod
+    def _has_wildcards(component):
+        return any(char in component for char in "*?[")
+
+    def _closure(self, state):
+        """Returns:
+            The states reachable from |state| without a path component, "**"
+            can match zero directories.
+        """
+        states = [state]
+        while state < len(self._components) and self._components[state] == "**":
+            state += 1
+            states.append(state)
+        return frozenset(states)
+
+    def _advance(self, states, name):
+        next_states = set()
+        for state in states:
+            if state == len(self._components):
+                continue
+            matcher = self._matchers[state]
+            if matcher is None:
+                next_states |= self._closures[state]
+            elif matcher(name):
+                next_states |= self._closures[state + 1]
+        return next_states
+
+    def _get_cache_path(self):
+        import hashlib
+        key = "\0".join([self._root] + self._components)
+        name = hashlib.sha256(key.encode("utf-8", "surrogateescape")).hexdigest()[:32]
+        return os.path.join(self._cache_dir, "hide-glob", name + ".marshal")
+
+    def _load_cache(self):
+        try:
+            with open(self._get_cache_path(), "rb") as f:
+                version, cache = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if version == HideGlob.VERSION:
+            self._cache = cache
+
+    def _store_cache(self):
+        path = self._get_cache_path()
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                marshal.dump((HideGlob.VERSION, self._cache), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is only an optimization
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _scan(self, path, stat, states):
+        """Match the entries of the directory |path| that is reached in |states|.
+        Returns:
+            A tuple of the list of matching names and a list of tuples of the
+            name and states of the subdirectories to descend into.
+        """
+        key = (stat.st_ino, stat.st_mtime_ns)
+        cached = self._cache.get(path)
+        if cached is not None and cached[0] == key:
+            self._new_cache[path] = cached
+            return cached[1], cached[2]
+
+        matches = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    continue
+
+                entry_states = self._advance(states, entry.name)
+                if not entry_states:
+                    continue
+
+                if len(self._components) in entry_states:
+                    # hidden with everything beneath it
+                    matches.append(entry.name)
+                else:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append((entry.name, tuple(sorted(entry_states))))
+                    except OSError:
+                        pass
+
+        self._new_cache[path] = (key, matches, subdirs)
+        self._cache_changed = True
+        return matches, subdirs
+
+    def expand(self):
+        """Returns:
+            The sorted list of the matching paths.
+        """
+        try:
+            root_stat = os.stat(self._root)
+        except OSError:
+            return []
+
+        states = self._closures[0]
+        if len(self._components) in states:
+            return [self._root]
+
+        if self._cache_dir is not None:
+            self._load_cache()
+
+        matches = []
+        # a stack instead of recursion, deep trees don't hit the recursion limit
+        stack = [(self._root, root_stat, tuple(sorted(states)))]
+        while stack:
+            path, stat, states = stack.pop()
+            try:
+                names, subdirs = self._scan(path, stat, states)
+            except OSError:
+                continue
+
+            prefix = path if path.endswith("/") else path + "/"
+            matches.extend(prefix + name for name in names)
+
+            for name, subdir_states in subdirs:
+                try:
+                    subdir_stat = os.stat(prefix + name, follow_symlinks=False)
+                except OSError:
+                    continue
+                if subdir_stat.st_dev == root_stat.st_dev:
+                    stack.append((prefix + name, subdir_stat, subdir_states))
+
+        if self._cache_dir is not None and (self._cache_changed or len(self._new_cache) != len(self._cache)):
+            self._cache = self._new_cache
+            self._store_cache()
+
+        return sorted(matches)
@@ -14,12 +14,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ctypes
-import ctypes.util
+
+from runjail.Libc import load_library
 
 
 class Pcap:
     def __init__(self):
-        self._libcap = ctypes.CDLL(ctypes.util.find_library("cap"))
+        self._libcap = load_library("libcap.so.2", "cap")
         self._libcap.cap_init.argtypes = []
         self._libcap.cap_init.restype = ctypes.c_void_p
         self._libcap.cap_clear.argtypes = [ctypes.c_void_p]
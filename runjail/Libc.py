@@ -14,10 +14,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ctypes
-import ctypes.util
-import errno
+import os
+import signal
 import sys
 
+from runjail import Trace
+
+_FS_ENCODING = sys.getfilesystemencoding()
+_FS_ERRORS = sys.getfilesystemencodeerrors()
+
+
+def load_library(soname, name):
+    """Load a shared library by its soname.
+    ctypes.util.find_library() is only used as fallback as it may run ldconfig or gcc.
+    """
+    try:
+        return ctypes.CDLL(soname, use_errno=True)
+    except OSError:
+        from ctypes.util import find_library
+        return ctypes.CDLL(find_library(name), use_errno=True)
+
 
 class Libc:
     CLONE_NEWIPC =  0x08000000
@@ -26,9 +42,15 @@ class Libc:
     CLONE_NEWPID =  0x20000000
     CLONE_NEWUSER = 0x10000000
     CLONE_NEWUTS =  0x04000000
+    CLONE_PIDFD =   0x00001000
+    CLONE_INTO_CGROUP = 0x200000000
 
     MNT_DETACH =    0x2
 
+    AT_FDCWD =      -100
+    AT_EMPTY_PATH = 0x1000
+    AT_RECURSIVE =  0x8000
+
     MS_RDONLY =      0x00000001
     MS_NOSUID =      0x00000002
     MS_NODEV =       0x00000004
@@ -56,42 +78,186 @@ class Libc:
     MS_ACTIVE =      0x40000000
     MS_NOUSER =      0x80000000
 
+    PR_SET_PDEATHSIG =    1
+    PR_SET_SECCOMP =      22
     PR_SET_NO_NEW_PRIVS = 38
 
+    SECCOMP_MODE_FILTER = 2
+    # size of struct sock_filter
+    SOCK_FILTER_SIZE = 8
+
+    AF_INET =      2
+    SOCK_DGRAM =   2
+    SOCK_CLOEXEC = 0o2000000
+
+    SIOCGIFFLAGS = 0x8913
+    SIOCSIFFLAGS = 0x8914
+    IFF_UP =       0x1
+    # struct ifreq with ifr_flags, padded to the size of the union
+    IFREQ_FLAGS_FORMAT = "16sh22x"
+
+    OPEN_TREE_CLONE =   0x1
+    OPEN_TREE_CLOEXEC = 0o2000000
+
+    MOVE_MOUNT_F_EMPTY_PATH = 0x04
+    MOVE_MOUNT_T_EMPTY_PATH = 0x40
+
+    MOUNT_ATTR_RDONLY =      0x00000001
+    MOUNT_ATTR_NOSUID =      0x00000002
+    MOUNT_ATTR_NODEV =       0x00000004
+    MOUNT_ATTR_NOEXEC =      0x00000008
+    MOUNT_ATTR_NOATIME =     0x00000010
+    MOUNT_ATTR_NODIRATIME =  0x00000080
+
+    SFD_CLOEXEC = 0o2000000
+    # size of struct signalfd_siginfo, it starts with the uint32 ssi_signo
+    SIGNALFD_SIGINFO_SIZE = 128
+
+    FSOPEN_CLOEXEC =  0x1
+    FSMOUNT_CLOEXEC = 0x1
+
+    FSCONFIG_SET_FLAG =        0
+    FSCONFIG_SET_STRING =      1
+    FSCONFIG_SET_BINARY =      2
+    FSCONFIG_SET_PATH =        3
+    FSCONFIG_SET_PATH_EMPTY =  4
+    FSCONFIG_SET_FD =          5
+    FSCONFIG_CMD_CREATE =      6
+    FSCONFIG_CMD_RECONFIGURE = 7
+
+    # the numbers of syscalls added since Linux 5.1 are the same on all architectures
+    SYSCALLS = { "open_tree":     428,
+                 "move_mount":    429,
+                 "fsopen":        430,
+                 "fsconfig":      431,
+                 "fsmount":       432,
+                 "pidfd_open":    434,
+                 "clone3":        435,
+                 "mount_setattr": 442 }
+
+    class MountAttr(ctypes.Structure):
+        _fields_ = [("attr_set", ctypes.c_uint64),
+                    ("attr_clr", ctypes.c_uint64),
+                    ("propagation", ctypes.c_uint64),
+                    ("userns_fd", ctypes.c_uint64)]
+
+    class CloneArgs(ctypes.Structure):
+        _fields_ = [("flags", ctypes.c_uint64),
+                    ("pidfd", ctypes.c_uint64),
+                    ("child_tid", ctypes.c_uint64),
+                    ("parent_tid", ctypes.c_uint64),
+                    ("exit_signal", ctypes.c_uint64),
+                    ("stack", ctypes.c_uint64),
+                    ("stack_size", ctypes.c_uint64),
+                    ("tls", ctypes.c_uint64),
+                    ("set_tid", ctypes.c_uint64),
+                    ("set_tid_size", ctypes.c_uint64),
+                    ("cgroup", ctypes.c_uint64)]
+
+    class SockFprog(ctypes.Structure):
+        _fields_ = [("len", ctypes.c_ushort),
+                    ("filter", ctypes.c_void_p)]
+
+    class SigSet(ctypes.Structure):
+        # sigset_t of glibc, larger than the one of the kernel
+        _fields_ = [("val", ctypes.c_ulong * (1024 // (8 * ctypes.sizeof(ctypes.c_ulong))))]
+
+    # shared by all instances, the prototypes only have to be declared once
+    _shared_lib = None
+
     def __init__(self):
-        self._lib = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if Libc._shared_lib is None:
+            Libc._shared_lib = Libc._load()
+        self._lib = Libc._shared_lib
 
-    def _to_c_string(self, string):
-        if string is None:
-            return None
-        else:
-            return ctypes.create_string_buffer(string.encode(sys.getdefaultencoding()))
+    @staticmethod
+    def _load():
+        lib = load_library("libc.so.6", "c")
+
+        prototypes = { "unshare": [ctypes.c_int],
+                       "setns": [ctypes.c_int, ctypes.c_int],
+                       "mount": [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p],
+                       "umount2": [ctypes.c_char_p, ctypes.c_int],
+                       "chroot": [ctypes.c_char_p],
+                       "prctl": [ctypes.c_int, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_ulong],
+                       "signalfd": [ctypes.c_int, ctypes.c_void_p, ctypes.c_int],
+                       "socket": [ctypes.c_int, ctypes.c_int, ctypes.c_int],
+                       "ioctl": [ctypes.c_int, ctypes.c_ulong, ctypes.c_void_p] }
+        for name, argtypes in prototypes.items():
+            function = getattr(lib, name)
+            function.argtypes = argtypes
+            function.restype = ctypes.c_int
+
+        # variadic, the arguments are converted by syscall()
+        lib.syscall.restype = ctypes.c_long
+
+        return lib
+
+    @staticmethod
+    def _to_bytes(path):
+        # same as os.fsencode() but cheaper, c_char_p arguments point to the
+        # bytes object so nothing is copied
+        if path.__class__ is str:
+            return path.encode(_FS_ENCODING, _FS_ERRORS)
+        return path
 
     def _errno_exception(self):
-        return OSError(ctypes.get_errno(), errno.errorcode[ctypes.get_errno()])
+        err = ctypes.get_errno()
+        return OSError(err, os.strerror(err))
+
+    def syscall(self, name, *args):
+        """Call the raw syscall |name| (a key of SYSCALLS or a number).
+        Integers are passed as long, str and bytes as NUL-terminated strings.
+        Returns:
+            The result of the syscall.
+        """
+        number = Libc.SYSCALLS[name] if isinstance(name, str) else name
+
+        c_args = []
+        for arg in args:
+            if isinstance(arg, int):
+                # the kernel reads the full registers
+                c_args.append(ctypes.c_long(arg))
+            elif isinstance(arg, str):
+                c_args.append(arg.encode(_FS_ENCODING, _FS_ERRORS))
+            else:
+                c_args.append(arg)
+
+        result = self._lib.syscall(ctypes.c_long(number), *c_args)
+
+        if result == -1:
+            raise self._errno_exception()
+        else:
+            return result
 
     def unshare(self, flags):
         if self._lib.unshare(flags) != 0:
             raise self._errno_exception()
 
+    def setns(self, fd, nstype):
+        if self._lib.setns(fd, nstype) != 0:
+            raise self._errno_exception()
+
     def mount(self, source, target, fstype, mountflags=0, data=None):
-        result = self._lib.mount(self._to_c_string(source),
-                                 self._to_c_string(target),
-                                 self._to_c_string(fstype),
+        Trace.count("mount")
+        result = self._lib.mount(self._to_bytes(source),
+                                 self._to_bytes(target),
+                                 self._to_bytes(fstype),
                                  mountflags,
-                                 self._to_c_string(data))
+                                 self._to_bytes(data))
 
         if result != 0:
             raise self._errno_exception()
 
     def umount2(self, target, flags):
-        result = self._lib.umount2(self._to_c_string(target), flags)
+        Trace.count("umount2")
+        result = self._lib.umount2(self._to_bytes(target), flags)
 
         if result != 0:
             raise self._errno_exception()
 
     def chroot(self, path):
-        result = self._lib.chroot(self._to_c_string(path))
+        result = self._lib.chroot(self._to_bytes(path))
 
         if result != 0:
             raise self._errno_exception()
@@ -103,3 +269,100 @@ class Libc:
             raise self._errno_exception()
         else:
             return result
+
+    def socket(self, domain, type, protocol=0):
+        """Same as socket.socket().detach() without the import of the socket module.
+        Returns:
+            The fd of the new socket.
+        """
+        fd = self._lib.socket(domain, type, protocol)
+
+        if fd == -1:
+            raise self._errno_exception()
+        else:
+            return fd
+
+    def ioctl(self, fd, request, arg):
+        """Same as fcntl.ioctl() with a bytes |arg|.
+        Returns:
+            The buffer after the ioctl as bytes.
+        """
+        buf = ctypes.create_string_buffer(arg, len(arg))
+
+        if self._lib.ioctl(fd, request, buf) == -1:
+            raise self._errno_exception()
+        else:
+            return buf.raw
+
+    def set_seccomp_filter(self, program):
+        """Install the classic BPF |program| (bytes of struct sock_filter) as seccomp filter."""
+        buf = ctypes.create_string_buffer(program, len(program))
+        fprog = Libc.SockFprog(len(program) // Libc.SOCK_FILTER_SIZE, ctypes.addressof(buf))
+        self.prctl(Libc.PR_SET_SECCOMP, Libc.SECCOMP_MODE_FILTER, ctypes.addressof(fprog), 0, 0)
+
+    def signalfd(self, signals, flags=SFD_CLOEXEC):
+        """Returns:
+            A new fd to read the pending |signals| from, they have to be blocked.
+        """
+        sigset = Libc.SigSet()
+        bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+        for sig in signals:
+            sigset.val[(sig - 1) // bits] |= 1 << ((sig - 1) % bits)
+
+        fd = self._lib.signalfd(-1, ctypes.byref(sigset), flags)
+
+        if fd == -1:
+            raise self._errno_exception()
+        else:
+            return fd
+
+    def open_tree(self, dirfd, path, flags):
+        Trace.count("open_tree")
+        return self.syscall("open_tree", dirfd, path, flags)
+
+    def move_mount(self, from_dirfd, from_path, to_dirfd, to_path, flags):
+        Trace.count("move_mount")
+        self.syscall("move_mount", from_dirfd, from_path, to_dirfd, to_path, flags)
+
+    def mount_setattr(self, dirfd, path, flags, attr_set=0, attr_clr=0):
+        Trace.count("mount_setattr")
+        attr = Libc.MountAttr(attr_set=attr_set, attr_clr=attr_clr)
+        self.syscall("mount_setattr", dirfd, path, flags, ctypes.byref(attr), ctypes.sizeof(attr))
+
+    def fsopen(self, fsname, flags=FSOPEN_CLOEXEC):
+        """Returns:
+            A filesystem context fd for |fsname|.
+        """
+        return self.syscall("fsopen", fsname, flags)
+
+    def fsconfig(self, fd, cmd, key=None, value=None, aux=0):
+        self.syscall("fsconfig", fd, cmd, key, value, aux)
+
+    def fsmount(self, fd, flags=FSMOUNT_CLOEXEC, attr_flags=0):
+        """Returns:
+            A fd of the detached mount created from the filesystem context |fd|.
+        """
+        Trace.count("fsmount")
+        return self.syscall("fsmount", fd, flags, attr_flags)
+
+    def pidfd_open(self, pid, flags=0):
+        return self.syscall("pidfd_open", pid, flags)
+
+    def clone3(self, flags, exit_signal=signal.SIGCHLD, cgroup_fd=0):
+        """Create a child process like fork() but with clone3 flags.
+        The child doesn't run the os.fork() hooks of the interpreter, so it
+        should only exec or _exit.
+        Returns:
+            A tuple of the pid (0 in the child) and the pidfd if CLONE_PIDFD
+            was set (otherwise None).
+        """
+        pidfd = ctypes.c_int(-1)
+        args = Libc.CloneArgs(flags=flags, exit_signal=exit_signal, cgroup=cgroup_fd)
+        if flags & Libc.CLONE_PIDFD:
+            args.pidfd = ctypes.addressof(pidfd)
+
+        pid = self.syscall("clone3", ctypes.byref(args), ctypes.sizeof(args))
+
+        if pid == 0 or not flags & Libc.CLONE_PIDFD:
+            return pid, None
+        return pid, pidfd.value
@@ -16,8 +16,30 @@
 import argparse
 import os
 import sys
+import time
 
-from runjail.Runjail import Options, Runjail
+from runjail import Trace
+
+# everything else is imported once the arguments are parsed so --help and
+# usage errors stay fast
+
+
+class EmptyAction(argparse.Action):
+    """Appends like action="append" and remembers the mount for a following --seed."""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, getattr(namespace, self.dest) + [values])
+        namespace.last_empty = values
+
+
+class SeedAction(argparse.Action):
+    def __call__(self, parser, namespace, values, option_string=None):
+        last_empty = getattr(namespace, "last_empty", None)
+        if last_empty is None:
+            parser.error("--seed has to follow --empty or --empty-ro.")
+        if last_empty in namespace.seeds:
+            parser.error("\"{}\" already has a seed.".format(last_empty))
+        namespace.seeds[last_empty] = values
 
 
 def error(message):
@@ -25,34 +47,78 @@ def error(message):
     sys.exit(1)
 
 
-def get_defaults(runjail):
-    defaults = { "ro": [],
-                 "rw": ["/dev/null", "/dev/zero", "/dev/full", "/dev/random", "/dev/urandom", "/dev/tty", "/dev/pts", "/dev/ptmx"],
-                 "hide": [],
-                 "empty": ["/tmp", "/var/tmp", "/dev/shm", runjail.get_user_runtime_dir(), runjail.get_home_dir()],
-                 "emptyro": ["/home", "/dev", "/run"],
-                 "symlink": {} }
+def load_profile(runjail, profile, cache_dir):
+    """Combine |profile| with the host defaults.
+    Args:
+        cache_dir: Directory of the cache of resolved profiles, None disables caching.
+    Returns:
+        A dict with the validated "mounts" by category and the "symlink" dict.
+    """
+    from runjail.Runjail import Runjail
+
+    if cache_dir is not None:
+        resolved = profile.load_cached(cache_dir)
+        if resolved is not None:
+            return resolved
+
+    try:
+        data = profile.read()
+    except OSError as e:
+        error("Couldn't read the profile \"{}\": {}".format(profile.get_name(), e.strerror))
+    except ValueError as e:
+        error("Invalid profile \"{}\": {}".format(profile.get_name(), e))
+
+    defaults = runjail.get_defaults()
+    defaults["symlink"].update(data["symlink"])
+    try:
+        mounts = Runjail.resolve_mounts(defaults, data)
+    except ValueError as e:
+        error(str(e))
+    resolved = { "mounts": mounts,
+                 "symlink": defaults["symlink"] }
 
-    for name in os.listdir("/"):
-        path = "/" + name
+    if cache_dir is not None:
+        profile.store_cached(cache_dir, resolved)
 
-        # ideally we'd mount a new sysfs but the kernel only allows this if we are admin of the network namespace
+    return resolved
 
-        if name in ("bin", "boot", "etc", "sbin", "selinux", "sys", "usr", "var", "mnt") or name.startswith("lib"):
-            if os.path.islink(path):
-                defaults["symlink"][path] = os.readlink(path)
-            else:
-                defaults["ro"].append(path)
 
-    hide_if_exists = [ "/sys/fs/fuse" ]
+def run_batch(args, runjail, options, plan_cache):
+    import json
+    from runjail.Batch import Batch, read_jobs
 
-    defaults["hide"].extend([path for path in hide_if_exists if os.path.exists(path)])
+    try:
+        if args.batch == "-":
+            jobs = read_jobs(sys.stdin)
+        else:
+            with open(args.batch) as f:
+                jobs = read_jobs(f)
+        if args.batch_output:
+            os.makedirs(args.batch_output, exist_ok=True)
+    except OSError as e:
+        error("Couldn't read \"{}\": {}".format(e.filename, e.strerror))
+    except ValueError as e:
+        error(str(e))
 
-    return defaults
+    start_time = time.monotonic()
+    results = Batch(runjail, options, args.jobs, args.batch_output, plan_cache).run(jobs)
+
+    failed = len([result for result in results if result.get("exit_code") != 0])
+    summary = { "jobs": results,
+                "failed": failed,
+                "duration": time.monotonic() - start_time }
+
+    if args.batch_summary:
+        with open(args.batch_summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary), file=sys.stderr)
+
+    sys.exit(0 if failed == 0 else 1)
 
 
 def main():
-    runjail = Runjail()
+    start_time = time.monotonic()
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--ro", action="append", default=[],
@@ -61,65 +127,275 @@ def main():
                         help="Mount file/directory from parent namespace read-write.")
     parser.add_argument("--hide", action="append", default=[],
                         help="Make file/directory inaccessible.")
-    parser.add_argument("--empty", action="append", default=[],
-                        help="Mount tmpfs on the specified path.")
-    parser.add_argument("--empty-ro", action="append", default=[], dest="emptyro",
+    parser.add_argument("--hide-glob", action="append", default=[], metavar="PATTERN",
+                        help="Hide every file/directory that matches PATTERN, \"**\" matches any number of "
+                             "directories (e.g. --hide-glob='~/src/**/*.pem').")
+    parser.add_argument("--empty", action=EmptyAction, default=[], metavar="PATH[:OPTIONS]",
+                        help="Mount tmpfs on the specified path, optionally with tmpfs options "
+                             "like size=2G,nr_inodes=1M,huge=within_size.")
+    parser.add_argument("--empty-ro", action=EmptyAction, default=[], dest="emptyro", metavar="PATH[:OPTIONS]",
                         help="Mount tmpfs on the specified path.")
-    parser.add_argument("--cwd", default=os.getcwd(),
+    parser.add_argument("--seed", action=SeedAction, default={}, dest="seeds", metavar="ARCHIVE",
+                        help="Extract the tar archive (optionally compressed) into the last --empty or --empty-ro "
+                             "before it, even if other options are in between.")
+    parser.add_argument("--tmpfs-options", metavar="OPTIONS",
+                        help="Default tmpfs options of all empty mounts (size, nr_blocks, nr_inodes, huge, noswap).")
+    parser.add_argument("--overlay", action="append", default=[],
+                        help="Make a directory writable with an overlay, changes are discarded on exit.")
+    parser.add_argument("--cwd",
                         help="Set the current working directory.")
     parser.add_argument("--nonet", action="store_true",
                         help="Disable network access.")
-    parser.add_argument("command", nargs="*", default=[runjail.get_user_shell()])
+    parser.add_argument("--kill-timeout", type=float, metavar="SECONDS",
+                        help="Kill the sandbox if it's still running SECONDS after a forwarded "
+                             "SIGTERM, SIGHUP, SIGINT or SIGQUIT.")
+    parser.add_argument("--memory-max", metavar="BYTES",
+                        help="Limit the memory of the sandbox (cgroup v2 memory.max, e.g. 2G).")
+    parser.add_argument("--cpu-weight", type=int, metavar="WEIGHT",
+                        help="Relative CPU share of the sandbox, 1 to 10000 (default 100).")
+    parser.add_argument("--cpu-max", metavar="\"QUOTA PERIOD\"",
+                        help="Limit the sandbox to QUOTA microseconds of CPU time per PERIOD (cgroup v2 cpu.max).")
+    parser.add_argument("--pids-max", metavar="NUMBER",
+                        help="Limit the number of processes and threads in the sandbox.")
+    parser.add_argument("--io-weight", type=int, metavar="WEIGHT",
+                        help="Relative IO share of the sandbox, 1 to 10000 (default 100).")
+    parser.add_argument("--cgroup-root", metavar="PATH",
+                        help="Delegated cgroup v2 without processes in which a cgroup is created for the limits, "
+                             "required by them.")
+    parser.add_argument("--seccomp", metavar="PROFILE",
+                        help="Filter the syscalls of the command with $XDG_CONFIG_HOME/runjail/seccomp/PROFILE.json "
+                             "or the built-in profile \"default\".")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't cache resolved profiles, compiled mount plans and seccomp filters.")
+    parser.add_argument("--profile", metavar="NAME",
+                        help="Apply the mounts of $XDG_CONFIG_HOME/runjail/NAME.json.")
+    parser.add_argument("--server", metavar="SOCKET",
+                        help="Keep a pool of ready sandboxes and launch commands sent to SOCKET.")
+    parser.add_argument("--pool-size", type=int, default=4,
+                        help="Number of sandboxes kept ready by --server.")
+    parser.add_argument("--connect", metavar="SOCKET",
+                        help="Run the command in a sandbox of the server listening on SOCKET.")
+    parser.add_argument("--name",
+                        help="Name of the sandbox, used with --keep.")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the sandbox alive after the command exited so commands can be attached.")
+    parser.add_argument("--attach", metavar="NAME",
+                        help="Run the command in the kept sandbox NAME.")
+    parser.add_argument("--destroy", metavar="NAME",
+                        help="Kill all processes of the kept sandbox NAME and release it.")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Run the jobs in FILE (one JSON object per line, - for stdin) in parallel sandboxes.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of jobs run at the same time by --batch (default: number of CPUs).")
+    parser.add_argument("--batch-output", metavar="DIR",
+                        help="Write the output of every job to DIR/<id>.out and DIR/<id>.err "
+                             "instead of prefixing the lines with the job id.")
+    parser.add_argument("--batch-summary", metavar="FILE",
+                        help="Write the summary of the jobs to FILE instead of stderr.")
+    parser.add_argument("--stats", metavar="FILE",
+                        help="Write the wall time, setup time, CPU time, max RSS and block IO of the sandbox "
+                             "as JSON to FILE after it exited. The max RSS is at least the size of the "
+                             "runjail process that the command is forked from.")
+    parser.add_argument("--trace-timing", action="store_true",
+                        help="Write the duration of each launch phase as JSON to stderr or --trace-fd.")
+    parser.add_argument("--trace-fd", type=int, metavar="FD",
+                        help="File descriptor for --trace-timing.")
+    parser.add_argument("command", nargs="*")
     args = parser.parse_args()
 
-    defaults = get_defaults(runjail)
+    if args.trace_fd is not None and not args.trace_timing:
+        error("--trace-fd needs --trace-timing.")
+
+    if args.trace_timing:
+        trace_fd = 2 if args.trace_fd is None else args.trace_fd
+        try:
+            os.fstat(trace_fd)
+        except OSError:
+            error("--trace-fd: {} is not an open file descriptor.".format(trace_fd))
+
+        Trace.enable(trace_fd, start_time)
+        Trace.mark("parse_args")
+
+    if args.name or args.keep:
+        if not (args.name and args.keep):
+            error("--name and --keep have to be used together.")
+    if args.kill_timeout is not None and args.kill_timeout < 0:
+        error("--kill-timeout can't be negative.")
+    cgroup_limits = {}
+    for option, name in (("memory_max", "memory.max"), ("cpu_max", "cpu.max"), ("pids_max", "pids.max")):
+        if getattr(args, option) is not None:
+            cgroup_limits[name] = getattr(args, option)
+    for option, name, value in (("cpu_weight", "cpu.weight", "{}"), ("io_weight", "io.weight", "default {}")):
+        weight = getattr(args, option)
+        if weight is not None:
+            if not 1 <= weight <= 10000:
+                error("--{} must be between 1 and 10000.".format(option.replace("_", "-")))
+            cgroup_limits[name] = value.format(weight)
+    if args.stats and (args.keep or args.server or args.batch):
+        error("--stats can't be combined with --keep, --server or --batch.")
+    if cgroup_limits and args.keep:
+        error("Resource limits can't be combined with --keep.")
+    if cgroup_limits and not args.cgroup_root:
+        error("Resource limits need --cgroup-root, the cgroup of runjail itself has processes and can't enable controllers.")
+    if args.seccomp and args.keep:
+        error("--seccomp can't be combined with --keep, attached commands wouldn't be filtered.")
+    if args.pool_size < 1:
+        error("--pool-size must be at least 1.")
+    if args.batch:
+        if args.command or args.server or args.connect or args.keep or args.attach or args.destroy:
+            error("--batch can't be combined with a command, --server, --connect, --keep, --attach or --destroy.")
+        if args.jobs < 1:
+            error("--jobs must be at least 1.")
+
+    if args.cwd is None:
+        args.cwd = os.getcwd()
+
+    if args.connect:
+        if not args.command:
+            error("--connect needs a command.")
+
+        from runjail.Server import launch
+        from runjail.UserNs import UserNs
+        try:
+            # the server runs in a different directory
+            cwd = os.path.realpath(os.path.expanduser(args.cwd))
+            status = launch(args.connect, args.command, cwd, dict(os.environ))
+        except OSError as e:
+            error("Couldn't connect to \"{}\": {}".format(args.connect, e.strerror))
+        UserNs.exitAsStatus(status)
+
+    from runjail.MountPlan import MountPlanCache
+    from runjail.Profile import Profile
+    from runjail.Runjail import Options, Runjail
+    Trace.mark("imports")
+
+    # the options of a mount override the defaults
+    try:
+        default_tmpfs_options = Runjail.parse_tmpfs_options(args.tmpfs_options) if args.tmpfs_options else {}
+        mount_tmpfs_options = {}
+        seeds = {}
+        for category in ("empty", "emptyro"):
+            paths = []
+            for spec in getattr(args, category):
+                path, tmpfs_options = Runjail.split_tmpfs_spec(spec)
+                paths.append(path)
+                if tmpfs_options:
+                    mount_tmpfs_options[Runjail.preprocess_path(path)] = tmpfs_options
+                if spec in args.seeds:
+                    seeds[Runjail.preprocess_path(path)] = os.path.abspath(args.seeds[spec])
+            setattr(args, category, paths)
+    except ValueError as e:
+        error(str(e))
+
+    runjail = Runjail()
+    if not args.command:
+        args.command = [runjail.get_user_shell()]
+
+    if args.attach or args.destroy:
+        from runjail.NamedSandbox import NamedSandbox
+        try:
+            named_sandbox = NamedSandbox(args.attach or args.destroy)
+        except ValueError as e:
+            error(str(e))
+
+        if args.destroy:
+            if not named_sandbox.destroy():
+                error("The sandbox \"{}\" doesn't exist.".format(named_sandbox.get_name()))
+            sys.exit(0)
+
+        try:
+            named_sandbox.attach(args.command, Runjail.preprocess_path(args.cwd))
+        except OSError as e:
+            error("Couldn't attach to \"{}\": {}".format(named_sandbox.get_name(), e.strerror))
+
+    keep = None
+    if args.keep:
+        from runjail.NamedSandbox import NamedSandbox
+        try:
+            keep = NamedSandbox(args.name)
+        except ValueError as e:
+            error(str(e))
+        if keep.exists():
+            error("The sandbox \"{}\" already exists.".format(args.name))
+
+    try:
+        profile = Profile(args.profile)
+    except ValueError as e:
+        error(str(e))
+    resolved = load_profile(runjail, profile, None if args.no_cache else Runjail.get_cache_dir())
+
+    if args.hide_glob:
+        from runjail.HideGlob import HideGlob
+        cache_dir = None if args.no_cache else Runjail.get_cache_dir()
+        try:
+            for pattern in args.hide_glob:
+                args.hide += HideGlob(pattern, cache_dir).expand()
+        except ValueError as e:
+            error(str(e))
+        Trace.mark("hide_glob")
+
+    seccomp = None
+    if args.seccomp:
+        from runjail.Seccomp import SeccompProfile
+        try:
+            seccomp = SeccompProfile(args.seccomp).load(None if args.no_cache else Runjail.get_cache_dir())
+        except OSError as e:
+            error("Couldn't read the seccomp profile \"{}\": {}".format(args.seccomp, e.strerror))
+        except ValueError as e:
+            error("Invalid seccomp profile \"{}\": {}".format(args.seccomp, e))
+        Trace.mark("seccomp")
 
     user_mounts = { "ro": args.ro,
                     "rw": args.rw,
                     "hide": args.hide,
                     "empty": args.empty,
-                    "emptyro": args.emptyro }
-    user_mounts_all = []
-
-    for category in ("ro", "rw", "hide", "empty", "emptyro"):
-        user_mounts[category] = [Runjail.preprocess_path(mount) for mount in user_mounts[category]]
-        # remove duplicates
-        user_mounts[category] = list(set(user_mounts[category]))
-        user_mounts_all.extend(user_mounts[category])
-
-    for mount in user_mounts_all:
-        if not os.path.exists(mount):
-            error("Mountpoint \"{}\" doesn't exist.".format(mount))
-
-    user_mounts_set = set()
-    for mount in user_mounts_all:
-        if mount.startswith("/runjail"):
-            error("Mountpoint /runjail* is reserved for internal usage.")
-
-        if mount in user_mounts_set:
-            error("\"{}\" specified multiple times.".format(mount))
-        user_mounts_set.add(mount)
-
-        # user arguments override defaults
-        for category in ("ro", "rw", "hide", "empty", "emptyro"):
-            try:
-                defaults[category].remove(mount)
-            except ValueError:
-                # is not in list, ignore
-                pass
-
-    for mount in user_mounts["ro"] + user_mounts["rw"] + user_mounts["empty"] + user_mounts["emptyro"]:
-        for hide_mount in user_mounts["hide"] + defaults["hide"]:
-            if mount.startswith(hide_mount + "/"):
-                error("Can't mount \"{}\" since it's beneath hidden mountpoint \"{}\".".format(mount, hide_mount))
-
-    options = Options(ro=defaults["ro"] + user_mounts["ro"],
-                      rw=defaults["rw"] + user_mounts["rw"],
-                      hide=defaults["hide"] + user_mounts["hide"],
-                      empty=defaults["empty"] + user_mounts["empty"],
-                      emptyro=defaults["emptyro"] + user_mounts["emptyro"],
-                      symlink=defaults["symlink"],
+                    "emptyro": args.emptyro,
+                    "overlay": args.overlay }
+
+    categories = resolved["mounts"]
+    if any(user_mounts.values()):
+        try:
+            categories = Runjail.resolve_mounts(categories, user_mounts)
+        except ValueError as e:
+            error(str(e))
+
+    tmpfs_options = {}
+    for path in categories["empty"] + categories["emptyro"]:
+        path_options = dict(default_tmpfs_options)
+        path_options.update(mount_tmpfs_options.get(path, {}))
+        if path_options:
+            tmpfs_options[path] = Runjail.format_tmpfs_options(path_options)
+
+    options = Options(ro=categories["ro"],
+                      rw=categories["rw"],
+                      hide=categories["hide"],
+                      empty=categories["empty"],
+                      emptyro=categories["emptyro"],
+                      overlay=categories["overlay"],
+                      symlink=resolved["symlink"],
                       cwd=args.cwd,
-                      nonet=args.nonet)
+                      nonet=args.nonet,
+                      kill_timeout=args.kill_timeout,
+                      cgroup_root=args.cgroup_root,
+                      cgroup_limits=cgroup_limits,
+                      tmpfs_options=tmpfs_options,
+                      seeds=seeds,
+                      seccomp=seccomp)
+    Trace.mark("options")
+
+    if args.no_cache:
+        plan_cache = None
+    else:
+        plan_cache = MountPlanCache(Runjail.get_cache_dir())
 
-    runjail.run(options, args.command)
+    if args.batch:
+        run_batch(args, runjail, options, plan_cache)
+    elif args.server:
+        from runjail.Server import Server
+        Server(args.server, args.pool_size, options, plan_cache).serve_forever()
+    else:
+        stats = None
+        if args.stats:
+            from runjail.Stats import Stats
+            stats = Stats(args.stats, start_time)
+        runjail.run(options, args.command, plan_cache, keep=keep, stats=stats)
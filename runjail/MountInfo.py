@@ -13,18 +13,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import collections
 import re
 
+from runjail import Trace
 from runjail.Libc import Libc
 
-_MountInfoEntry = collections.namedtuple("MountInfoEntry",
-                                         ["mount_id", "parent_id", "major_minor", "root",
-                                          "mount_point", "mount_options", "optional_fields",
-                                          "fs_type", "mount_source", "super_options"])
 
+class MountInfoEntry:
+    """A line of /proc/self/mountinfo.
+
+    The optional fields and super options are rarely needed so they are only
+    unescaped when accessed.
+    """
 
-class MountInfoEntry(_MountInfoEntry):
     OPTION_FLAG_MAP = { "ro":          Libc.MS_RDONLY,
                         "noexec":      Libc.MS_NOEXEC,
                         "nosuid":      Libc.MS_NOSUID,
@@ -40,13 +43,44 @@ class MountInfoEntry(_MountInfoEntry):
                         "strictatime": Libc.MS_STRICTATIME,
                         "lazytime":    Libc.MS_LAZYTIME }
 
-    def __init__(self, *args):
-        _MountInfoEntry.__init__(self, args)
+    # most mounts share a handful of option strings
+    _flags_cache = {}
+
+    __slots__ = ("mount_id", "parent_id", "major_minor", "root", "mount_point", "mount_options",
+                 "fs_type", "mount_source", "_optional_fields", "_super_options", "_flags")
+
+    def __init__(self, mount_id, parent_id, major_minor, root, mount_point, mount_options,
+                 optional_fields, fs_type, mount_source, super_options):
+        self.mount_id = mount_id
+        self.parent_id = parent_id
+        self.major_minor = major_minor
+        self.root = root
+        self.mount_point = mount_point
+        self.mount_options = mount_options
+        self.fs_type = fs_type
+        self.mount_source = mount_source
+        self._optional_fields = optional_fields
+        self._super_options = super_options
+
+        try:
+            self._flags = MountInfoEntry._flags_cache[mount_options]
+        except KeyError:
+            self._flags = MountInfoEntry._parse_mount_flags(mount_options)
+            MountInfoEntry._flags_cache[mount_options] = self._flags
+
+    @property
+    def optional_fields(self):
+        return [MountInfo._unescape_field(field) for field in self._optional_fields]
+
+    @property
+    def super_options(self):
+        return MountInfo._unescape_field(self._super_options)
 
-    def get_mount_flags(self):
+    @staticmethod
+    def _parse_mount_flags(mount_options):
         flags = 0
 
-        for option in self.mount_options.split(","):
+        for option in mount_options.split(","):
             try:
                 flags |= MountInfoEntry.OPTION_FLAG_MAP[option]
             except KeyError:
@@ -55,27 +89,63 @@ class MountInfoEntry(_MountInfoEntry):
 
         return flags
 
+    def get_mount_flags(self):
+        return self._flags
+
 
 class MountInfo:
-    def __init__(self):
+    _ESCAPE_RE = re.compile(r"\\(\d{1,3})")
+
+    def __init__(self, path_prefix=None, filename="/proc/self/mountinfo"):
+        """Parse the mount table of the current process.
+        Args:
+            path_prefix: Only include mounts at or beneath this path.
+            filename: Read the mount table from this file instead.
+        """
+        Trace.count("mountinfo_parse")
+
         self._mounts = []
         self._mountpoints = {}
+        self._children = None
+        self._sorted_mountpoints = None
+
+        if path_prefix is not None:
+            # compare the still escaped mount point so we can skip lines without parsing them
+            escaped_prefix = MountInfo._escape_field(path_prefix.rstrip("/"))
+            escaped_prefix_dir = escaped_prefix + "/"
 
-        with open("/proc/self/mountinfo") as f:
+        unescape = MountInfo._unescape_field
+
+        with open(filename) as f:
             for line in f:
                 fields = line.rstrip("\n").split(" ")
-                # the kernel escapes some chars like " "
-                fields = [MountInfo._unescape_field(field) for field in fields]
-                index_dash = -1
+
+                mount_point = fields[4]
+                if path_prefix is not None:
+                    if mount_point != escaped_prefix and not mount_point.startswith(escaped_prefix_dir):
+                        continue
+
                 # field 6 until separator field ("-") are optional fields
-                for i in range(6, len(fields)):
-                    if fields[i] == "-":
-                        index_dash = i
-                if index_dash == -1:
+                try:
+                    index_dash = fields.index("-", 6)
+                except ValueError:
                     raise RuntimeError("Missing optional fields separator.")
-                entry = MountInfoEntry._make(fields[:6] + [fields[6:index_dash]] + fields[index_dash + 1:])
+
+                root = fields[3]
+                mount_source = fields[index_dash + 2]
+                # the kernel escapes some chars like " "
+                if "\\" in root:
+                    root = unescape(root)
+                if "\\" in mount_point:
+                    mount_point = unescape(mount_point)
+                if "\\" in mount_source:
+                    mount_source = unescape(mount_source)
+
+                entry = MountInfoEntry(int(fields[0]), int(fields[1]), fields[2], root, mount_point, fields[5],
+                                       fields[6:index_dash], fields[index_dash + 1], mount_source,
+                                       fields[index_dash + 3])
                 self._mounts.append(entry)
-                self._mountpoints[entry.mount_point] = entry
+                self._mountpoints[mount_point] = entry
 
     def get_list(self):
         return self._mounts
@@ -86,10 +156,94 @@ class MountInfo:
     def has_mountpoint(self, path):
         return path in self._mountpoints
 
+    def get_children(self, mount_id):
+        """Return the mounts whose parent is the mount |mount_id|."""
+        if self._children is None:
+            self._children = collections.defaultdict(list)
+            for entry in self._mounts:
+                self._children[entry.parent_id].append(entry)
+
+        return self._children.get(mount_id, [])
+
+    def get_subtree(self, mount_id):
+        """Return the mount |mount_id| and all mounts beneath it, parents before children."""
+        subtree = [entry for entry in self._mounts if entry.mount_id == mount_id]
+        for entry in subtree:
+            subtree.extend(self.get_children(entry.mount_id))
+        return subtree
+
+    def get_mounts_under(self, path):
+        """Return the mounts at or beneath |path|, sorted by mount point."""
+        if self._sorted_mountpoints is None:
+            self._sorted_mountpoints = sorted(self._mountpoints)
+
+        path = path.rstrip("/")
+        mountpoints = self._sorted_mountpoints
+        result = []
+
+        if path in self._mountpoints:
+            result.append(self._mountpoints[path])
+
+        # all paths starting with "<path>/" are sorted between "<path>/" and "<path>0"
+        start = bisect.bisect_left(mountpoints, path + "/")
+        end = bisect.bisect_left(mountpoints, path + "0", start)
+        result.extend(self._mountpoints[mountpoint] for mountpoint in mountpoints[start:end])
+
+        return result
+
+    @staticmethod
+    def _escape_field(field):
+        for char in ("\\", " ", "\t", "\n"):
+            field = field.replace(char, "\\{:03o}".format(ord(char)))
+        return field
+
     @staticmethod
     def _octal_to_char(match):
         return chr(int(match.group(1), 8))
 
     @staticmethod
     def _unescape_field(field):
-        return re.sub(r"\\(\d{1,3})", MountInfo._octal_to_char, field)
+        return MountInfo._ESCAPE_RE.sub(MountInfo._octal_to_char, field)
+
+
+class MountTracker:
+    """Keeps track of the mounts beneath a directory.
+
+    After a mount only the mount tree that was added is read from the kernel,
+    the full table beneath the directory is only re-read on refresh().
+    """
+
+    def __init__(self, base):
+        self._base = base
+        self._mountpoints = {}
+
+    def refresh(self):
+        self._mountpoints = {}
+        for entry in MountInfo(self._base).get_list():
+            self._mountpoints[entry.mount_point] = entry
+
+    def learn(self, path):
+        """Look up the mount at |path| and its submounts.
+        Args:
+            path: Mount point of a mount that was just created.
+        Returns:
+            The entries of the mount tree at |path|, parents before children.
+        """
+        mount_info = MountInfo(path)
+
+        # mounts that were already stacked at |path| are parents of the new one
+        at_path = [entry for entry in mount_info.get_list() if entry.mount_point == path]
+        parent_ids = set(entry.parent_id for entry in at_path)
+        tops = [entry for entry in at_path if entry.mount_id not in parent_ids]
+        if not tops:
+            raise RuntimeError("\"{}\" is not a mount point.".format(path))
+
+        subtree = mount_info.get_subtree(tops[-1].mount_id)
+
+        for entry in subtree:
+            self._mountpoints[entry.mount_point] = entry
+
+        return subtree
+
+    def get_mountpoint(self, path):
+        return self._mountpoints[path]
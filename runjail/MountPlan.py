@@ -0,0 +1,139 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+
+
+class MountPlan:
+    """Ordered list of the steps that build the root of the sandbox.
+
+    Each step is a tuple of the operation name followed by its arguments.
+    Paths are relative to the staging directory ("/" is the staging
+    directory itself) so a plan can be reused for every launch.
+    """
+
+    VERSION = 3
+
+    def __init__(self, steps=None, saved_syscalls=0):
+        self.steps = [] if steps is None else steps
+        # estimate of the syscalls that the minimizer removed from the plan
+        self.saved_syscalls = saved_syscalls
+
+    def add(self, op, *args):
+        self.steps.append((op,) + args)
+
+    def dumps(self):
+        return json.dumps({"version": MountPlan.VERSION,
+                           "steps": self.steps,
+                           "saved_syscalls": self.saved_syscalls})
+
+    @staticmethod
+    def loads(data):
+        obj = json.loads(data)
+        if obj.get("version") != MountPlan.VERSION:
+            raise ValueError("Unsupported mount plan version.")
+        return MountPlan([tuple(step) for step in obj["steps"]], obj["saved_syscalls"])
+
+
+class MountPlanCache:
+    """On-disk cache of compiled mount plans.
+
+    Plans are keyed by the mount options, the host paths they resolve to and
+    a fingerprint of the host mount table, so any change on the host results
+    in a new plan. Only the most recently stored plans are kept.
+    """
+
+    MAX_PLANS = 64
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    @staticmethod
+    def get_key(options):
+        key = hashlib.sha256()
+        # the plan doesn't depend on the order of the paths
+        key.update(json.dumps({"version": MountPlan.VERSION,
+                               "ro": sorted(options.ro),
+                               "rw": sorted(options.rw),
+                               "hide": sorted(options.hide),
+                               "empty": sorted(options.empty),
+                               "emptyro": sorted(options.emptyro),
+                               "overlay": sorted(options.overlay),
+                               "tmpfs_options": options.tmpfs_options,
+                               "seeds": sorted(options.seeds or ()),
+                               "symlink": options.symlink},
+                              sort_keys=True).encode())
+
+        # compile_plan() resolves symlinks and picks a directory or a file as bind target
+        resolved = []
+        for category in ("ro", "rw", "hide", "empty", "emptyro", "overlay"):
+            for path in getattr(options, category):
+                path = os.path.expanduser(path)
+                resolved.append([path, os.path.realpath(path), os.path.isdir(path)])
+        key.update(json.dumps(sorted(resolved)).encode())
+
+        with open("/proc/self/mountinfo", "rb") as f:
+            key.update(f.read())
+
+        return key.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, key + ".json")
+
+    def load(self, key):
+        try:
+            with open(self._get_path(key)) as f:
+                return MountPlan.loads(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def store(self, key, plan):
+        path = self._get_path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+
+        try:
+            os.makedirs(self._directory, 0o700, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                f.write(plan.dumps())
+            # atomically replace so concurrent launches never see a partial plan
+            os.replace(tmp_path, path)
+            self._prune()
+        except OSError:
+            # the cache is only an optimization
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _prune(self):
+        """Remove the oldest plans beyond MAX_PLANS, every mount table leaves a new plan."""
+        plans = []
+        with os.scandir(self._directory) as it:
+            for entry in it:
+                if entry.name.endswith(".json"):
+                    try:
+                        plans.append((entry.stat().st_mtime_ns, entry.path))
+                    except FileNotFoundError:
+                        pass
+
+        plans.sort()
+        for mtime, path in plans[:-MountPlanCache.MAX_PLANS]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # removed by a concurrent launch
+                pass
@@ -0,0 +1,144 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import json
+import os
+import signal
+import stat
+import time
+
+from runjail.UserNs import UserNs
+
+
+class NamedSandbox:
+    """State of a sandbox that is kept alive after its command exited.
+
+    The init process of the pid namespace keeps running and pins the
+    namespaces, its pid and the inodes of its namespaces are stored in a
+    state file so later commands can be attached.
+    """
+
+    NAMESPACES = ("user", "mnt", "ipc", "net", "pid")
+    # used without XDG_RUNTIME_DIR, other users can create it first
+    FALLBACK_STATE_DIR = "/tmp/runjail-{uid}"
+
+    def __init__(self, name):
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError("Invalid sandbox name \"{}\".".format(name))
+        self._name = name
+        self._state_path = os.path.join(NamedSandbox.get_state_dir(), name + ".json")
+
+    @staticmethod
+    def get_state_dir():
+        """Raises:
+            ValueError if the fallback directory isn't private to the current user.
+        """
+        try:
+            return os.path.join(os.environ["XDG_RUNTIME_DIR"], "runjail")
+        except KeyError:
+            pass
+
+        uid = os.getuid()
+        path = NamedSandbox.FALLBACK_STATE_DIR.format(uid=uid)
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid or stat.S_IMODE(st.st_mode) != 0o700:
+            raise ValueError("\"{}\" has to be a directory with mode 0700 owned by the current user.".format(path))
+        return path
+
+    def get_name(self):
+        return self._name
+
+    def save(self, pid, mount_base):
+        """Args:
+            mount_base: The staging directory to remove, None if the staging root has none.
+        """
+        state = { "pid": pid,
+                  "mount_base": mount_base,
+                  "ns": {} }
+        for name in NamedSandbox.NAMESPACES:
+            state["ns"][name] = os.stat("/proc/{}/ns/{}".format(pid, name)).st_ino
+
+        os.makedirs(os.path.dirname(self._state_path), 0o700, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self._state_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self._state_path)
+
+    def _read_state(self):
+        try:
+            with open(self._state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """Returns:
+            The state or None if the sandbox doesn't exist (anymore).
+        """
+        state = self._read_state()
+        if state is None:
+            return None
+
+        try:
+            if os.stat("/proc/{}/ns/user".format(state["pid"])).st_ino != state["ns"]["user"]:
+                return None
+        except FileNotFoundError:
+            return None
+
+        return state
+
+    def exists(self):
+        return self.load() is not None
+
+    def attach(self, command, cwd):
+        state = self.load()
+        if state is None:
+            raise ProcessLookupError(errno.ESRCH, "The sandbox \"{}\" doesn't exist.".format(self._name))
+
+        UserNs(None).attach(state["pid"], state["ns"], command, cwd)
+
+    def destroy(self):
+        """Kill all processes of the sandbox and remove its state.
+        Returns:
+            False if the sandbox didn't exist (anymore).
+        """
+        state = self._read_state()
+        if state is None:
+            return False
+
+        alive = self.load() is not None
+        if alive:
+            # killing the init process of a pid namespace kills all processes in it
+            os.kill(state["pid"], signal.SIGKILL)
+            for i in range(100):
+                if not os.path.exists("/proc/{}".format(state["pid"])):
+                    break
+                time.sleep(0.01)
+
+        # the mounts only exist in the namespace of the sandbox
+        if state["mount_base"] is not None:
+            try:
+                os.rmdir(state["mount_base"])
+            except FileNotFoundError:
+                pass
+        os.remove(self._state_path)
+
+        return alive
@@ -0,0 +1,124 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+_NO_VALUE = object()
+
+
+class _Node:
+    __slots__ = ("children", "value")
+
+    def __init__(self):
+        self.children = {}
+        self.value = _NO_VALUE
+
+
+class PathTrie:
+    """Maps normalized absolute paths to values, stored by path component.
+
+    Lookups take time proportional to the depth of the path instead of the
+    number of stored paths and iteration yields parents before their children.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._len = 0
+
+    @staticmethod
+    def _split(path):
+        return [component for component in path.split("/") if component]
+
+    def _find(self, path):
+        node = self._root
+        for component in self._split(path):
+            node = node.children.get(component)
+            if node is None:
+                return None
+        return node
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, path):
+        node = self._find(path)
+        return node is not None and node.value is not _NO_VALUE
+
+    def __getitem__(self, path):
+        node = self._find(path)
+        if node is None or node.value is _NO_VALUE:
+            raise KeyError(path)
+        return node.value
+
+    def __setitem__(self, path, value):
+        node = self._root
+        for component in self._split(path):
+            child = node.children.get(component)
+            if child is None:
+                child = node.children[component] = _Node()
+            node = child
+
+        if node.value is _NO_VALUE:
+            self._len += 1
+        node.value = value
+
+    def get(self, path, default=None):
+        node = self._find(path)
+        if node is None or node.value is _NO_VALUE:
+            return default
+        return node.value
+
+    def pop(self, path, default=None):
+        node = self._find(path)
+        if node is None or node.value is _NO_VALUE:
+            return default
+
+        value = node.value
+        node.value = _NO_VALUE
+        self._len -= 1
+        return value
+
+    def find_ancestor(self, path, predicate=None):
+        """Find the nearest proper ancestor of |path| that has a value.
+        Args:
+            predicate: Only consider values for which it returns True.
+        Returns:
+            A tuple of the path and value of the ancestor or None.
+        """
+        result = None
+        node = self._root
+        components = self._split(path)
+
+        for i in range(len(components)):
+            if node.value is not _NO_VALUE and (predicate is None or predicate(node.value)):
+                result = ("/" + "/".join(components[:i]), node.value)
+            node = node.children.get(components[i])
+            if node is None:
+                break
+
+        return result
+
+    def items(self):
+        """Iterate over all paths and their values, parents before children
+        and siblings in sorted order.
+        """
+        stack = [("/", self._root)]
+        while stack:
+            path, node = stack.pop()
+            if node.value is not _NO_VALUE:
+                yield path, node.value
+
+            prefix = path if path == "/" else path + "/"
+            # reversed so the smallest sibling is popped first
+            for component in sorted(node.children, reverse=True):
+                stack.append((prefix + component, node.children[component]))
@@ -0,0 +1,144 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import marshal
+import os
+
+
+class Profile:
+    """Set of mounts stored in $XDG_CONFIG_HOME/runjail/<name>.json.
+
+    The file contains a JSON object with lists of absolute paths for "ro",
+    "rw", "hide", "empty", "emptyro" and "overlay" and a "symlink" object that maps
+    paths to their target. The profile combined with the host defaults is
+    cached until the profile or the root directory of the host changes.
+    Profile(None) only stands for the host defaults.
+    """
+
+    VERSION = 2
+    CATEGORIES = ("ro", "rw", "hide", "empty", "emptyro", "overlay")
+    # changes of these directories may change the host defaults
+    HOST_PATHS = ("/", "/sys/fs")
+
+    def __init__(self, name):
+        if name is not None and (not name or "/" in name or name.startswith(".")):
+            raise ValueError("Invalid profile name \"{}\".".format(name))
+        self._name = name
+        self._fingerprint = None
+
+    @staticmethod
+    def get_config_dir():
+        try:
+            config_home = os.environ["XDG_CONFIG_HOME"]
+        except KeyError:
+            config_home = os.path.expanduser("~/.config")
+        return os.path.join(config_home, "runjail")
+
+    def get_name(self):
+        return self._name
+
+    def get_path(self):
+        if self._name is None:
+            return None
+        return os.path.join(Profile.get_config_dir(), self._name + ".json")
+
+    def read(self):
+        """Returns:
+            A dict with the lists of paths of every category and the symlinks.
+        Raises:
+            OSError if the profile can't be read, ValueError if it's invalid.
+        """
+        profile = { category: [] for category in Profile.CATEGORIES }
+        profile["symlink"] = {}
+        if self._name is None:
+            return profile
+
+        with open(self.get_path()) as f:
+            data = json.load(f)
+
+        if not isinstance(data, dict):
+            raise ValueError("The profile has to be a JSON object.")
+
+        for key, value in data.items():
+            if key in Profile.CATEGORIES:
+                if not isinstance(value, list) or not all(isinstance(path, str) for path in value):
+                    raise ValueError("\"{}\" has to be a list of paths.".format(key))
+                paths = value
+            elif key == "symlink":
+                if not isinstance(value, dict) or not all(isinstance(target, str) for target in value.values()):
+                    raise ValueError("\"symlink\" has to map paths to their target.")
+                paths = list(value)
+            else:
+                raise ValueError("Unknown key \"{}\".".format(key))
+
+            for path in paths:
+                if not os.path.isabs(os.path.expanduser(path)):
+                    raise ValueError("\"{}\" is not an absolute path.".format(path))
+
+            profile[key] = value
+
+        return profile
+
+    def _get_fingerprint(self):
+        # taken once before the profile is resolved, so changes during the resolution invalidate the cache
+        if self._fingerprint is None:
+            self._fingerprint = self._compute_fingerprint()
+        return self._fingerprint
+
+    def _compute_fingerprint(self):
+        mtimes = []
+        for path in (self.get_path(),) + Profile.HOST_PATHS:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except (OSError, TypeError):
+                mtimes.append(None)
+
+        # the defaults include the home and runtime directory of the user
+        return (Profile.VERSION, os.getuid(), os.environ.get("HOME"), tuple(mtimes))
+
+    def _get_cache_path(self, cache_dir):
+        return os.path.join(cache_dir, "profiles", (self._name or ".defaults") + ".marshal")
+
+    def load_cached(self, cache_dir):
+        """Returns:
+            The resolved profile stored by store_cached() or None if it's missing or outdated.
+        """
+        try:
+            with open(self._get_cache_path(cache_dir), "rb") as f:
+                fingerprint, resolved = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if fingerprint != self._get_fingerprint():
+            return None
+
+        return resolved
+
+    def store_cached(self, cache_dir, resolved):
+        path = self._get_cache_path(cache_dir)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+
+        try:
+            os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                marshal.dump((self._get_fingerprint(), resolved), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is only an optimization
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
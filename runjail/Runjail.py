@@ -18,13 +18,27 @@ import enum
 import os
 import pwd
 import re
-import tempfile
+import sys
 
+from runjail import Trace
 from runjail.Libc import Libc
-from runjail.MountInfo import MountInfo
+from runjail.MountInfo import MountTracker
+from runjail.MountPlan import MountPlan, MountPlanCache
+from runjail.PathTrie import PathTrie
 from runjail.UserNs import UserNs
 
-Options = collections.namedtuple("Options", ["ro", "rw", "hide", "empty", "emptyro", "symlink", "cwd", "nonet"])
+Options = collections.namedtuple("Options", ["ro", "rw", "hide", "empty", "emptyro", "symlink", "cwd", "nonet", "env",
+                                             "kill_timeout", "cgroup_root", "cgroup_limits", "overlay", "tmpfs_options",
+                                             "seeds", "seccomp"])
+# env: environment of the command, None keeps the current one
+# kill_timeout: seconds until SIGKILL follows a forwarded termination signal, None waits forever
+# cgroup_limits: maps cgroup v2 interface files to values, applied to a new child of
+#                cgroup_root (a delegated cgroup without processes)
+# overlay: directories that are writable through an overlayfs, the writes end up in a tmpfs
+# tmpfs_options: maps empty and emptyro paths to additional tmpfs options (see Runjail.parse_tmpfs_options)
+# seeds: maps empty and emptyro paths to tar archives that are extracted into them
+# seccomp: compiled seccomp filter of the command (see Seccomp.SeccompProfile.load)
+Options.__new__.__defaults__ = (None, None, None, None, (), None, None, None)
 
 
 class MountType(enum.Enum):
@@ -33,66 +47,192 @@ class MountType(enum.Enum):
     HIDE = 3
     EMPTY = 4
     EMPTYRO = 5
+    OVERLAY = 6
 
 
 Mount = collections.namedtuple("Mount", ["path", "type"])
 
 
 class Runjail:
+    # mode of the tmpfs at the root of the sandbox
+    ROOT_MODE = "550"
+    HIDE_BASE = "/runjail-hide"
+    HIDE_DIR = HIDE_BASE + "/dir"
+    HIDE_FILE = HIDE_BASE + "/file"
+    # tmpfs with the upper and work directories of the overlays
+    OVERLAY_BASE = "/runjail-overlay"
+
+    MOUNT_CATEGORIES = ("ro", "rw", "hide", "empty", "emptyro", "overlay")
+
+    # estimated syscalls per mount, a read-only bind needs open_tree, mount_setattr and move_mount
+    MOUNT_COST = { MountType.RO: 3,
+                   MountType.RW: 1,
+                   MountType.HIDE: 2 }
+
+    # tmpfs options that can be set for empty mounts and the pattern of their value, None for flags
+    TMPFS_OPTIONS = { "size": r"[0-9]+[kKmMgGtTpPeE%]?",
+                      "nr_blocks": r"[0-9]+[kKmMgGtTpPeE]?",
+                      "nr_inodes": r"[0-9]+[kKmMgGtTpPeE]?",
+                      "huge": r"never|always|within_size|advise",
+                      "noswap": None }
+
     def __init__(self):
         self._uid = os.getuid()
-        self._pwd = pwd.getpwuid(self._uid)
-        self._bind_mapping = {}
-        self._bind_mapping_counter = 0
-        self._mount_base = tempfile.mkdtemp(prefix="runjail")
-        self._mount_hide_base = self._mount_base + "/runjail-hide"
-        self._mount_hide_dir = self._mount_hide_base + "/dir"
-        self._mount_hide_file = self._mount_hide_base + "/file"
-        self._userns = UserNs(self._mount_base)
+        # looked up on demand
+        self._pwd = None
+        # created by run() so only launches create a staging root
+        self._mount_base = None
+        # only used for a staging directory, a staging root without one isn't in the mount table by its path
+        self._mount_tracker = None
+        self._mount_tracker_stale = True
+        self._userns = None
+        # fds and paths of the seed archives by mount path, opened by run()
+        self._seeds = {}
 
     def create_file(self, path, mode):
         os.close(os.open(path, os.O_WRONLY | os.O_CREAT, mode))
 
-    def init_hide_mounts(self):
-        os.mkdir(self._mount_hide_base, 0o500)
-        os.mkdir(self._mount_hide_dir, 0o000)
-        self.create_file(self._mount_hide_file, 0o000)
+    def get_staging_path(self, path):
+        if path == "/":
+            return self._mount_base
+        return self._mount_base + path
 
     def bind_mount(self, path, read_only):
-        abs_target_path = self._mount_base + path
-
-        if os.path.isdir(path):
-            os.makedirs(abs_target_path, 0o700, exist_ok=True)
-        else:
-            os.makedirs(self._mount_base + os.path.dirname(path), 0o700, exist_ok=True)
-            if not os.path.exists(abs_target_path):
-                self.create_file(abs_target_path, 0o600)
+        abs_target_path = self.get_staging_path(path)
 
         if not read_only:
             self._userns.mount_bind(path, abs_target_path)
-        else:
-            mount_info_before = MountInfo()
+        elif not self._userns.mount_bind_ro(path, abs_target_path):
             self._userns.mount_bind(path, abs_target_path)
-            mount_info_after = MountInfo()
 
-            # remount submounts read-only
-            for mount in mount_info_after.get_list():
-                if not mount_info_before.has_mountpoint(mount.mount_point):
-                    self._userns.remount_ro(mount.mount_point,
-                                            mount_info_after.get_mountpoint(mount.mount_point).get_mount_flags())
+            # remount the new mount and its submounts read-only
+            for mount in self._mount_tracker.learn(abs_target_path):
+                self._userns.remount_ro(mount.mount_point, mount.get_mount_flags())
+
+        self._mount_tracker_stale = True
 
     @staticmethod
     def preprocess_path(path):
         return os.path.realpath(os.path.expanduser(path))
 
+    @staticmethod
+    def resolve_mounts(base_mounts, user_mounts):
+        """Combine validated mounts with the mounts specified by the user.
+        Args:
+            base_mounts: Maps the mount categories to lists of paths, they are
+                overridden by the user mounts.
+            user_mounts: Maps the mount categories to lists of paths that haven't
+                been normalized yet, missing categories are empty.
+        Returns:
+            A dict that maps the mount categories to lists of paths, parents before children.
+        Raises:
+            ValueError if the user mounts are invalid.
+        """
+        # maps paths to a tuple of the category and whether the user specified it
+        mounts = PathTrie()
+        for category in Runjail.MOUNT_CATEGORIES:
+            for mount in base_mounts[category]:
+                mounts[mount] = (category, False)
+
+        for category in Runjail.MOUNT_CATEGORIES:
+            # remove duplicates, keep the order for stable error messages
+            for mount in dict.fromkeys(Runjail.preprocess_path(mount) for mount in user_mounts.get(category, [])):
+                if not os.path.exists(mount):
+                    raise ValueError("Mountpoint \"{}\" doesn't exist.".format(mount))
+
+                if mount.startswith("/runjail"):
+                    raise ValueError("Mountpoint /runjail* is reserved for internal usage.")
+
+                if category == "overlay" and not os.path.isdir(mount):
+                    raise ValueError("Overlay \"{}\" isn't a directory.".format(mount))
+
+                existing = mounts.get(mount)
+                if existing is not None and existing[1]:
+                    raise ValueError("\"{}\" specified multiple times.".format(mount))
+
+                # user arguments override defaults
+                mounts[mount] = (category, True)
+
+        is_hide = lambda value: value[0] == "hide"
+        categories = { category: [] for category in Runjail.MOUNT_CATEGORIES }
+
+        for mount, (category, is_user) in mounts.items():
+            if is_user and category != "hide":
+                hidden = mounts.find_ancestor(mount, is_hide)
+                if hidden is not None:
+                    raise ValueError("Can't mount \"{}\" since it's beneath hidden mountpoint \"{}\".".format(
+                        mount, hidden[0]))
+
+            categories[category].append(mount)
+
+        return categories
+
+    @staticmethod
+    def parse_tmpfs_options(options):
+        """Validate comma separated tmpfs options like "size=2G,huge=within_size".
+        Returns:
+            A dict that maps the option names to their value (None for flags).
+        Raises:
+            ValueError if an option is unknown or has an invalid value.
+        """
+        parsed = {}
+        for option in options.split(","):
+            name, has_value, value = option.partition("=")
+            if name not in Runjail.TMPFS_OPTIONS:
+                raise ValueError("Unsupported tmpfs option \"{}\".".format(name))
+
+            pattern = Runjail.TMPFS_OPTIONS[name]
+            if pattern is None:
+                if has_value:
+                    raise ValueError("The tmpfs option \"{}\" doesn't take a value.".format(name))
+                parsed[name] = None
+            else:
+                if not re.fullmatch(pattern, value):
+                    raise ValueError("Invalid value \"{}\" of the tmpfs option \"{}\".".format(value, name))
+                parsed[name] = value
+
+        return parsed
+
+    @staticmethod
+    def format_tmpfs_options(options):
+        # sorted so equal options give the same plan cache key
+        return ",".join(name if value is None else name + "=" + value for name, value in sorted(options.items()))
+
+    @staticmethod
+    def split_tmpfs_spec(spec):
+        """Split "PATH[:OPTIONS]" of an empty mount.
+        The part after the last colon only counts as options if it starts with an option name.
+        Returns:
+            A tuple of the path and the dict of the parsed options.
+        Raises:
+            ValueError if the options are invalid.
+        """
+        path, colon, options = spec.rpartition(":")
+        if not colon or options.partition(",")[0].partition("=")[0] not in Runjail.TMPFS_OPTIONS:
+            return spec, {}
+        return path, Runjail.parse_tmpfs_options(options)
+
+    @staticmethod
+    def get_cache_dir():
+        try:
+            cache_home = os.environ["XDG_CACHE_HOME"]
+        except KeyError:
+            cache_home = os.path.expanduser("~/.cache")
+        return os.path.join(cache_home, "runjail")
+
+    def get_passwd_entry(self):
+        if self._pwd is None:
+            self._pwd = pwd.getpwuid(self._uid)
+        return self._pwd
+
     def get_home_dir(self):
         try:
             return os.environ["HOME"]
         except KeyError:
-            return self._pwd.pw_dir
+            return self.get_passwd_entry().pw_dir
 
     def get_user_shell(self):
-        return self._pwd.pw_shell
+        return self.get_passwd_entry().pw_shell
 
     def get_user_id(self):
         return self._uid
@@ -100,75 +240,329 @@ class Runjail:
     def get_user_runtime_dir(self):
         return "/run/" + str(self.get_user_id())
 
-    def run(self, options, command):
-        mounts = []
+    def get_defaults(self):
+        """Returns:
+            The mounts and symlinks of the host that every sandbox starts with.
+        """
+        defaults = { "ro": [],
+                     "rw": ["/dev/null", "/dev/zero", "/dev/full", "/dev/random", "/dev/urandom", "/dev/tty", "/dev/pts", "/dev/ptmx"],
+                     "hide": [],
+                     "empty": ["/tmp", "/var/tmp", "/dev/shm", self.get_user_runtime_dir(), self.get_home_dir()],
+                     "emptyro": ["/home", "/dev", "/run"],
+                     "overlay": [],
+                     "symlink": {} }
+
+        for name in os.listdir("/"):
+            path = "/" + name
+
+            # ideally we'd mount a new sysfs but the kernel only allows this if we are admin of the network namespace
+
+            if name in ("bin", "boot", "etc", "sbin", "selinux", "sys", "usr", "var", "mnt") or name.startswith("lib"):
+                if os.path.islink(path):
+                    defaults["symlink"][path] = os.readlink(path)
+                else:
+                    defaults["ro"].append(path)
+
+        hide_if_exists = [ "/sys/fs/fuse" ]
+
+        defaults["hide"].extend([path for path in hide_if_exists if os.path.exists(path)])
+
+        return defaults
+
+    def compile_plan(self, options):
+        mounts = PathTrie()
 
         for path in options.ro:
-            mounts.append(Mount(self.preprocess_path(path), MountType.RO))
+            mounts[self.preprocess_path(path)] = MountType.RO
 
         for path in options.rw:
-            mounts.append(Mount(self.preprocess_path(path), MountType.RW))
+            mounts[self.preprocess_path(path)] = MountType.RW
 
         for path in options.hide:
-            mounts.append(Mount(self.preprocess_path(path), MountType.HIDE))
+            mounts[self.preprocess_path(path)] = MountType.HIDE
 
         for path in options.empty:
-            mounts.append(Mount(self.preprocess_path(path), MountType.EMPTY))
+            mounts[self.preprocess_path(path)] = MountType.EMPTY
 
         for path in options.emptyro:
-            mounts.append(Mount(self.preprocess_path(path), MountType.EMPTYRO))
+            mounts[self.preprocess_path(path)] = MountType.EMPTYRO
 
-        # make sure we handle parent paths before sub paths
-        mounts.sort(key=lambda mount: mount.path)
+        for path in options.overlay:
+            mounts[self.preprocess_path(path)] = MountType.OVERLAY
 
-        cwd = self.preprocess_path(options.cwd)
+        # the trie yields parent paths before sub paths
+        mounts, saved_syscalls = self.minimize_mounts(mounts)
 
-        self._userns.create(new_net=options.nonet)
-        self._userns.mount_tmpfs(self._mount_base, "550")
+        plan = MountPlan(saved_syscalls=saved_syscalls)
+        plan.add("tmpfs", "/", Runjail.ROOT_MODE)
+        plan.add("mkdir", "/proc", 0o550)
+        plan.add("proc", "/proc")
 
-        os.mkdir(self._mount_base + "/proc", 0o550)
-        self._userns.mount_proc(self._mount_base + "/proc")
+        plan.add("mkdir", Runjail.HIDE_BASE, 0o500)
+        plan.add("mkdir", Runjail.HIDE_DIR, 0o000)
+        plan.add("create_file", Runjail.HIDE_FILE, 0o000)
 
-        self.init_hide_mounts()
+        for path, target in sorted(options.symlink.items()):
+            plan.add("symlink", target, path)
 
-        for path, target in options.symlink.items():
-            os.symlink(target, self._mount_base + path)
+        if options.overlay:
+            plan.add("mkdir", Runjail.OVERLAY_BASE, 0o700)
+            plan.add("tmpfs", Runjail.OVERLAY_BASE, "700")
+        overlay_index = 0
 
         for mount in mounts:
-            abs_mount_path = self._mount_base + mount.path
-
-            if mount.type is MountType.RO:
-                self.bind_mount(mount.path, read_only=True)
-            elif mount.type is MountType.RW:
-                self.bind_mount(mount.path, read_only=False)
-            elif mount.type is MountType.HIDE:
-                if os.path.isdir(abs_mount_path):
-                    os.makedirs(abs_mount_path, 0o700, exist_ok=True)
-                    self._userns.mount_bind(self._mount_hide_dir, abs_mount_path)
-                    self._userns.remount_ro(abs_mount_path, 0)
+            if mount.type is MountType.RO or mount.type is MountType.RW:
+                if os.path.isdir(mount.path):
+                    plan.add("makedirs", mount.path, 0o700)
                 else:
-                    if not os.path.exists(abs_mount_path):
-                        self.create_file(abs_mount_path, 0o000)
-                    self._userns.mount_bind(self._mount_hide_file, abs_mount_path)
-                    self._userns.remount_ro(abs_mount_path, 0)
+                    plan.add("makedirs", os.path.dirname(mount.path), 0o700)
+                    plan.add("create_file", mount.path, 0o600)
+                plan.add("bind", mount.path, mount.type is MountType.RO)
+            elif mount.type is MountType.HIDE:
+                plan.add("hide", mount.path)
             elif mount.type is MountType.EMPTY:
-                os.makedirs(abs_mount_path, 0o700, exist_ok=True)
-                self._userns.mount_tmpfs(abs_mount_path, "750")
+                plan.add("makedirs", mount.path, 0o700)
+                plan.add("tmpfs", mount.path, "750", *self.get_tmpfs_options(options, mount.path))
+                if options.seeds and mount.path in options.seeds:
+                    plan.add("seed", mount.path)
             elif mount.type is MountType.EMPTYRO:
-                os.makedirs(abs_mount_path, 0o700, exist_ok=True)
+                plan.add("makedirs", mount.path, 0o700)
                 # is later remounted read-only
-                self._userns.mount_tmpfs(abs_mount_path, "550")
-
-        mount_info = MountInfo()
+                plan.add("tmpfs", mount.path, "550", *self.get_tmpfs_options(options, mount.path))
+                if options.seeds and mount.path in options.seeds:
+                    plan.add("seed", mount.path)
+            elif mount.type is MountType.OVERLAY:
+                plan.add("makedirs", mount.path, 0o700)
+                plan.add("overlay", mount.path, overlay_index)
+                overlay_index += 1
 
         for mount in mounts:
-            mount_path = self._mount_base + mount.path
-
             if mount.type is MountType.EMPTYRO:
-                self._userns.remount_ro(mount_path,
-                                        mount_info.get_mountpoint(mount_path).get_mount_flags())
+                plan.add("remount_ro", mount.path)
+
+        plan.add("remount_ro", "/")
+
+        return plan
+
+    def get_tmpfs_options(self, options, path):
+        """Returns:
+            A list with the additional tmpfs options of |path| if there are any.
+        """
+        if options.tmpfs_options and path in options.tmpfs_options:
+            return [options.tmpfs_options[path]]
+        return []
+
+    def minimize_mounts(self, mounts):
+        """Drop mounts that are already covered by an identical mount of a parent.
+        Args:
+            mounts: PathTrie that maps paths to their MountType.
+        Returns:
+            A tuple of the list of Mount, parents before children, and the
+            estimated number of saved syscalls.
+        """
+        kept = PathTrie()
+        saved_syscalls = 0
+
+        for path, type in mounts.items():
+            ancestor = mounts.find_ancestor(path) if type in Runjail.MOUNT_COST else None
+            if ancestor is not None and ancestor[1] is type:
+                # recursive binds of the same source tree, nothing changes
+                saved_syscalls += Runjail.MOUNT_COST[type]
+            else:
+                kept[path] = type
+
+        return [Mount(path, type) for path, type in kept.items()], saved_syscalls
+
+    def get_plan(self, options, plan_cache=None):
+        if plan_cache is None:
+            return self.compile_plan(options)
+
+        key = MountPlanCache.get_key(options)
+        plan = plan_cache.load(key)
+        if plan is None:
+            plan = self.compile_plan(options)
+            plan_cache.store(key, plan)
+
+        return plan
+
+    def execute_plan(self, plan):
+        Trace.count("saved_syscalls", plan.saved_syscalls)
+        for step in plan.steps:
+            getattr(self, "_step_" + step[0])(*step[1:])
+
+    def _step_mkdir(self, path, mode):
+        os.mkdir(self.get_staging_path(path), mode)
+
+    def _step_makedirs(self, path, mode):
+        os.makedirs(self.get_staging_path(path), mode, exist_ok=True)
+
+    def _step_create_file(self, path, mode):
+        abs_path = self.get_staging_path(path)
+        if not os.path.exists(abs_path):
+            self.create_file(abs_path, mode)
+
+    def _step_symlink(self, target, path):
+        os.symlink(target, self.get_staging_path(path))
+
+    def _step_proc(self, path):
+        self._userns.mount_proc(self.get_staging_path(path))
+        self._mount_tracker_stale = True
+
+    def _step_tmpfs(self, path, mode, options=None):
+        if path == "/" and self._mount_tracker is None:
+            # the staging root is already the tmpfs, another one on top would stay writable beneath "/"
+            return
+        self._userns.mount_tmpfs(self.get_staging_path(path), mode, options)
+        self._mount_tracker_stale = True
+
+    def _step_seed(self, path):
+        from runjail import Seed
+        fd, archive = self._seeds.pop(path)
+
+        def extract():
+            try:
+                Seed.extract(fd, path)
+            except (OSError, ValueError) as e:
+                print("Couldn't extract the seed archive '{}': {}".format(archive, e), file=sys.stderr)
+                sys.exit(1)
+
+        # the checks of the extraction use realpath(), which turns the fd path of a staging root into a host path
+        try:
+            self._userns.call_in_staging_root(extract)
+        except ChildProcessError:
+            sys.exit(1)
+        finally:
+            os.close(fd)
+
+    def _step_bind(self, path, read_only):
+        self.bind_mount(path, read_only)
+
+    def _step_hide(self, path):
+        abs_mount_path = self.get_staging_path(path)
+
+        if os.path.isdir(abs_mount_path):
+            os.makedirs(abs_mount_path, 0o700, exist_ok=True)
+            self._userns.mount_bind(self.get_staging_path(Runjail.HIDE_DIR), abs_mount_path)
+        else:
+            if not os.path.exists(abs_mount_path):
+                self.create_file(abs_mount_path, 0o000)
+            self._userns.mount_bind(self.get_staging_path(Runjail.HIDE_FILE), abs_mount_path)
+        self._userns.remount_ro(abs_mount_path, 0)
+        self._mount_tracker_stale = True
+
+    def _step_overlay(self, path, index):
+        layers = self.get_staging_path("{}/{}".format(Runjail.OVERLAY_BASE, index))
+        os.mkdir(layers, 0o700)
+        # the root of the overlay gets its attributes from the upper directory
+        os.mkdir(layers + "/upper", os.stat(path).st_mode & 0o7777)
+        os.mkdir(layers + "/work", 0o700)
+
+        # the host directory is the lower layer, submounts of it aren't part of the overlay
+        self._userns.mount_overlay(path, layers + "/upper", layers + "/work", self.get_staging_path(path))
+        self._mount_tracker_stale = True
+
+    def _step_remount_ro(self, path):
+        abs_path = self.get_staging_path(path)
+
+        if self._mount_tracker is None:
+            # the kernel of a staging root without directory has mount_setattr(), no flags to look up
+            self._userns.mount_setattr_ro(abs_path)
+            return
+
+        # the remounts are all at the end of the plan so this only reads the mount table once
+        if self._mount_tracker_stale:
+            self._mount_tracker.refresh()
+            self._mount_tracker_stale = False
+
+        self._userns.remount_ro(abs_path, self._mount_tracker.get_mountpoint(abs_path).get_mount_flags())
+
+    def open_seeds(self, seeds):
+        """Open the archives of |seeds| on the host so they can be extracted
+        once the sandbox has no access to them.
+        """
+        from runjail import Seed
+
+        for path, archive in seeds.items():
+            try:
+                self._seeds[path] = (Seed.open_archive(archive), archive)
+            except OSError as e:
+                print("Couldn't open the seed archive '{}': {}".format(archive, e.strerror), file=sys.stderr)
+                sys.exit(1)
+            except ValueError as e:
+                print(str(e), file=sys.stderr)
+                sys.exit(1)
+
+    def create_cgroup(self, root, limits):
+        """Create a cgroup with |limits| and move the current process into it,
+        the sandbox forked from it inherits the cgroup.
+        """
+        from runjail.CGroup import CGroup
+
+        try:
+            cgroup = CGroup(root, limits)
+            cgroup.create()
+            cgroup.enter()
+        except OSError as e:
+            print("Couldn't set up a cgroup in '{}': {}\n"
+                  "The cgroup root has to be a delegated cgroup v2 without processes.".format(
+                      root, e.strerror),
+                  file=sys.stderr)
+            sys.exit(1)
+
+        return cgroup
+
+    def run(self, options, command, plan_cache=None, launcher=None, keep=None, plan=None, stats=None):
+        """Set up the sandbox and exec |command| in it, doesn't return.
+        Args:
+            launcher: Called right before the exec, returns the command, cwd
+                and environment to use instead.
+            keep: NamedSandbox to keep alive after the command exited.
+            plan: MountPlan of |options| if it is already known.
+            stats: Stats to write once the sandbox exited.
+        """
+        if plan is None:
+            plan = self.get_plan(options, plan_cache)
+        cwd = self.preprocess_path(options.cwd)
+        Trace.mark("plan")
+
+        if options.seeds:
+            self.open_seeds(options.seeds)
+
+        cgroup = None
+        if options.cgroup_limits:
+            cgroup = self.create_cgroup(options.cgroup_root, options.cgroup_limits)
+
+        if UserNs.has_mount_api():
+            # mounted by the init process, nothing is created on the host
+            staging_dir = None
+        else:
+            # tempfile is slow to import and only needed here
+            import tempfile
+            staging_dir = tempfile.mkdtemp(prefix="runjail")
+        self._userns = UserNs(staging_dir)
+
+        if stats is not None:
+            for step in plan.steps:
+                if step[0] == "tmpfs":
+                    stats.add_tmpfs(step[1])
+
+        if keep is None:
+            keep_callback = None
+        else:
+            keep_callback = lambda pid: keep.save(pid, staging_dir)
+
+        self._userns.create(new_net=options.nonet, keep_callback=keep_callback, kill_timeout=options.kill_timeout,
+                            cgroup=cgroup, stats=stats)
+
+        if staging_dir is None:
+            self._mount_base = self._userns.mount_staging_root(Runjail.ROOT_MODE)
+        else:
+            self._mount_base = staging_dir
+            self._mount_tracker = MountTracker(staging_dir)
+        Trace.mark("staging_dir")
 
-        self._userns.remount_ro(self._mount_base, mount_info.get_mountpoint(self._mount_base).get_mount_flags())
+        self.execute_plan(plan)
+        Trace.mark("mounts")
 
         self._userns.set_no_new_privs()
-        self._userns.run(command, cwd)
+        self._userns.run(command, cwd, launcher, options.env, options.seccomp)
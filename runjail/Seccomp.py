@@ -0,0 +1,271 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Seccomp filters compiled from profiles to classic BPF.
+
+A profile is a JSON object in $XDG_CONFIG_HOME/runjail/seccomp/<name>.json.
+"allow", "deny" and "kill" are lists of syscall names, "default" is the
+action of all other syscalls (default "allow") and "errno" the error of
+denied syscalls (default "EPERM"). The built-in profile "default" denies
+syscalls that only administer the host or leave the sandbox.
+
+The filter kills processes that use another syscall ABI than the native one
+(e.g. i386 on x86_64), x32 syscalls fail with ENOSYS. The syscall numbers
+are split into ranges with the same action, which are looked up with a
+binary search of JGE jumps. So a syscall costs about log2(ranges)
+comparisons instead of one per listed syscall.
+"""
+
+import errno
+import json
+import marshal
+import os
+import struct
+
+# classic BPF instructions, struct sock_filter
+BPF_LD_W_ABS = 0x20
+BPF_JMP_JA = 0x05
+BPF_JMP_JEQ_K = 0x15
+BPF_JMP_JGE_K = 0x35
+BPF_RET_K = 0x06
+SOCK_FILTER_FORMAT = "=HBBI"
+# jt and jf are 8 bit offsets
+MAX_JUMP = 255
+
+# offsets in struct seccomp_data
+NR_OFFSET = 0
+ARCH_OFFSET = 4
+
+SECCOMP_RET_KILL_PROCESS = 0x80000000
+SECCOMP_RET_ERRNO = 0x00050000
+SECCOMP_RET_ALLOW = 0x7fff0000
+
+# maps platform.machine() to the AUDIT_ARCH_* value of the native syscall ABI
+AUDIT_ARCHES = { "x86_64": 0xc000003e,
+                 "aarch64": 0xc00000b7 }
+# x32 syscalls have the native AUDIT_ARCH_X86_64 and this bit in the number
+X32_SYSCALL_BIT = 0x40000000
+
+
+def get_syscall_table(arch):
+    from runjail import SyscallTable
+
+    if arch == "x86_64":
+        return SyscallTable.X86_64
+    elif arch == "aarch64":
+        return SyscallTable.AARCH64
+    raise ValueError("Seccomp filters aren't supported on {}.".format(arch))
+
+
+def _instruction(code, k, jt=0, jf=0):
+    return struct.pack(SOCK_FILTER_FORMAT, code, jt, jf, k)
+
+
+def _compile_search(ranges, start, end):
+    """Returns:
+        The instructions that return the action of the range among
+        |ranges|[start:end] that contains the syscall number in A.
+    """
+    if end - start == 1:
+        return [_instruction(BPF_RET_K, ranges[start][1])]
+
+    middle = (start + end) // 2
+    lower = _compile_search(ranges, start, middle)
+    upper = _compile_search(ranges, middle, end)
+
+    # jumps only go forward, the upper half follows the lower one
+    if len(lower) <= MAX_JUMP:
+        return [_instruction(BPF_JMP_JGE_K, ranges[middle][0], jt=len(lower))] + lower + upper
+    return ([_instruction(BPF_JMP_JGE_K, ranges[middle][0], jt=0, jf=1),
+             _instruction(BPF_JMP_JA, len(lower))] + lower + upper)
+
+
+def compile_filter(actions, default, arch):
+    """Compile a filter for the native syscall ABI of |arch|.
+    Args:
+        actions: Maps syscall numbers to the SECCOMP_RET_* value returned for them.
+        default: The SECCOMP_RET_* value of all other syscalls.
+    Returns:
+        The program as bytes of struct sock_filter.
+    """
+    try:
+        audit_arch = AUDIT_ARCHES[arch]
+    except KeyError:
+        raise ValueError("Seccomp filters aren't supported on {}.".format(arch))
+
+    boundaries = {0: default}
+    for number in sorted(actions):
+        boundaries.setdefault(number + 1, default)
+        boundaries[number] = actions[number]
+    if arch == "x86_64":
+        boundaries[X32_SYSCALL_BIT] = SECCOMP_RET_ERRNO | errno.ENOSYS
+
+    # list of the start and action of the ranges, neighbours with the same action are merged
+    ranges = []
+    for number, action in sorted(boundaries.items()):
+        if not ranges or ranges[-1][1] != action:
+            ranges.append((number, action))
+
+    program = [_instruction(BPF_LD_W_ABS, ARCH_OFFSET),
+               _instruction(BPF_JMP_JEQ_K, audit_arch, jt=1),
+               _instruction(BPF_RET_K, SECCOMP_RET_KILL_PROCESS),
+               _instruction(BPF_LD_W_ABS, NR_OFFSET)]
+    program += _compile_search(ranges, 0, len(ranges))
+
+    return b"".join(program)
+
+
+class SeccompProfile:
+    """A named seccomp profile and the cache of its compiled filter."""
+
+    # bumped when the syscall tables or the compiler change
+    VERSION = 1
+    ACTIONS = { "allow": SECCOMP_RET_ALLOW,
+                "kill": SECCOMP_RET_KILL_PROCESS }
+    BUILTIN = { "default": { "deny": ["_sysctl", "acct", "add_key", "bpf", "clock_adjtime", "clock_settime",
+                                      "create_module", "delete_module", "finit_module", "fsconfig", "fsmount",
+                                      "fsopen", "fspick", "get_kernel_syms", "init_module", "ioperm", "iopl",
+                                      "kexec_file_load", "kexec_load", "keyctl", "lookup_dcookie", "mount",
+                                      "mount_setattr", "move_mount", "nfsservctl", "open_by_handle_at",
+                                      "open_tree", "perf_event_open", "pivot_root", "query_module", "quotactl",
+                                      "reboot", "request_key", "setns", "settimeofday", "swapoff", "swapon",
+                                      "syslog", "umount2", "unshare", "uselib", "userfaultfd", "vhangup"] } }
+
+    def __init__(self, name):
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError("Invalid seccomp profile name \"{}\".".format(name))
+        self._name = name
+
+    def get_name(self):
+        return self._name
+
+    def get_path(self):
+        from runjail.Profile import Profile
+        return os.path.join(Profile.get_config_dir(), "seccomp", self._name + ".json")
+
+    def read(self):
+        """Returns:
+            The validated profile, a profile file overrides a built-in one.
+        Raises:
+            OSError if the profile can't be read, ValueError if it's invalid.
+        """
+        try:
+            with open(self.get_path()) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            if self._name not in SeccompProfile.BUILTIN:
+                raise
+            data = SeccompProfile.BUILTIN[self._name]
+
+        if not isinstance(data, dict):
+            raise ValueError("The profile has to be a JSON object.")
+
+        profile = { "default": "allow",
+                    "allow": [],
+                    "deny": [],
+                    "kill": [],
+                    "errno": "EPERM" }
+        for key, value in data.items():
+            if key in ("allow", "deny", "kill"):
+                if not isinstance(value, list) or not all(isinstance(name, str) for name in value):
+                    raise ValueError("\"{}\" has to be a list of syscall names.".format(key))
+            elif key == "default":
+                if value not in ("allow", "deny", "kill"):
+                    raise ValueError("\"default\" has to be \"allow\", \"deny\" or \"kill\".")
+            elif key == "errno":
+                if not isinstance(value, str) or not isinstance(getattr(errno, value, None), int):
+                    raise ValueError("Unknown errno \"{}\".".format(value))
+            else:
+                raise ValueError("Unknown key \"{}\".".format(key))
+            profile[key] = value
+
+        return profile
+
+    def compile(self, arch):
+        """Returns:
+            The filter of the profile for |arch| (see compile_filter()).
+        Raises:
+            OSError if the profile can't be read, ValueError if it's invalid.
+        """
+        from runjail import SyscallTable
+
+        profile = self.read()
+        table = get_syscall_table(arch)
+        action_values = dict(SeccompProfile.ACTIONS)
+        action_values["deny"] = SECCOMP_RET_ERRNO | getattr(errno, profile["errno"])
+
+        actions = {}
+        for action in ("allow", "deny", "kill"):
+            for name in profile[action]:
+                if name in table:
+                    if table[name] in actions:
+                        raise ValueError("\"{}\" is listed more than once.".format(name))
+                    actions[table[name]] = action_values[action]
+                elif name not in SyscallTable.X86_64 and name not in SyscallTable.AARCH64:
+                    raise ValueError("Unknown syscall \"{}\".".format(name))
+                # otherwise it doesn't exist on this architecture, profiles stay portable
+
+        return compile_filter(actions, action_values[profile["default"]], arch)
+
+    def _get_fingerprint(self, arch):
+        # profiles of the same name in other config directories share the cache file
+        path = self.get_path()
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        return (SeccompProfile.VERSION, arch, path, mtime)
+
+    def _get_cache_path(self, cache_dir):
+        return os.path.join(cache_dir, "seccomp", self._name + ".marshal")
+
+    def load(self, cache_dir):
+        """Compile the filter for the native architecture or load it from the cache.
+        Args:
+            cache_dir: Directory of the cache of compiled filters, None disables caching.
+        Raises:
+            OSError if the profile can't be read, ValueError if it's invalid.
+        """
+        arch = os.uname().machine
+        if cache_dir is None:
+            return self.compile(arch)
+
+        # taken before reading the profile, so changes while compiling invalidate the cache
+        fingerprint = self._get_fingerprint(arch)
+        path = self._get_cache_path(cache_dir)
+        try:
+            with open(path, "rb") as f:
+                cached_fingerprint, program = marshal.load(f)
+            if cached_fingerprint == fingerprint:
+                return program
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+        program = self.compile(arch)
+
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), 0o700, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                marshal.dump((fingerprint, program), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            # the cache is only an optimization
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+        return program
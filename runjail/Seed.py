@@ -0,0 +1,127 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Extraction of tar archives into empty mounts.
+
+The archive is opened on the host before the namespaces are set up and
+streamed from the fd into the new tmpfs, so it's neither bind-mounted into
+the sandbox nor copied to a temporary file. Compression (gzip, bzip2, xz and
+zstd) is detected from the content.
+"""
+
+import io
+import os
+import tarfile
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# reads from the archive and the decompressor
+BUFFER_SIZE = 1024 * 1024
+
+
+def _get_zstd_reader():
+    """Returns:
+        A function that wraps a binary file in a zstd decompressing reader or
+        None if neither compression.zstd (Python 3.14) nor zstandard is available.
+    """
+    try:
+        from compression import zstd
+        return zstd.ZstdFile
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+        return lambda f: zstandard.ZstdDecompressor().stream_reader(f, read_size=BUFFER_SIZE)
+    except ImportError:
+        return None
+
+
+def open_archive(path):
+    """Open the archive |path| for extract().
+    Returns:
+        The fd of the archive.
+    Raises:
+        OSError if it can't be opened, ValueError if it's compressed with zstd
+        and no zstd module is available.
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+
+    try:
+        magic = os.pread(fd, len(ZSTD_MAGIC), 0)
+    except OSError:
+        # a pipe, checked once it's extracted
+        return fd
+
+    if magic == ZSTD_MAGIC and _get_zstd_reader() is None:
+        os.close(fd)
+        raise ValueError("\"{}\" is compressed with zstd, that needs Python 3.14 or the zstandard module.".format(path))
+
+    return fd
+
+
+def _data_filter(member):
+    """Fallback of the "data" filter for Python before 3.12 without the backport,
+    changes |member| in place.
+    Raises:
+        ValueError if |member| would be extracted outside of the destination or is a special file.
+    """
+    def is_outside(path):
+        return os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == ".."
+
+    if is_outside(member.name):
+        raise ValueError("\"{}\" is outside of the destination.".format(member.name))
+    if member.isdev():
+        raise ValueError("\"{}\" is a special file.".format(member.name))
+    if member.issym() and is_outside(os.path.join(os.path.dirname(member.name), member.linkname)):
+        raise ValueError("\"{}\" links outside of the destination.".format(member.name))
+    if member.islnk() and is_outside(member.linkname):
+        raise ValueError("\"{}\" links outside of the destination.".format(member.name))
+
+    # like the "data" filter: no setuid/setgid/sticky bits, no write access for others, no owners
+    member.mode &= 0o755
+    member.uid = os.getuid()
+    member.gid = os.getgid()
+    member.uname = ""
+    member.gname = ""
+
+
+def extract(fd, target):
+    """Extract the archive |fd| to the directory |target| and close it.
+    The "data" filter rejects absolute paths, links that point outside of
+    |target| and device files.
+    Raises:
+        OSError or ValueError if the archive can't be extracted.
+    """
+    with io.open(fd, "rb", buffering=BUFFER_SIZE) as f:
+        # stream mode only reads forward, "*" detects the other compressions
+        fileobj = f
+        mode = "r|*"
+        if f.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+            zstd_reader = _get_zstd_reader()
+            if zstd_reader is None:
+                raise ValueError("The archive is compressed with zstd, that needs Python 3.14 or the zstandard module.")
+            fileobj = zstd_reader(f)
+            mode = "r|"
+
+        try:
+            with tarfile.open(fileobj=fileobj, mode=mode, bufsize=BUFFER_SIZE) as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(target, filter="data")
+                else:
+                    for member in tar:
+                        _data_filter(member)
+                        tar.extract(member, target)
+        except tarfile.TarError as e:
+            raise ValueError(str(e))
@@ -0,0 +1,331 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import collections
+import errno
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+# large enough for the argv and environment of a command
+MAX_MESSAGE_SIZE = 1024 * 1024
+MAX_FDS = 3
+# delay of respawning sandboxes after one died before it was launched
+MIN_RESPAWN_DELAY = 0.1
+MAX_RESPAWN_DELAY = 30
+
+
+def send_message(sock, obj, fds=()):
+    """Send |obj| as one packet, passing |fds| with SCM_RIGHTS."""
+    ancillary = []
+    if fds:
+        ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds)))
+    sock.sendmsg([json.dumps(obj).encode()], ancillary)
+
+
+def recv_message(sock):
+    """Receive a packet sent by send_message().
+    Returns:
+        A tuple of the object and the list of received fds or (None, []) on EOF.
+    """
+    fds = array.array("i")
+    data, ancillary, flags, address = sock.recvmsg(MAX_MESSAGE_SIZE,
+                                                   socket.CMSG_SPACE(MAX_FDS * fds.itemsize))
+    for level, type, cmsg_data in ancillary:
+        if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+
+    if not data:
+        for fd in fds:
+            os.close(fd)
+        return None, []
+
+    return json.loads(data.decode()), list(fds)
+
+
+class SandboxLauncher:
+    """Parks a fully set up sandbox until the server hands it a command.
+
+    Called by UserNs.run in the process that execs the command.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def __call__(self):
+        send_message(self._sock, {"ready": True})
+        request, fds = recv_message(self._sock)
+        if request is None:
+            # the server went away
+            os._exit(1)
+
+        for target_fd, fd in enumerate(fds):
+            os.dup2(fd, target_fd)
+            os.close(fd)
+        self._sock.close()
+
+        return request["argv"], request["cwd"], request["env"]
+
+
+Sandbox = collections.namedtuple("Sandbox", ["pid", "sock"])
+
+
+class Server:
+    """Keeps a pool of sandboxes that are set up up to the final exec.
+
+    Clients connect to a SOCK_SEQPACKET unix socket and send the argv, cwd,
+    environment and their stdio fds. The server hands them to a parked
+    sandbox and replies with the wait status once the command exits.
+    Sandboxes that die before they are launched are replaced, backing off
+    while they keep failing.
+    """
+
+    def __init__(self, socket_path, pool_size, options, plan_cache=None):
+        self._socket_path = socket_path
+        self._pool_size = pool_size
+        self._options = options
+        self._plan_cache = plan_cache
+        self._listen_sock = None
+        self._wakeup_read_fd = None
+        self._wakeup_write_fd = None
+        self._selector = None
+        # sandboxes that are being set up or are ready, by sandbox socket
+        self._pool = {}
+        self._ready = collections.deque()
+        # requests waiting for a ready sandbox
+        self._pending = collections.deque()
+        # client connection of launched sandboxes, by pid
+        self._running = {}
+        self._respawn_delay = MIN_RESPAWN_DELAY
+        # monotonic time to refill the pool at
+        self._respawn_at = None
+
+    def _spawn(self):
+        server_sock, sandbox_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                server_sock.close()
+                self._close_server_fds()
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+                # signals to the process group of the server shouldn't skip the
+                # cleanup of parked sandboxes, they exit once their socket is closed
+                os.setpgrp()
+
+                # the sandbox must not take over the terminal of the server
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, sys.stdin.fileno())
+                os.close(devnull)
+
+                # imported here to keep the client side light
+                from runjail.Runjail import Runjail
+
+                runjail = Runjail()
+                runjail.run(self._options, None, self._plan_cache, launcher=SandboxLauncher(sandbox_sock))
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+            os._exit(exit_code)
+
+        sandbox_sock.close()
+        self._pool[server_sock] = Sandbox(pid, server_sock)
+        self._selector.register(server_sock, selectors.EVENT_READ, self._handle_sandbox)
+
+    def _close_server_fds(self):
+        self._selector.close()
+        self._listen_sock.close()
+        os.close(self._wakeup_read_fd)
+        os.close(self._wakeup_write_fd)
+        for sock in self._pool:
+            sock.close()
+        for conn in self._running.values():
+            conn.close()
+        for conn, request, fds in self._pending:
+            conn.close()
+            for fd in fds:
+                os.close(fd)
+
+    def _handle_accept(self, sock):
+        conn, address = sock.accept()
+        self._selector.register(conn, selectors.EVENT_READ, self._handle_client)
+
+    def _handle_client(self, conn):
+        self._selector.unregister(conn)
+
+        try:
+            request, fds = recv_message(conn)
+        except (OSError, ValueError):
+            request, fds = None, []
+
+        if request is None or len(fds) != MAX_FDS:
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            return
+
+        self._pending.append((conn, request, fds))
+        self._dispatch()
+
+    def _handle_sandbox(self, sock):
+        try:
+            message, fds = recv_message(sock)
+        except OSError:
+            message = None
+
+        if message is None:
+            # died during setup, it is reaped in _handle_wakeup
+            self._selector.unregister(sock)
+        else:
+            self._respawn_delay = MIN_RESPAWN_DELAY
+            self._ready.append(self._pool[sock])
+            self._dispatch()
+
+    def _handle_wakeup(self, fd):
+        os.read(fd, 4096)
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+
+            if pid in self._running:
+                conn = self._running.pop(pid)
+                try:
+                    send_message(conn, {"status": status})
+                except OSError:
+                    # the client went away
+                    pass
+                conn.close()
+            else:
+                for sandbox in list(self._pool.values()):
+                    if sandbox.pid == pid:
+                        print("Sandbox {} exited with status {} before it was launched.".format(pid, status),
+                              file=sys.stderr)
+                        self._remove_from_pool(sandbox)
+                        self._schedule_respawn()
+
+    def _schedule_respawn(self):
+        if self._respawn_at is None:
+            self._respawn_at = time.monotonic() + self._respawn_delay
+            self._respawn_delay = min(self._respawn_delay * 2, MAX_RESPAWN_DELAY)
+
+    def _respawn(self):
+        self._respawn_at = None
+        while len(self._pool) < self._pool_size:
+            self._spawn()
+
+    def _remove_from_pool(self, sandbox):
+        del self._pool[sandbox.sock]
+        if sandbox in self._ready:
+            self._ready.remove(sandbox)
+        if sandbox.sock.fileno() in self._selector.get_map():
+            self._selector.unregister(sandbox.sock)
+        sandbox.sock.close()
+
+    def _dispatch(self):
+        while self._pending and self._ready:
+            conn, request, fds = self._pending.popleft()
+            sandbox = self._ready.popleft()
+
+            try:
+                send_message(sandbox.sock, request, fds)
+                self._running[sandbox.pid] = conn
+            except OSError:
+                conn.close()
+            finally:
+                for fd in fds:
+                    os.close(fd)
+                self._remove_from_pool(sandbox)
+
+            # refill, the new sandbox is set up while the command runs
+            self._spawn()
+
+    def serve_forever(self):
+        self._listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            os.remove(self._socket_path)
+        except FileNotFoundError:
+            pass
+        self._listen_sock.bind(self._socket_path)
+        self._listen_sock.listen(16)
+
+        # turn SIGCHLD into a readable fd so the loop notices exiting sandboxes
+        self._wakeup_read_fd, self._wakeup_write_fd = os.pipe2(os.O_CLOEXEC | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self._wakeup_write_fd)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listen_sock, selectors.EVENT_READ, self._handle_accept)
+        self._selector.register(self._wakeup_read_fd, selectors.EVENT_READ, self._handle_wakeup)
+
+        try:
+            for i in range(self._pool_size):
+                self._spawn()
+
+            while True:
+                timeout = None
+                if self._respawn_at is not None:
+                    timeout = max(self._respawn_at - time.monotonic(), 0)
+
+                for key, events in self._selector.select(timeout):
+                    key.data(key.fileobj)
+
+                if self._respawn_at is not None and time.monotonic() >= self._respawn_at:
+                    self._respawn()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.set_wakeup_fd(-1)
+            # parked sandboxes exit when their socket is closed
+            for sandbox in list(self._pool.values()):
+                self._remove_from_pool(sandbox)
+            self._listen_sock.close()
+            os.remove(self._socket_path)
+
+
+def launch(socket_path, command, cwd, env):
+    """Run |command| in a sandbox of the server listening on |socket_path|.
+    Returns:
+        The wait status of the command.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.connect(socket_path)
+
+    send_message(sock, {"argv": command, "cwd": cwd, "env": env},
+                 [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+
+    reply, fds = recv_message(sock)
+    sock.close()
+
+    if reply is None:
+        raise OSError(errno.ECONNRESET, "The server closed the connection.")
+
+    return reply["status"]
@@ -0,0 +1,151 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import resource
+import struct
+import time
+
+
+class Stats:
+    """Resource usage of a sandbox, written as JSON to a file after it exited.
+
+    The processes inside the sandbox report to the monitor through a pipe:
+    the command the time right before its exec and the init process the
+    usage of all its children and of the tmpfs mounts once the children are
+    reaped. The init process only runs the command and reaps orphans, so its
+    own setup work and memory aren't counted. The max RSS still covers the
+    forked interpreter of the command before its exec, the kernel keeps that
+    peak across the exec.
+    """
+
+    # record type, time.monotonic()
+    EXEC_FORMAT = "=cd"
+    # record type, wait status, user and system CPU seconds, max RSS in KiB, block input and output operations
+    USAGE_FORMAT = "=ciddqqq"
+    # record type, index of the tmpfs mount, used and total bytes, used and total inodes
+    TMPFS_FORMAT = "=ciQQQQ"
+
+    def __init__(self, path, start=None):
+        """Args:
+            start: time.monotonic() of the start of runjail (default: now).
+        """
+        self._path = path
+        self._start = time.monotonic() if start is None else start
+        self._read_fd, self._write_fd = os.pipe2(os.O_CLOEXEC)
+        # tmpfs mountpoints in the sandbox, the records refer to them by index
+        self._tmpfs = []
+
+    def add_tmpfs(self, path):
+        self._tmpfs.append(path)
+
+    def close_writer(self):
+        """Called by the monitor after the fork so it sees EOF once the sandbox exited."""
+        os.close(self._write_fd)
+        self._write_fd = None
+
+    def report_exec(self):
+        """Called by the command right before its exec, the pipe is closed by the exec."""
+        os.write(self._write_fd, struct.pack(Stats.EXEC_FORMAT, b"E", time.monotonic()))
+
+    def report_usage(self, status):
+        """Called by the init process after all its children were reaped.
+        Args:
+            status: The wait status of the command.
+        """
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        data = struct.pack(Stats.USAGE_FORMAT, b"U", status,
+                           usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+                           usage.ru_inblock, usage.ru_oublock)
+
+        # the init process is in the root of the sandbox, the monitor can't reach the mounts
+        for index, path in enumerate(self._tmpfs):
+            try:
+                stat = os.statvfs(path)
+            except OSError:
+                continue
+            data += struct.pack(Stats.TMPFS_FORMAT, b"T", index,
+                                (stat.f_blocks - stat.f_bfree) * stat.f_frsize, stat.f_blocks * stat.f_frsize,
+                                stat.f_files - stat.f_ffree, stat.f_files)
+
+        os.write(self._write_fd, data)
+
+    def _read_records(self):
+        data = b""
+        while True:
+            chunk = os.read(self._read_fd, 4096)
+            if not chunk:
+                break
+            data += chunk
+        os.close(self._read_fd)
+        self._read_fd = None
+
+        record_formats = { b"E": Stats.EXEC_FORMAT,
+                           b"U": Stats.USAGE_FORMAT,
+                           b"T": Stats.TMPFS_FORMAT }
+        # maps the record types to the list of their records
+        records = {}
+        offset = 0
+        while offset < len(data):
+            record_format = record_formats[data[offset:offset + 1]]
+            record = struct.unpack_from(record_format, data, offset)
+            records.setdefault(record[0], []).append(record[1:])
+            offset += struct.calcsize(record_format)
+        return records
+
+    def _get_tmpfs_usage(self, records):
+        usage = {}
+        for index, used_bytes, size_bytes, used_inodes, inodes in records:
+            usage[self._tmpfs[index]] = { "used_bytes": used_bytes,
+                                          "size_bytes": size_bytes,
+                                          "used_inodes": used_inodes,
+                                          "inodes": inodes }
+        return dict(sorted(usage.items()))
+
+    def write(self, status):
+        """Write the stats of the sandbox that exited with |status|.
+        Fields are null if the sandbox didn't report them, e.g. when it was killed.
+        Either "exit_code" or "signal" is null depending on how the command exited.
+        """
+        end = time.monotonic()
+        records = self._read_records()
+
+        stats = { "wall_time": end - self._start,
+                  "setup_time": None,
+                  "user_cpu_time": None,
+                  "system_cpu_time": None,
+                  "max_rss_kb": None,
+                  "block_input_ops": None,
+                  "block_output_ops": None,
+                  "exit_code": None,
+                  "signal": None }
+
+        if b"E" in records:
+            stats["setup_time"] = records[b"E"][0][0] - self._start
+
+        if b"U" in records:
+            (status, stats["user_cpu_time"], stats["system_cpu_time"], stats["max_rss_kb"],
+             stats["block_input_ops"], stats["block_output_ops"]) = records[b"U"][0]
+
+        if os.WIFSIGNALED(status):
+            stats["signal"] = os.WTERMSIG(status)
+        else:
+            stats["exit_code"] = os.WEXITSTATUS(status)
+
+        stats["tmpfs"] = self._get_tmpfs_usage(records.get(b"T", []))
+
+        with open(self._path, "w") as f:
+            json.dump(stats, f, indent=2)
@@ -0,0 +1,177 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import select
+import signal
+import struct
+import time
+
+from runjail.Libc import Libc
+
+
+class Supervisor:
+    """Waits for the main child while forwarding termination signals to it.
+
+    Signals are read from a signalfd and the exit of the main child from a
+    pidfd, both are polled with epoll so nothing waits for a timer. The
+    signals have to be blocked with block_signals() before the child is
+    forked, the child has to restore the returned mask before it execs.
+    Kernels without signalfd or pidfd_open() (before 5.3) fall back to
+    waiting for the blocked signals with sigtimedwait().
+    """
+
+    FORWARD_SIGNALS = (signal.SIGHUP, signal.SIGINT, signal.SIGQUIT, signal.SIGTERM)
+    SIGNALS = FORWARD_SIGNALS + (signal.SIGCHLD,)
+
+    @staticmethod
+    def block_signals():
+        """Returns:
+            The previous signal mask.
+        """
+        return signal.pthread_sigmask(signal.SIG_BLOCK, Supervisor.SIGNALS)
+
+    def __init__(self, pid, process_group=False, reap_orphans=False, kill_timeout=None):
+        """Args:
+            pid: The main child.
+            process_group: Send the signals to the process group of |pid|.
+            reap_orphans: Wait until all children exited, not only |pid|. Used by
+                the init process of a pid namespace which inherits the orphans.
+            kill_timeout: Send SIGKILL if |pid| didn't exit this many seconds
+                after the first forwarded signal.
+        """
+        self._libc = Libc()
+        self._pid = pid
+        self._process_group = process_group
+        self._reap_orphans = reap_orphans
+        self._kill_timeout = kill_timeout
+        self._status = None
+
+    def _kill(self, sig):
+        try:
+            if self._process_group:
+                os.killpg(self._pid, sig)
+            else:
+                os.kill(self._pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _reap(self):
+        """Reap all children that exited.
+        Returns:
+            True if there are no children left.
+        """
+        while True:
+            try:
+                (wpid, status) = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return True
+            if wpid == 0:
+                return False
+            if wpid == self._pid:
+                self._status = status
+
+    def _read_signals(self, fd):
+        data = os.read(fd, 16 * Libc.SIGNALFD_SIGINFO_SIZE)
+        return [struct.unpack_from("I", data, offset)[0]
+                for offset in range(0, len(data), Libc.SIGNALFD_SIGINFO_SIZE)]
+
+    def _forward(self, sig, deadline):
+        """Returns:
+            The deadline for SIGKILL after forwarding |sig|.
+        """
+        self._kill(sig)
+        if deadline is None and self._kill_timeout is not None:
+            deadline = time.monotonic() + self._kill_timeout
+        return deadline
+
+    def run(self):
+        """Returns:
+            The wait status of the main child.
+        """
+        try:
+            signal_fd = self._libc.signalfd(Supervisor.SIGNALS)
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            return self._run_sigwait()
+
+        try:
+            pidfd = self._libc.pidfd_open(self._pid)
+        except OSError as e:
+            os.close(signal_fd)
+            if e.errno != errno.ENOSYS:
+                raise
+            return self._run_sigwait()
+
+        deadline = None
+
+        try:
+            with select.epoll() as epoll:
+                epoll.register(signal_fd, select.EPOLLIN)
+                epoll.register(pidfd, select.EPOLLIN)
+
+                while True:
+                    no_children = self._reap()
+                    if self._status is not None:
+                        if no_children or not self._reap_orphans:
+                            return self._status
+                        if pidfd is not None:
+                            # stays readable after the exit
+                            epoll.unregister(pidfd)
+                            os.close(pidfd)
+                            pidfd = None
+
+                    timeout = -1 if deadline is None else max(deadline - time.monotonic(), 0)
+                    events = epoll.poll(timeout)
+
+                    if deadline is not None and time.monotonic() >= deadline:
+                        self._kill(signal.SIGKILL)
+                        deadline = None
+
+                    for fd, event in events:
+                        if fd != signal_fd:
+                            continue
+                        for sig in self._read_signals(signal_fd):
+                            if sig != signal.SIGCHLD:
+                                deadline = self._forward(sig, deadline)
+        finally:
+            os.close(signal_fd)
+            if pidfd is not None:
+                os.close(pidfd)
+
+    def _run_sigwait(self):
+        """Same as run() without signalfd and pidfd, the exit of the child is
+        noticed through the blocked SIGCHLD.
+        """
+        deadline = None
+
+        while True:
+            no_children = self._reap()
+            if self._status is not None and (no_children or not self._reap_orphans):
+                return self._status
+
+            if deadline is None:
+                info = signal.sigwaitinfo(Supervisor.SIGNALS)
+            else:
+                info = signal.sigtimedwait(Supervisor.SIGNALS, max(deadline - time.monotonic(), 0))
+
+            if deadline is not None and time.monotonic() >= deadline:
+                self._kill(signal.SIGKILL)
+                deadline = None
+
+            if info is not None and info.si_signo != signal.SIGCHLD:
+                deadline = self._forward(info.si_signo, deadline)
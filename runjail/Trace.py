@@ -0,0 +1,79 @@
+# Copyright (C) 2017 Felix Geyer <debfx@fobos.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or (at your option)
+# version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Per-phase timing and call counters of a launch.
+
+All functions are no-ops until enable() is called, so the instrumentation
+costs a single global lookup when tracing is disabled. The state is inherited
+by forked children, the process that execs the command emits the record.
+"""
+
+import os
+import time
+
+_active = None
+
+
+class _Trace:
+    def __init__(self, fd, start):
+        self.fd = fd
+        self.start = time.monotonic() if start is None else start
+        self.last = self.start
+        self.phases = []
+        self.counters = {}
+
+
+def enable(fd, start=None):
+    """Record timings and write them to |fd| when emit() is called.
+    Args:
+        start: time.monotonic() value of the start of the launch.
+    """
+    global _active
+    _active = _Trace(fd, start)
+
+
+def is_enabled():
+    return _active is not None
+
+
+def mark(phase):
+    """End |phase|, it started at the previous mark."""
+    if _active is not None:
+        now = time.monotonic()
+        _active.phases.append((phase, now - _active.last))
+        _active.last = now
+
+
+def count(name, value=1):
+    if _active is not None:
+        _active.counters[name] = _active.counters.get(name, 0) + value
+
+
+def emit():
+    """Write the record as one JSON line, right before the exec."""
+    if _active is None:
+        return
+
+    import json
+
+    record = { "pid": os.getpid(),
+               "total_ms": (time.monotonic() - _active.start) * 1000,
+               "phases": [[phase, duration * 1000] for phase, duration in _active.phases],
+               "counters": _active.counters }
+    try:
+        os.write(_active.fd, (json.dumps(record) + "\n").encode())
+    except OSError:
+        # tracing must never prevent the command from running
+        pass
@@ -17,11 +17,13 @@
 import errno
 import os
 import signal
+import struct
 import sys
-import time
 
+from runjail import Trace
 from runjail.Libc import Libc
 from runjail.LibCap import Pcap
+from runjail.Supervisor import Supervisor
 
 
 class PipeLock:
@@ -59,11 +61,24 @@ class PipeLock:
 
 
 class UserNs:
-    def __init__(self, chroot_dir):
+    def __init__(self, chroot_dir=None):
+        """Args:
+            chroot_dir: Staging directory of the root of the sandbox, None if
+                it's mounted with mount_staging_root() instead.
+        """
         self._chroot_dir = chroot_dir
         self._libc = Libc()
+        # fd of the tmpfs mounted by mount_staging_root()
+        self._staging_fd = None
         # remember original uid, changes when transitioning to new user ns
         self._uid = os.getuid()
+        # cleared when the kernel doesn't support the new mount API
+        self._has_mount_api = True
+        # used by the init process of kept sandboxes to report to the parent
+        self._keep_fd = None
+        # signal mask before the supervised signals were blocked, restored for the command
+        self._sigmask = None
+        self._stats = None
 
     def safeTcSetPgrp(self, fd, pgrp):
         """Set |pgrp| as the controller of the tty |fd|."""
@@ -79,28 +94,8 @@ class UserNs:
         if curr_pgrp == os.getpgrp():
             os.tcsetpgrp(fd, pgrp)
 
-    def reapChildren(self, pid):
-        """Reap all children that get reparented to us until we see |pid| exit.
-        Args:
-            pid: The main child to watch for.
-        Returns:
-            The wait status of the |pid| child.
-        """
-        pid_status = 0
-        while True:
-            try:
-                (wpid, status) = os.wait()
-                if pid == wpid:
-                    # Save the status of our main child so we can exit with it below.
-                    pid_status = status
-            except OSError as e:
-                if e.errno == errno.ECHILD:
-                    break
-                elif e.errno != errno.EINTR:
-                    raise
-        return pid_status
-
-    def exitAsStatus(self, status):
+    @staticmethod
+    def exitAsStatus(status):
         """Exit the same way as |status|.
         If the status field says it was killed by a signal, then we'll do that to
         ourselves.  Otherwise we'll exit with the exit code.
@@ -109,45 +104,100 @@ class UserNs:
             status: A status as returned by os.wait type funcs.
         """
         if os.WIFSIGNALED(status):
-            # Kill ourselves with the same signal.
+            # Kill ourselves with the same signal.  A fatal signal sent to
+            # ourselves is delivered before kill() returns.
             sig_status = os.WTERMSIG(status)
-            pid = os.getpid()
-            os.kill(pid, sig_status)
-            time.sleep(0.1)
-            # Still here?  Maybe the signal was masked.
             try:
                 signal.signal(sig_status, signal.SIG_DFL)
-            except RuntimeError as e:
-                if e.args[0] != errno.EINVAL:
-                    raise
-            os.kill(pid, sig_status)
-            time.sleep(0.1)
-            # Still here?  Just exit.
+            except OSError:
+                # SIGKILL and SIGSTOP can't be handled anyway
+                pass
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, [sig_status])
+            os.kill(os.getpid(), sig_status)
+            # Still here?  The init process of a pid namespace ignores its own
+            # signals, just exit.
             exit_status = 128 + sig_status
         else:
             exit_status = os.WEXITSTATUS(status)
         # Exit with the code we want.
         sys.exit(exit_status)
 
-    def create(self, new_net=False):
+    def reapKept(self, pid):
+        """Reap all children but keep running after |pid| exited.
+        This keeps the pid namespace alive so commands can be attached later.
+        The wait status of |pid| is reported to the parent.
+        Args:
+            pid: The main child to watch for.
+        """
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+
+        while True:
+            while True:
+                try:
+                    (wpid, status) = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if wpid == 0:
+                    break
+                if wpid == pid:
+                    os.write(self._keep_fd, struct.pack("i", status))
+                    os.close(self._keep_fd)
+                    self._keep_fd = None
+
+            signal.sigwaitinfo([signal.SIGCHLD])
+
+    def waitKept(self, read_fd, pid, keep_callback):
+        """Wait until the init process of a kept sandbox is ready and its main child exited.
+        Returns:
+            The wait status of the main child or None if the init process died.
+        """
+        with os.fdopen(read_fd, "rb") as f:
+            if f.read(1) != b"R":
+                return None
+
+            keep_callback(pid)
+
+            data = f.read(struct.calcsize("i"))
+            if len(data) != struct.calcsize("i"):
+                return None
+
+            return struct.unpack("i", data)[0]
+
+    def create(self, new_net=False, keep_callback=None, kill_timeout=None, cgroup=None, stats=None):
+        """Unshare the namespaces and fork the init process of the new pid namespace.
+        Args:
+            new_net: Create a new network namespace.
+            keep_callback: Keep the namespaces alive after the command exited.
+                Called with the pid of the init process once it's ready.
+            kill_timeout: Kill the sandbox if it's still running this many
+                seconds after a termination signal was forwarded to it.
+            cgroup: CGroup of the sandbox, removed after it exited.
+            stats: Stats that are reported by the sandbox and written after it exited.
+        """
         unshare_flags = Libc.CLONE_NEWUSER | Libc.CLONE_NEWNS | Libc.CLONE_NEWPID | Libc.CLONE_NEWIPC
         if new_net:
             unshare_flags |= Libc.CLONE_NEWNET
 
         self._libc.unshare(unshare_flags)
+        Trace.mark("unshare")
 
         # Used to make sure process groups are in the right state before we try to
         # forward the controlling terminal.
         lock = PipeLock()
 
+        if keep_callback is not None:
+            keep_read_fd, self._keep_fd = os.pipe2(os.O_CLOEXEC)
+
         # Now that we're in the new pid namespace, fork.  The parent is the master
         # of it in the original namespace, so it only monitors the child inside it.
-        # It is only allowed to fork once too.
+        # It is only allowed to fork once too.  The signals are blocked before
+        # so none gets lost until the supervisors read them.
+        self._sigmask = Supervisor.block_signals()
+        self._stats = stats
         pid = os.fork()
         if pid != 0:
-            # Mask SIGINT with the assumption that the child will catch & process it.
-            # We'll pass that back up below.
-            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            if stats is not None:
+                stats.close_writer()
 
             # Forward the control of the terminal to the child so it can manage input.
             self.safeTcSetPgrp(sys.stdin.fileno(), pid)
@@ -156,46 +206,85 @@ class UserNs:
             lock.Post()
             del lock
 
-            status = self.reapChildren(pid)
+            if keep_callback is not None:
+                # the sandbox outlives us, signals only concern this process
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.pthread_sigmask(signal.SIG_SETMASK, self._sigmask)
+
+                os.close(self._keep_fd)
+                status = self.waitKept(keep_read_fd, pid, keep_callback)
+                if status is not None:
+                    # the namespaces stay alive, don't clean up
+                    self.exitAsStatus(status)
 
-            # Cleanup
-            self.umount(self._chroot_dir, Libc.MNT_DETACH)
-            os.rmdir(self._chroot_dir)
+            # The init process forwards the signals to the command, killing it
+            # kills the whole pid namespace.
+            status = Supervisor(pid, kill_timeout=kill_timeout).run()
+
+            if stats is not None:
+                stats.write(status)
+
+            # Cleanup, a staging root without directory disappears with the mount namespace
+            if self._chroot_dir is not None:
+                self.umount(self._chroot_dir, Libc.MNT_DETACH)
+                os.rmdir(self._chroot_dir)
+            if cgroup is not None:
+                cgroup.remove()
 
             self.exitAsStatus(status)
 
+        Trace.mark("fork_init")
+
+        if keep_callback is not None:
+            os.close(keep_read_fd)
+        else:
+            # kill the sandbox if the parent dies, e.g. the helper process of Api.spawn()
+            self._libc.prctl(Libc.PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0)
+
         self.setup_user_mapping()
         self.mount_private_propagation("/")
+        Trace.mark("user_mapping")
 
         if new_net:
             self.set_iface_lo_up()
+            Trace.mark("loopback")
 
         # Wait for our parent to finish initialization.
         lock.Wait()
         del lock
+        Trace.mark("wait_parent")
 
-    def run(self, command, cwd=os.getcwd()):
-        self._libc.chroot(self._chroot_dir)
-        os.chdir("/")
+    def run(self, command, cwd=None, launcher=None, env=None, seccomp=None):
+        """Args:
+            seccomp: Seccomp filter installed right before the exec (see Seccomp.compile_filter()).
+        """
+        if self._keep_fd is not None:
+            # a kept init process must not hold on to the stdio of the caller
+            devnull_fd = os.open(os.devnull, os.O_RDWR | os.O_CLOEXEC)
+
+        self._enter_staging_root()
+        if self._staging_fd is not None:
+            os.close(self._staging_fd)
+            self._staging_fd = None
+        Trace.mark("chroot")
 
         # Drop all effective, inheritable and permitted capabilities
         pcap = Pcap()
         pcap.clear()
         pcap.set_proc()
+        Trace.mark("drop_caps")
 
         # Resetup the locks for the next phase.
         lock = PipeLock()
 
         pid = os.fork()
         if pid != 0:
-            # Mask SIGINT with the assumption that the child will catch & process it.
-            # We'll pass that back up below.
-            signal.signal(signal.SIGINT, signal.SIG_IGN)
-
             # Now that we're in a new pid namespace, start a new process group so that
             # children have something valid to use.  Otherwise getpgrp/etc... will get
             # back 0 which tends to confuse -- you can't setpgrp(0) for example.
             os.setpgrp()
+            # the process group of the child has to exist before signals are forwarded to it
+            os.setpgid(pid, pid)
 
             # Forward the control of the terminal to the child so it can manage input.
             self.safeTcSetPgrp(sys.stdin.fileno(), pid)
@@ -204,18 +293,38 @@ class UserNs:
             lock.Post()
             del lock
 
+            if self._keep_fd is not None:
+                for fd in (sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()):
+                    os.dup2(devnull_fd, fd)
+                os.close(devnull_fd)
+
+                os.write(self._keep_fd, b"R")
+                self.reapKept(pid)
+
             # Watch all of the children.  We need to act as the master inside the
             # namespace and reap old processes.
-            self.exitAsStatus(self.reapChildren(pid))
+            status = Supervisor(pid, process_group=True, reap_orphans=True).run()
+            if self._stats is not None:
+                self._stats.report_usage(status)
+            self.exitAsStatus(status)
 
         # Wait for our parent to finish initialization.
         lock.Wait()
         del lock
+        Trace.mark("fork_command")
 
         # Create a process group for the grandchild so it can manage things
         # independent of the init process.
         os.setpgrp()
 
+        if launcher is not None:
+            # the sandbox is ready, wait for the command to run
+            command, cwd, env = launcher()
+            Trace.mark("launcher")
+
+        if cwd is None:
+            cwd = os.getcwd()
+
         # move cwd to new mounts
         try:
             os.chdir(cwd)
@@ -229,9 +338,160 @@ class UserNs:
         for sig_nr in range(1, signal.NSIG):
             if signal.getsignal(sig_nr) == signal.SIG_IGN:
                 signal.signal(sig_nr, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_SETMASK, self._sigmask)
+
+        Trace.mark("pre_exec")
+        Trace.emit()
+        if self._stats is not None:
+            self._stats.report_exec()
+        if seccomp is not None:
+            self.set_seccomp_filter(seccomp)
+
+        if env is None:
+            os.execvp(command[0], command)
+        else:
+            os.execvpe(command[0], command, env)
+
+    def attach(self, pid, ns_inodes, command, cwd):
+        """Run |command| in the namespaces and root directory of the process |pid|.
+        Args:
+            pid: The init process of a kept sandbox.
+            ns_inodes: Maps namespace names to their expected inode to make sure
+                |pid| wasn't reused by another process.
+        """
+        ns_types = [("user", Libc.CLONE_NEWUSER), ("mnt", Libc.CLONE_NEWNS), ("ipc", Libc.CLONE_NEWIPC),
+                    ("net", Libc.CLONE_NEWNET), ("pid", Libc.CLONE_NEWPID)]
+        ns_fds = []
+
+        for name, nstype in ns_types:
+            fd = os.open("/proc/{}/ns/{}".format(pid, name), os.O_RDONLY | os.O_CLOEXEC)
+            if os.fstat(fd).st_ino != ns_inodes[name]:
+                raise ProcessLookupError(errno.ESRCH, "The sandbox doesn't exist anymore.")
+            # entering our own namespace again fails for the namespaces owned by the initial user namespace
+            if os.stat("/proc/self/ns/" + name).st_ino != ns_inodes[name]:
+                ns_fds.append((fd, nstype))
+            else:
+                os.close(fd)
+
+        root_fd = os.open("/proc/{}/root".format(pid), os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+        # the user namespace comes first, it grants the capabilities for the others
+        for fd, nstype in ns_fds:
+            self._libc.setns(fd, nstype)
+            os.close(fd)
+
+        os.fchdir(root_fd)
+        self._libc.chroot(".")
+        os.close(root_fd)
+
+        pcap = Pcap()
+        pcap.clear()
+        pcap.set_proc()
+        self.set_no_new_privs()
+
+        lock = PipeLock()
+
+        # only children enter the pid namespace
+        self._sigmask = Supervisor.block_signals()
+        pid = os.fork()
+        if pid != 0:
+            # the process group has to exist before handing it the terminal
+            os.setpgid(pid, pid)
+            self.safeTcSetPgrp(sys.stdin.fileno(), pid)
+            lock.Post()
+            del lock
+            self.exitAsStatus(Supervisor(pid, process_group=True).run())
+
+        os.setpgrp()
+        lock.Wait()
+        del lock
+        signal.pthread_sigmask(signal.SIG_SETMASK, self._sigmask)
+
+        try:
+            os.chdir(cwd)
+        except FileNotFoundError:
+            print("The current working directory '{}' doesn't exist in the sandbox.\n"
+                  "Resetting to '/'.".format(cwd),
+                  file=sys.stderr)
+            os.chdir("/")
 
         os.execvp(command[0], command)
 
+    @staticmethod
+    def has_mount_api():
+        """Returns:
+            True if the kernel supports the new mount API up to mount_setattr() (5.12).
+        """
+        try:
+            # returns before looking at the fd when there are no attributes to change
+            Libc().mount_setattr(-1, "", 0)
+        except OSError as e:
+            return e.errno != errno.ENOSYS
+        return True
+
+    def mount_staging_root(self, mode):
+        """Mount a tmpfs for the root of the sandbox that has no mountpoint on the host.
+        It's stacked on top of "/" of the private mount namespace. Path lookups
+        start at the root of the process beneath it, so the host stays visible
+        until run() enters it. Needs has_mount_api().
+        Args:
+            mode: The octal mode of the root directory as string.
+        Returns:
+            The path of the tmpfs until then.
+        """
+        fs_fd = self._libc.fsopen("tmpfs")
+        try:
+            self._libc.fsconfig(fs_fd, Libc.FSCONFIG_SET_STRING, "mode", mode)
+            self._libc.fsconfig(fs_fd, Libc.FSCONFIG_CMD_CREATE)
+            # the same flags as mount_tmpfs()
+            self._staging_fd = self._libc.fsmount(fs_fd, attr_flags=Libc.MOUNT_ATTR_NOSUID | Libc.MOUNT_ATTR_NOATIME)
+        finally:
+            os.close(fs_fd)
+
+        # mount() refuses targets in a detached mount, so it's attached to the namespace
+        self._libc.move_mount(self._staging_fd, "", Libc.AT_FDCWD, "/", Libc.MOVE_MOUNT_F_EMPTY_PATH)
+
+        return "/proc/self/fd/{}".format(self._staging_fd)
+
+    def _enter_staging_root(self):
+        if self._staging_fd is not None:
+            os.fchdir(self._staging_fd)
+            self._libc.chroot(".")
+        else:
+            self._libc.chroot(self._chroot_dir)
+        os.chdir("/")
+
+    def call_in_staging_root(self, function, *args):
+        """Call |function| in a child process that has the staging root as root directory.
+        Paths resolve like in the sandbox, os.path.realpath() of a path
+        beneath the fd path of mount_staging_root() returns a host path.
+        Raises:
+            ChildProcessError if |function| failed, the child prints the traceback
+            unless |function| called sys.exit().
+        """
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._enter_staging_root()
+                function(*args)
+                status = 0
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+
+        (wpid, status) = os.waitpid(pid, 0)
+        if status != 0:
+            raise ChildProcessError("{}() failed in the staging root.".format(function.__name__))
+
+    def mount_setattr_ro(self, path):
+        """Make the mount |path| read-only, the other mount flags are kept."""
+        self._libc.mount_setattr(Libc.AT_FDCWD, path, 0, attr_set=Libc.MOUNT_ATTR_RDONLY)
+
     def mount_private_propagation(self, mountpoint):
         self._libc.mount("none", mountpoint, None, Libc.MS_REC | Libc.MS_PRIVATE)
 
@@ -254,12 +514,61 @@ class UserNs:
     def mount_bind(self, source, target):
         self._libc.mount(source, target, None, Libc.MS_REC | Libc.MS_BIND)
 
-    def mount_tmpfs(self, path, mode):
+    def mount_bind_ro(self, source, target):
+        """Bind |source| with all submounts read-only on |target|.
+        This needs a constant number of syscalls instead of a remount per submount.
+        Returns:
+            False if the kernel doesn't support the required syscalls (before 5.12).
+        """
+        if not self._has_mount_api:
+            return False
+
+        try:
+            fd = self._libc.open_tree(Libc.AT_FDCWD, source,
+                                      Libc.OPEN_TREE_CLONE | Libc.OPEN_TREE_CLOEXEC | Libc.AT_RECURSIVE)
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            self._has_mount_api = False
+            return False
+
+        try:
+            self._libc.mount_setattr(fd, "", Libc.AT_EMPTY_PATH | Libc.AT_RECURSIVE,
+                                     attr_set=Libc.MOUNT_ATTR_RDONLY)
+            self._libc.move_mount(fd, "", Libc.AT_FDCWD, target, Libc.MOVE_MOUNT_F_EMPTY_PATH)
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            self._has_mount_api = False
+            return False
+        finally:
+            os.close(fd)
+
+        return True
+
+    def mount_tmpfs(self, path, mode, options=None):
+        data = "mode=" + mode
+        if options:
+            data += "," + options
         self._libc.mount("tmpfs",
                          path,
                          "tmpfs",
                          Libc.MS_REC | Libc.MS_NOSUID | Libc.MS_NOATIME,
-                         "mode=" + mode)
+                         data)
+
+    def mount_overlay(self, lower, upper, work, target):
+        # backslashes escape the separators of the mount options and the lower directories
+        escape = lambda path: path.replace("\\", "\\\\").replace(",", "\\,").replace(":", "\\:")
+        data = "lowerdir={},upperdir={},workdir={}".format(escape(lower), escape(upper), escape(work))
+
+        try:
+            # store the overlay attributes in user.* xattrs, trusted.* needs CAP_SYS_ADMIN on the host
+            self._libc.mount("overlay", target, "overlay", 0, data + ",userxattr")
+        except OSError as e:
+            # kernels before 5.11 don't know the option (and don't allow overlays in user namespaces)
+            if e.errno != errno.EINVAL:
+                raise
+            self._libc.mount("overlay", target, "overlay", 0, data)
 
     def umount(self, path, flags=0):
         self._libc.umount2(path, flags)
@@ -284,15 +593,18 @@ class UserNs:
     def set_no_new_privs(self):
         self._libc.prctl(Libc.PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
 
+    def set_seccomp_filter(self, program):
+        """Needs set_no_new_privs(), unprivileged processes can't install filters otherwise."""
+        self._libc.set_seccomp_filter(program)
+
     def set_iface_lo_up(self):
+        # a SIOCSIFFLAGS ioctl is all that is needed, Linux automatically adds the IP addresses
+        # the socket module takes longer to import than the ioctls
+        sock = self._libc.socket(Libc.AF_INET, Libc.SOCK_DGRAM | Libc.SOCK_CLOEXEC)
         try:
-            import pyroute2
-        except ImportError:
-            print("Couldn't bring up the loopback interface for network. "
-                  "Install the pyroute2 python library.", file=sys.stderr)
-            return
-
-        ipr = pyroute2.IPRoute()
-        dev = ipr.link_lookup(ifname="lo")[0]
-        # Linux automatically adds the IP addresses
-        ipr.link("set", index=dev, state="up")
+            # struct ifreq is the interface name followed by a union that starts with the short ifr_flags
+            ifreq = self._libc.ioctl(sock, Libc.SIOCGIFFLAGS, struct.pack(Libc.IFREQ_FLAGS_FORMAT, b"lo", 0))
+            name, flags = struct.unpack(Libc.IFREQ_FLAGS_FORMAT, ifreq)
+            self._libc.ioctl(sock, Libc.SIOCSIFFLAGS, struct.pack(Libc.IFREQ_FLAGS_FORMAT, b"lo", flags | Libc.IFF_UP))
+        finally:
+            os.close(sock)
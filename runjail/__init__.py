@@ -12,3 +12,14 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# the library interface is imported on first use so the command line tool
+# doesn't pay for it
+_API_NAMES = ("spawn", "spawn_async", "make_options", "Process", "AsyncProcess", "PIPE", "DEVNULL")
+
+
+def __getattr__(name):
+    if name in _API_NAMES:
+        from runjail import Api
+        return getattr(Api, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
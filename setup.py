@@ -26,6 +26,7 @@ setup(
     author_email="debfx@fobos.de",
     license="GPL-3",
     packages=["runjail"],
+    python_requires=">=3.7",
     entry_points={
         "console_scripts": [
             "runjail = runjail.Main:main",
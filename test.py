@@ -15,10 +15,33 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import errno
+import json
 import os
+import select
+import signal
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
 import unittest
+import unittest.mock
+
+import runjail
+from runjail import Seccomp
+from runjail.CGroup import CGroup
+from runjail.HideGlob import HideGlob
+from runjail.Libc import Libc
+from runjail.MountInfo import MountInfo
+from runjail.MountPlan import MountPlan, MountPlanCache
+from runjail.NamedSandbox import NamedSandbox
+from runjail.PathTrie import PathTrie
+from runjail.Runjail import Options, Runjail
+from runjail.Supervisor import Supervisor
+from runjail.UserNs import UserNs
 
 
 class RunjailTest(unittest.TestCase):
@@ -36,11 +59,21 @@ class RunjailTest(unittest.TestCase):
             data = f.read().strip("\r\n\t ")
         self.assertEqual(data, "RWTESTDATA")
 
+    def test_overlay_write(self):
+        self.assertEqual(self.run_helper(["--overlay=tests/data/ro"], "overlay_write"), "OVERLAYDATAROTESTDATA")
+        # the write only went to the tmpfs of the overlay
+        self.assertFalse(os.path.exists("tests/data/ro/write_test"))
+
     def test_hide_read(self):
         with self.assertRaises(subprocess.CalledProcessError) as cm:
             self.run_helper(["--hide=tests/data/hide"], "hide_read")
         self.assertEqual(cm.exception.returncode, 3)
 
+    def test_hide_glob_read(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.run_helper(["--hide-glob=tests/data/h*/*file"], "hide_read")
+        self.assertEqual(cm.exception.returncode, 3)
+
     def test_hide_write(self):
         with self.assertRaises(subprocess.CalledProcessError) as cm:
             self.run_helper(["--hide=tests/data/hide"], "hide_write")
@@ -51,6 +84,23 @@ class RunjailTest(unittest.TestCase):
             self.run_helper(["--empty=tests/data/empty"], "empty_read")
         self.assertEqual(cm.exception.returncode, 3)
 
+    def test_empty_seed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with tarfile.open(tmp_dir + "/seed.tar.gz", "w:gz") as tar:
+                tar.add("tests/data/empty/emptyfile", "emptyfile")
+            self.run_helper(["--empty=tests/data/empty", "--seed=" + tmp_dir + "/seed.tar.gz"], "empty_read")
+
+    def test_empty_seed_invalid(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(tmp_dir + "/seed.tar", "w") as f:
+                f.write("no tar archive")
+            result = subprocess.run(["bin/runjail", "--empty=tests/data/empty", "--seed=" + tmp_dir + "/seed.tar",
+                                     "--", "true"],
+                                    stderr=subprocess.PIPE, universal_newlines=True, env=self.get_env())
+        self.assertEqual(result.returncode, 1)
+        self.assertTrue(result.stderr.startswith("Couldn't extract the seed archive"), result.stderr)
+        self.assertNotIn("Traceback", result.stderr)
+
     def test_empty_write(self):
         self.run_helper(["--empty=tests/data/empty"], "empty_write")
 
@@ -72,6 +122,253 @@ class RunjailTest(unittest.TestCase):
         for ip in ips:
             self.assertIn(ip, ("127.0.0.1", "::1"))
 
+    def test_mounts_deduplicated(self):
+        read_fd, write_fd = os.pipe()
+        # the bind of data/ro repeats the one of data
+        full_cmd = ["bin/runjail", "--trace-timing", "--trace-fd={}".format(write_fd),
+                    "--ro=tests/data", "--ro=tests/data/ro", "--cwd=tests/data", "--", "cat", "ro/rofile"]
+        try:
+            output = subprocess.check_output(full_cmd, env=self.get_env(), pass_fds=(write_fd,), universal_newlines=True)
+        finally:
+            os.close(write_fd)
+
+        with os.fdopen(read_fd) as f:
+            record = json.loads(f.readline())
+
+        self.assertEqual(output.strip(), "ROTESTDATA")
+        self.assertGreater(record["counters"]["saved_syscalls"], 0)
+
+    def test_invalid_mounts(self):
+        for args in (["--ro=tests/data", "--rw=tests/data"],
+                     ["--hide=tests/data", "--ro=tests/data/ro"]):
+            result = subprocess.run(["bin/runjail"] + args + ["--", "true"], env=self.get_env(),
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            self.assertEqual(result.returncode, 1)
+            self.assertIn(os.path.realpath("tests/data"), result.stderr)
+
+    def test_plan_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            env = {"XDG_CACHE_HOME": cache_dir}
+            self.assertEqual(self.run_helper(["--ro=tests/data/ro"], "ro_read", env), "ROTESTDATA")
+            plans = [name for name in os.listdir(cache_dir + "/runjail") if name.endswith(".json")]
+            self.assertEqual(len(plans), 1)
+            # second launch is served from the cache
+            self.assertEqual(self.run_helper(["--ro=tests/data/ro"], "ro_read", env), "ROTESTDATA")
+            self.assertEqual([name for name in os.listdir(cache_dir + "/runjail") if name.endswith(".json")], plans)
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = {"XDG_CACHE_HOME": tmp_dir + "/cache", "XDG_CONFIG_HOME": tmp_dir + "/config"}
+            os.makedirs(tmp_dir + "/config/runjail")
+            with open(tmp_dir + "/config/runjail/test.json", "w") as f:
+                json.dump({"hide": [os.path.realpath("tests/data/hide")]}, f)
+
+            for i in range(2):
+                with self.assertRaises(subprocess.CalledProcessError):
+                    self.run_helper(["--profile=test"], "hide_read", env)
+            self.assertTrue(os.path.exists(tmp_dir + "/cache/runjail/profiles/test.marshal"))
+
+            # changes of the profile invalidate the cache
+            with open(tmp_dir + "/config/runjail/test.json", "w") as f:
+                json.dump({"ro": [os.path.realpath("tests/data/hide")]}, f)
+            os.utime(tmp_dir + "/config/runjail/test.json", ns=(0, 0))
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.run_helper(["--profile=test"], "hide_write", env)
+            self.run_helper(["--profile=test"], "hide_read", env)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(tmp_dir + "/jobs.jsonl", "w") as f:
+                f.write(json.dumps({"id": "env", "argv": ["sh", "-c", "echo $RUNJAIL_TEST"],
+                                    "env": {"RUNJAIL_TEST": "batch"}}) + "\n")
+                f.write(json.dumps({"id": "ro", "argv": ["cat", "data/ro/rofile"], "cwd": os.path.realpath("tests"),
+                                    "ro": ["tests/data/ro"]}) + "\n")
+                f.write(json.dumps({"id": "fail", "argv": ["sh", "-c", "exit 3"]}) + "\n")
+
+            result = subprocess.run(["bin/runjail", "--batch", tmp_dir + "/jobs.jsonl", "-j", "2",
+                                     "--batch-output", tmp_dir + "/out", "--batch-summary", tmp_dir + "/summary.json",
+                                     "--cwd=/"],
+                                    env=self.get_env())
+            self.assertEqual(result.returncode, 1)
+
+            with open(tmp_dir + "/out/env.out") as f:
+                self.assertEqual(f.read(), "batch\n")
+            with open(tmp_dir + "/out/ro.out") as f:
+                self.assertEqual(f.read().strip(), "ROTESTDATA")
+            with open(tmp_dir + "/summary.json") as f:
+                summary = json.load(f)
+
+        self.assertEqual([job["exit_code"] for job in summary["jobs"]], [0, 0, 3])
+        self.assertEqual(summary["failed"], 1)
+
+    def test_server(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            socket_path = tmp_dir + "/runjail.sock"
+            server_cmd = ["bin/runjail", "--server=" + socket_path, "--pool-size=1", "--ro=tests"]
+            server = subprocess.Popen(server_cmd + self.get_python_args(), env=self.get_env())
+            try:
+                for i in range(100):
+                    if os.path.exists(socket_path):
+                        break
+                    time.sleep(0.1)
+
+                client_cmd = ["../bin/runjail", "--connect=" + socket_path, "--"]
+                for i in range(2):
+                    result = subprocess.check_output(client_cmd + ["./helper.py", "ro_read"], cwd="tests",
+                                                     universal_newlines=True, env=self.get_env())
+                    self.assertIn("ROTESTDATA", result)
+
+                result = subprocess.check_output(["../bin/runjail", "--connect=" + socket_path, "--cwd=data/ro",
+                                                  "--", "cat", "rofile"], cwd="tests",
+                                                 universal_newlines=True, env=self.get_env())
+                self.assertEqual(result, "ROTESTDATA\n")
+
+                with self.assertRaises(subprocess.CalledProcessError) as cm:
+                    subprocess.check_output(client_cmd + ["./helper.py", "ro_write"], cwd="tests",
+                                            env=self.get_env())
+                self.assertEqual(cm.exception.returncode, 3)
+            finally:
+                server.terminate()
+                server.wait()
+
+    def test_server_respawn(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            socket_path = tmp_dir + "/runjail.sock"
+            server_cmd = ["bin/runjail", "--server=" + socket_path, "--pool-size=1", "--ro=tests"]
+            server = subprocess.Popen(server_cmd + self.get_python_args(), stderr=subprocess.PIPE,
+                                      universal_newlines=True, env=self.get_env())
+            try:
+                children_path = "/proc/{0}/task/{0}/children".format(server.pid)
+                for i in range(100):
+                    with open(children_path) as f:
+                        children = f.read().split()
+                    if children and os.path.exists(socket_path):
+                        break
+                    time.sleep(0.1)
+
+                # a parked sandbox that dies is replaced
+                os.kill(int(children[0]), signal.SIGKILL)
+
+                client_cmd = ["../bin/runjail", "--connect=" + socket_path, "--"]
+                result = subprocess.check_output(client_cmd + ["./helper.py", "ro_read"], cwd="tests",
+                                                 universal_newlines=True, env=self.get_env())
+                self.assertIn("ROTESTDATA", result)
+            finally:
+                server.terminate()
+                stdout, stderr = server.communicate()
+            self.assertIn("before it was launched", stderr)
+
+    def test_trace_timing(self):
+        read_fd, write_fd = os.pipe()
+        full_cmd = ["bin/runjail", "--trace-timing", "--trace-fd={}".format(write_fd)] + self.get_python_args()
+        full_cmd += ["--ro=tests", "--cwd=tests", "--", "./helper.py", "ro_read"]
+        try:
+            subprocess.check_output(full_cmd, env=self.get_env(), pass_fds=(write_fd,))
+        finally:
+            os.close(write_fd)
+
+        with os.fdopen(read_fd) as f:
+            record = json.loads(f.readline())
+
+        phases = [phase for phase, duration in record["phases"]]
+        self.assertEqual(phases[0], "parse_args")
+        self.assertIn("unshare", phases)
+        self.assertIn("mounts", phases)
+        self.assertEqual(phases[-1], "pre_exec")
+        self.assertGreater(record["counters"]["mount"], 0)
+
+        # the flag doesn't take the command as its value, the record goes to stderr
+        result = subprocess.run(["bin/runjail", "--trace-timing", "--cwd=/", "true"], stderr=subprocess.PIPE,
+                                universal_newlines=True, env=self.get_env())
+        self.assertEqual(result.returncode, 0)
+        self.assertIn("phases", json.loads(result.stderr.splitlines()[-1]))
+
+    def test_stats(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.run_helper(["--stats=" + tmp_dir + "/stats.json"], "ro_read")
+            with open(tmp_dir + "/stats.json") as f:
+                stats = json.load(f)
+
+        self.assertEqual(stats["exit_code"], 0)
+        self.assertIsNone(stats["signal"])
+        self.assertLess(stats["setup_time"], stats["wall_time"])
+        self.assertGreater(stats["user_cpu_time"] + stats["system_cpu_time"], 0)
+        self.assertGreater(stats["max_rss_kb"], 0)
+
+    def test_tmpfs_options(self):
+        self.assertEqual(Runjail.split_tmpfs_spec("/tmp:size=1M,huge=within_size"),
+                         ("/tmp", {"size": "1M", "huge": "within_size"}))
+        self.assertEqual(Runjail.split_tmpfs_spec("/a:b"), ("/a:b", {}))
+        with self.assertRaises(ValueError):
+            Runjail.split_tmpfs_spec("/tmp:size=1Q")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.run_helper(["--empty=tests/data/empty:size=1M", "--tmpfs-options=nr_inodes=100",
+                             "--stats=" + tmp_dir + "/stats.json"], "empty_write")
+            with open(tmp_dir + "/stats.json") as f:
+                usage = json.load(f)["tmpfs"][os.path.abspath("tests/data/empty")]
+
+        self.assertEqual(usage["size_bytes"], 1024 * 1024)
+        self.assertEqual(usage["inodes"], 100)
+        self.assertEqual(usage["used_inodes"], 2)
+
+    def test_forward_signal(self):
+        with subprocess.Popen(["bin/runjail", "--cwd=/", "--", "sh", "-c", "trap 'exit 7' TERM; echo ready; while true; do sleep 0.1; done"],
+                              stdout=subprocess.PIPE, env=self.get_env()) as process:
+            self.assertEqual(process.stdout.readline(), b"ready\n")
+            process.send_signal(signal.SIGTERM)
+            self.assertEqual(process.wait(10), 7)
+
+    def test_kill_timeout(self):
+        with subprocess.Popen(["bin/runjail", "--kill-timeout=0.2", "--cwd=/", "--", "sh", "-c", "trap '' TERM; echo ready; sleep 30"],
+                              stdout=subprocess.PIPE, env=self.get_env()) as process:
+            self.assertEqual(process.stdout.readline(), b"ready\n")
+            process.send_signal(signal.SIGTERM)
+            self.assertEqual(process.wait(10), -signal.SIGKILL)
+
+    def test_seccomp(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(tmp_dir + "/runjail/seccomp")
+            with open(tmp_dir + "/runjail/seccomp/test.json", "w") as f:
+                json.dump({"deny": ["mkdir", "mkdirat"]}, f)
+
+            output = subprocess.check_output(["bin/runjail", "--seccomp=test", "--cwd=/tmp", "--",
+                                              "sh", "-c", "mkdir a 2>/dev/null || echo denied; touch b && echo allowed"],
+                                             universal_newlines=True,
+                                             env=self.get_env({"XDG_CONFIG_HOME": tmp_dir,
+                                                               "XDG_CACHE_HOME": tmp_dir + "/cache"}))
+        self.assertEqual(output, "denied\nallowed\n")
+
+    @unittest.skipUnless(UserNs.has_mount_api(), "needs Linux 5.12")
+    def test_staging_root(self):
+        get_staging_dirs = lambda: set(name for name in os.listdir(tempfile.gettempdir()) if name.startswith("runjail"))
+        staging_dirs = get_staging_dirs()
+        self.run_helper(["--empty=tests/data/empty"], "empty_write")
+        self.assertEqual(get_staging_dirs(), staging_dirs)
+
+        # the staging root is the only tmpfs at "/" and can't be written beneath it
+        output = subprocess.check_output(["bin/runjail", "--cwd=/", "--", "sh", "-c",
+                                          "cat /proc/self/mountinfo; touch /../x 2>/dev/null || echo denied"],
+                                         universal_newlines=True, env=self.get_env())
+        lines = output.splitlines()
+        self.assertEqual([line.split()[4] for line in lines[:-1]].count("/"), 1)
+        self.assertEqual(lines[-1], "denied")
+
+    def test_keep_attach(self):
+        with tempfile.TemporaryDirectory() as runtime_dir:
+            env = self.get_env({"XDG_RUNTIME_DIR": runtime_dir})
+            self.run_helper(["--name=test", "--keep", "--empty=tests/data/empty"], "empty_write", env)
+            try:
+                # the tmpfs written to by the first command is still mounted
+                subprocess.check_call(["bin/runjail", "--attach=test", "--cwd=tests", "--",
+                                       "test", "-e", "data/empty/write_test"], env=env)
+            finally:
+                subprocess.check_call(["bin/runjail", "--destroy=test"], env=env)
+
+            with self.assertRaises(subprocess.CalledProcessError):
+                subprocess.check_call(["bin/runjail", "--attach=test", "--", "true"],
+                                      env=env, stderr=subprocess.DEVNULL)
+
     @classmethod
     def tearDownClass(cls):
         RunjailTest.try_remove("tests/data/rw/write_test")
@@ -81,9 +378,8 @@ class RunjailTest(unittest.TestCase):
         if os.path.exists(path):
             os.remove(path)
 
-    def run_helper(self, args, cmd):
-        full_cmd =  ["bin/runjail"]
-        full_cmd += args
+    def get_python_args(self):
+        args = []
         # allow read only access to python binary and modules
         python_paths = sys.path.copy()
         try:
@@ -96,17 +392,391 @@ class RunjailTest(unittest.TestCase):
             pass
         for path in python_paths:
             if not path.startswith("/usr") and path not in ("", os.getcwd()) and os.path.exists(path):
-                full_cmd.append("--ro=" + path)
-        full_cmd += ["--ro=tests", "--cwd=tests", "--", "./helper.py", cmd]
+                args.append("--ro=" + path)
+        return args
 
+    def get_env(self, extra_env=None):
         env = os.environ.copy()
         env["PYTHONPATH"] = ":".join(sys.path)
+        if extra_env:
+            env.update(extra_env)
+        return env
+
+    def run_helper(self, args, cmd, extra_env=None):
+        full_cmd =  ["bin/runjail"]
+        full_cmd += args
+        full_cmd += self.get_python_args()
+        full_cmd += ["--ro=tests", "--cwd=tests", "--", "./helper.py", cmd]
 
-        result = subprocess.check_output(full_cmd, universal_newlines=True, env=env)
+        result = subprocess.check_output(full_cmd, universal_newlines=True, env=self.get_env(extra_env))
 
         return result.strip("\r\n\t ")
 
 
+class StartupTest(unittest.TestCase):
+    # cumulative import time of runjail.Main in microseconds, argparse alone takes about half of it
+    IMPORT_TIME_BUDGET = 30000
+    # modules that must not be loaded for --help
+    LAZY_MODULES = ("ctypes", "ctypes.util", "tempfile", "subprocess", "hashlib", "pyroute2", "runjail.Runjail")
+
+    def get_import_times(self, args):
+        env = os.environ.copy()
+        env.pop("PYTHONDONTWRITEBYTECODE", None)
+        # the first run compiles the modules
+        for i in range(2):
+            result = subprocess.run([sys.executable, "-X", "importtime", "bin/runjail"] + args, env=env,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+
+        import_times = {}
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and not line.endswith("package"):
+                self_time, cumulative, name = line[len("import time:"):].split("|")
+                import_times[name.strip()] = int(cumulative)
+        return import_times
+
+    def test_help_import_time(self):
+        import_times = self.get_import_times(["--help"])
+        for module in StartupTest.LAZY_MODULES:
+            self.assertNotIn(module, import_times)
+        self.assertLess(import_times["runjail.Main"], StartupTest.IMPORT_TIME_BUDGET)
+
+
+class MountInfoTest(unittest.TestCase):
+    MOUNTINFO = ("1 0 254:0 / / rw,relatime shared:1 - ext4 /dev/vda rw\n"
+                 "2 1 0:20 / /srv/with\\040space ro,nosuid shared:2 master:1 - tmpfs tmp\\134fs rw,size=10k\n"
+                 "3 2 0:21 / /srv/with\\040space/sub rw,noexec - tmpfs tmpfs rw\n"
+                 "4 1 0:22 / /srv0 rw - tmpfs tmpfs rw\n")
+
+    def setUp(self):
+        f = tempfile.NamedTemporaryFile("w", prefix="mountinfo", delete=False)
+        with f:
+            f.write(MountInfoTest.MOUNTINFO)
+        self.addCleanup(os.remove, f.name)
+        self.mount_info = MountInfo(filename=f.name)
+
+    def test_parse(self):
+        entry = self.mount_info.get_mountpoint("/srv/with space")
+        self.assertEqual(entry.mount_id, 2)
+        self.assertEqual(entry.parent_id, 1)
+        self.assertEqual(entry.mount_source, "tmp\\fs")
+        self.assertEqual(entry.optional_fields, ["shared:2", "master:1"])
+        self.assertEqual(entry.super_options, "rw,size=10k")
+        self.assertEqual(entry.get_mount_flags(), Libc.MS_RDONLY | Libc.MS_NOSUID)
+
+    def test_index(self):
+        self.assertEqual([entry.mount_point for entry in self.mount_info.get_mounts_under("/srv")],
+                         ["/srv/with space", "/srv/with space/sub"])
+        self.assertEqual([entry.mount_id for entry in self.mount_info.get_subtree(2)], [2, 3])
+        self.assertEqual([entry.mount_id for entry in self.mount_info.get_children(1)], [2, 4])
+
+
+class MountPlanCacheTest(unittest.TestCase):
+    def test_key(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = tmp_dir + "/mount"
+            options = Options(ro=[path], rw=[], hide=[], empty=[], emptyro=[], symlink={}, cwd="/", nonet=False)
+            open(path, "w").close()
+            file_key = MountPlanCache.get_key(options)
+            self.assertEqual(MountPlanCache.get_key(options), file_key)
+
+            # a directory needs another bind target
+            os.remove(path)
+            os.mkdir(path)
+            dir_key = MountPlanCache.get_key(options)
+            self.assertNotEqual(dir_key, file_key)
+
+            os.rmdir(path)
+            os.symlink("/usr", path)
+            self.assertNotEqual(MountPlanCache.get_key(options), dir_key)
+
+    def test_prune(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = MountPlanCache(tmp_dir)
+            for i in range(MountPlanCache.MAX_PLANS + 2):
+                cache.store(str(i), MountPlan())
+                os.utime(tmp_dir + "/{}.json".format(i), ns=(i, i))
+
+            self.assertEqual(len(os.listdir(tmp_dir)), MountPlanCache.MAX_PLANS)
+            self.assertIsNone(cache.load("1"))
+            self.assertIsNotNone(cache.load(str(MountPlanCache.MAX_PLANS + 1)))
+
+
+class ApiTest(unittest.TestCase):
+    def setUp(self):
+        self.options = runjail.make_options(ro=["tests"], cwd="tests")
+
+    def test_spawn(self):
+        mnt_ns = os.readlink("/proc/self/ns/mnt")
+        with runjail.spawn(self.options, ["sh", "-c", "cat data/ro/rofile; exit 5"], stdout=runjail.PIPE) as process:
+            self.assertEqual(process.stdout.read().strip(), b"ROTESTDATA")
+        self.assertEqual(process.returncode, 5)
+        # the namespaces of the caller are untouched
+        self.assertEqual(os.readlink("/proc/self/ns/mnt"), mnt_ns)
+
+    def test_stdin(self):
+        with runjail.spawn(self.options, ["cat"], stdin=runjail.PIPE, stdout=runjail.PIPE) as process:
+            process.stdin.write(b"input")
+            process.stdin.close()
+            self.assertEqual(process.stdout.read(), b"input")
+            self.assertEqual(process.wait(10), 0)
+
+    def test_terminate(self):
+        process = runjail.spawn(self.options, ["sleep", "60"])
+        with self.assertRaises(subprocess.TimeoutExpired):
+            process.wait(0.1)
+        process.terminate()
+        # forwarded to the command, the init process of the sandbox exits like a shell
+        self.assertEqual(process.wait(10), 128 + signal.SIGTERM)
+
+    def test_spawn_async(self):
+        async def run():
+            process = await runjail.spawn_async(self.options, ["sh", "-c", "exit 4"])
+            return await process.wait()
+
+        self.assertEqual(asyncio.run(run()), 4)
+
+
+class PathTrieTest(unittest.TestCase):
+    def setUp(self):
+        self.trie = PathTrie()
+        for path in ("/usr/lib", "/usr", "/a-b", "/a/b/c", "/"):
+            self.trie[path] = path
+
+    def test_lookup(self):
+        self.assertEqual(len(self.trie), 5)
+        self.assertIn("/usr/lib", self.trie)
+        self.assertNotIn("/a/b", self.trie)
+        self.assertEqual(self.trie.pop("/usr"), "/usr")
+        self.assertNotIn("/usr", self.trie)
+        self.assertEqual(len(self.trie), 4)
+
+    def test_find_ancestor(self):
+        self.assertEqual(self.trie.find_ancestor("/usr/lib/x"), ("/usr/lib", "/usr/lib"))
+        self.assertEqual(self.trie.find_ancestor("/usr/lib"), ("/usr", "/usr"))
+        self.assertEqual(self.trie.find_ancestor("/usr/lib", lambda value: value == "/"), ("/", "/"))
+        self.assertEqual(self.trie.find_ancestor("/"), None)
+
+    def test_items(self):
+        self.assertEqual([path for path, value in self.trie.items()],
+                         ["/", "/a/b/c", "/a-b", "/usr", "/usr/lib"])
+
+
+class CGroupTest(unittest.TestCase):
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_plain_directory(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(root + "/origin")
+            # created by the kernel in a real cgroup
+            open(root + "/origin/cgroup.procs", "w").close()
+            cgroup = CGroup(root, {"memory.max": "2G", "pids.max": "64"})
+            cgroup.create()
+            path = cgroup.get_path()
+            self.assertEqual(os.path.dirname(path), root)
+            self.assertEqual(self.read(root + "/cgroup.subtree_control"), "+memory +pids")
+            self.assertEqual(self.read(path + "/memory.max"), "2G")
+            self.assertEqual(self.read(path + "/pids.max"), "64")
+
+            cgroup.enter(return_path=root + "/origin")
+            self.assertEqual(self.read(path + "/cgroup.procs"), str(os.getpid()))
+            cgroup.remove()
+            self.assertEqual(self.read(root + "/origin/cgroup.procs"), str(os.getpid()))
+
+
+class NamedSandboxTest(unittest.TestCase):
+    def test_fallback_state_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, unittest.mock.patch.dict(os.environ):
+            os.environ.pop("XDG_RUNTIME_DIR", None)
+            state_dir = tmp_dir + "/runjail-{}".format(os.getuid())
+            with unittest.mock.patch.object(NamedSandbox, "FALLBACK_STATE_DIR", tmp_dir + "/runjail-{uid}"):
+                self.assertEqual(NamedSandbox.get_state_dir(), state_dir)
+                self.assertEqual(os.stat(state_dir).st_mode & 0o777, 0o700)
+
+                os.chmod(state_dir, 0o755)
+                with self.assertRaises(ValueError):
+                    NamedSandbox.get_state_dir()
+
+                os.rmdir(state_dir)
+                os.symlink(tmp_dir, state_dir)
+                with self.assertRaises(ValueError):
+                    NamedSandbox.get_state_dir()
+
+
+class HideGlobTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name + "/root"
+        for path in ("a/x.pem", "a/b/y.pem", "a/b/.env", "c/.env", "c/d/z.txt"):
+            os.makedirs(os.path.dirname(os.path.join(self.root, path)), exist_ok=True)
+            open(os.path.join(self.root, path), "w").close()
+        os.symlink("/etc/passwd", self.root + "/a/link.pem")
+        os.makedirs(self.root + "/dir.pem/sub")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def expand(self, pattern, cache_dir=None):
+        return [path[len(self.root):] for path in HideGlob(self.root + pattern, cache_dir).expand()]
+
+    def test_expand(self):
+        self.assertEqual(self.expand("/**/*.pem"), ["/a/b/y.pem", "/a/x.pem", "/dir.pem"])
+        self.assertEqual(self.expand("/**/.env"), ["/a/b/.env", "/c/.env"])
+        self.assertEqual(self.expand("/*/b"), ["/a/b"])
+        self.assertEqual(self.expand("/c"), ["/c"])
+        self.assertEqual(self.expand("/missing/**"), [])
+
+    def test_cache(self):
+        cache_dir = self.tmp_dir.name + "/cache"
+        self.assertEqual(self.expand("/**/.env", cache_dir), ["/a/b/.env", "/c/.env"])
+        # adding an entry changes the mtime of the directory
+        open(self.root + "/c/d/.env", "w").close()
+        self.assertEqual(self.expand("/**/.env", cache_dir), ["/a/b/.env", "/c/.env", "/c/d/.env"])
+
+
+class SeccompTest(unittest.TestCase):
+    def run_filter(self, program, nr, arch=Seccomp.AUDIT_ARCHES["x86_64"]):
+        """Interpret the instructions that compile_filter() emits."""
+        data = struct.pack("=II", nr, arch)
+        pc = 0
+        while True:
+            code, jt, jf, k = struct.unpack_from(Seccomp.SOCK_FILTER_FORMAT, program, pc * 8)
+            pc += 1
+            if code == Seccomp.BPF_LD_W_ABS:
+                a = struct.unpack_from("=I", data, k)[0]
+            elif code == Seccomp.BPF_JMP_JEQ_K:
+                pc += jt if a == k else jf
+            elif code == Seccomp.BPF_JMP_JGE_K:
+                pc += jt if a >= k else jf
+            elif code == Seccomp.BPF_JMP_JA:
+                pc += k
+            else:
+                self.assertEqual(code, Seccomp.BPF_RET_K)
+                return k
+
+    def test_compile(self):
+        deny = Seccomp.SECCOMP_RET_ERRNO | errno.EPERM
+        # every other syscall, the jumps over the lower halves don't fit into 8 bits
+        actions = { nr: Seccomp.SECCOMP_RET_ALLOW for nr in range(0, 460, 2) }
+        actions[101] = Seccomp.SECCOMP_RET_KILL_PROCESS
+        program = Seccomp.compile_filter(actions, deny, "x86_64")
+
+        for nr in range(470):
+            self.assertEqual(self.run_filter(program, nr), actions.get(nr, deny))
+        self.assertEqual(self.run_filter(program, Seccomp.X32_SYSCALL_BIT | 2), Seccomp.SECCOMP_RET_ERRNO | errno.ENOSYS)
+        self.assertEqual(self.run_filter(program, 2, arch=0x40000003), Seccomp.SECCOMP_RET_KILL_PROCESS)
+
+    def test_profile(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with unittest.mock.patch.dict(os.environ, {"XDG_CONFIG_HOME": tmp_dir}):
+                os.makedirs(tmp_dir + "/runjail/seccomp")
+                with open(tmp_dir + "/runjail/seccomp/test.json", "w") as f:
+                    json.dump({"deny": ["mkdir", "mkdirat"], "errno": "EACCES"}, f)
+
+                program = Seccomp.SeccompProfile("test").load(tmp_dir + "/cache")
+                self.assertTrue(os.path.exists(tmp_dir + "/cache/seccomp/test.marshal"))
+                self.assertEqual(Seccomp.SeccompProfile("test").load(tmp_dir + "/cache"), program)
+
+                # a profile of the same name and mtime in another config directory isn't served from the cache
+                os.makedirs(tmp_dir + "/other/runjail/seccomp")
+                with open(tmp_dir + "/other/runjail/seccomp/test.json", "w") as f:
+                    json.dump({"deny": ["mkdir", "mkdirat"]}, f)
+                mtime = os.stat(tmp_dir + "/runjail/seccomp/test.json").st_mtime_ns
+                os.utime(tmp_dir + "/other/runjail/seccomp/test.json", ns=(mtime, mtime))
+                with unittest.mock.patch.dict(os.environ, {"XDG_CONFIG_HOME": tmp_dir + "/other"}):
+                    self.assertNotEqual(Seccomp.SeccompProfile("test").load(tmp_dir + "/cache"), program)
+
+                # names of other architectures are skipped
+                self.assertEqual(Seccomp.SeccompProfile("test").compile("aarch64"),
+                                 Seccomp.compile_filter({34: Seccomp.SECCOMP_RET_ERRNO | errno.EACCES},
+                                                        Seccomp.SECCOMP_RET_ALLOW, "aarch64"))
+
+                with open(tmp_dir + "/runjail/seccomp/test.json", "w") as f:
+                    json.dump({"deny": ["mkdirr"]}, f)
+                with self.assertRaises(ValueError):
+                    Seccomp.SeccompProfile("test").compile("x86_64")
+
+
+class SeedTest(unittest.TestCase):
+    def test_data_filter(self):
+        from runjail import Seed
+
+        member = tarfile.TarInfo("dir/file")
+        member.mode = 0o4777
+        Seed._data_filter(member)
+        self.assertEqual(member.mode, 0o755)
+
+        for name, type, linkname in (("/file", tarfile.REGTYPE, ""),
+                                     ("dir/../../file", tarfile.REGTYPE, ""),
+                                     ("dev", tarfile.CHRTYPE, ""),
+                                     ("dir/link", tarfile.SYMTYPE, "../../file"),
+                                     ("link", tarfile.LNKTYPE, "/file")):
+            member = tarfile.TarInfo(name)
+            member.type = type
+            member.linkname = linkname
+            with self.assertRaises(ValueError):
+                Seed._data_filter(member)
+
+
+class SupervisorTest(unittest.TestCase):
+    def run_supervisor(self, ignore_term=False, **kwargs):
+        sigmask = Supervisor.block_signals()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                if ignore_term:
+                    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                signal.pthread_sigmask(signal.SIG_SETMASK, sigmask)
+                time.sleep(10)
+                os._exit(0)
+            supervisor = Supervisor(pid, **kwargs)
+            # pending until the supervisor waits for it
+            os.kill(os.getpid(), signal.SIGTERM)
+            return supervisor.run()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, sigmask)
+
+    def test_forward(self):
+        status = self.run_supervisor()
+        self.assertEqual(os.WTERMSIG(status), signal.SIGTERM)
+
+    def test_sigwait_fallback(self):
+        enosys = OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        with unittest.mock.patch.object(Libc, "pidfd_open", side_effect=enosys):
+            status = self.run_supervisor()
+            self.assertEqual(os.WTERMSIG(status), signal.SIGTERM)
+
+            status = self.run_supervisor(ignore_term=True, kill_timeout=0.2)
+            self.assertEqual(os.WTERMSIG(status), signal.SIGKILL)
+
+
+class LibcTest(unittest.TestCase):
+    def test_errno(self):
+        with self.assertRaises(OSError) as cm:
+            Libc().mount(None, "/nonexistent/runjail", None, Libc.MS_PRIVATE)
+        self.assertIn(cm.exception.errno, (errno.ENOENT, errno.EPERM))
+
+    def test_clone3_pidfd(self):
+        libc = Libc()
+        try:
+            pid, pidfd = libc.clone3(Libc.CLONE_PIDFD)
+        except OSError as e:
+            if e.errno == errno.ENOSYS:
+                self.skipTest("clone3 is not supported by the kernel.")
+            raise
+        if pid == 0:
+            os._exit(3)
+
+        try:
+            # the pidfd becomes readable once the child exited
+            readable, writable, exceptional = select.select([pidfd], [], [], 10)
+            self.assertEqual(readable, [pidfd])
+            self.assertEqual(os.waitpid(pid, 0), (pid, 3 << 8))
+        finally:
+            os.close(pidfd)
+
+
 if __name__ == '__main__':
     dirname = os.path.dirname(__file__)
     if dirname:
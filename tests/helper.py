@@ -27,6 +27,11 @@ def helper_ro_write():
     open("data/ro/write_test", "w")
 
 
+def helper_overlay_write():
+    open("data/ro/write_test", "w").write("OVERLAYDATA")
+    print(open("data/ro/write_test").read() + open("data/ro/rofile").read())
+
+
 def helper_rw_write():
     open("data/rw/write_test", "w").write("RWTESTDATA")
 
@@ -72,6 +77,8 @@ def main():
             helper_ro_read()
         elif cmd == "ro_write":
             helper_ro_write()
+        elif cmd == "overlay_write":
+            helper_overlay_write()
         elif cmd == "rw_write":
             helper_rw_write()
         elif cmd == "hide_read":